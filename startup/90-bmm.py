@@ -20,6 +20,9 @@ from BMM.linescans import linescan, pluck, rocking_curve, slit_height, ls2dat
 run_report('\t'+'areascan')
 from BMM.areascan import areascan, as2dat
 
+run_report('\t'+'XANES imaging')
+from BMM.xanesmap import xanes_map, xm2npz, XanesMapViewer
+
 run_report('\t'+'timescan')
 from BMM.timescan import timescan, ts2dat
 
@@ -66,8 +69,18 @@ XDI_record = {'xafs_linx'                        : (True,  'BMM.sample_x_positio
               'monotc_downstream_temperature'    : (False, 'BMM.mono_tc_downstream'),
               'monotc_upstream_low_temperature'  : (False, 'BMM.mono_tc_upstream_low'),
               }
+run_report('\t'+'run cache')
+from BMM.runcache import runcache
+RE.subscribe(runcache)
+
+run_report('\t'+'dead-time profiler')
+from BMM.profiler import profiler
+RE.preprocessors.append(profiler)
+
 run_report('\t'+'XDI')
 from BMM.xdi import write_XDI
+from BMM.xdi_benchmark import xdi_benchmark
+from BMM.sidecar import read_sidecar, load_experiment
 
 run_report('\t'+'machine learning and data evaluation')
 from BMM.ml import BMMDataEvaluation
@@ -75,6 +88,12 @@ clf = BMMDataEvaluation()
 
 run_report('\t'+'xafs')
 from BMM.xafs import howlong, xafs, db2xdi
+from BMM.estimator import estimator
+from BMM.pitchtable import pitch_table
+from BMM.bulkexport import bulk_export
+
+run_report('\t'+'macro preflight')
+from BMM.preflight import preflight
 
 run_report('\t'+'mono calibration')
 from BMM.mono_calibration import calibrate_high_end, calibrate_low_end, calibrate_mono
@@ -93,6 +112,12 @@ from BMM.larch import Pandrosus, Kekropidai
 # bunch.add(seo)
 
 
+run_report('\t'+'merging scan sequences')
+from BMM.merge import merge
+
+run_report('\t'+'dossier quad plot')
+from BMM.quadplot import quadplot, athena_project
+
 run_report('\t'+'Demeter')
 from BMM.demeter import athena, hephaestus, toprj
 
@@ -0,0 +1,242 @@
+from bluesky.preprocessors import run_wrapper, stage_wrapper
+
+import numpy
+from collections import defaultdict
+from cycler import cycler
+
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+from BMM.perstep       import FusedStep, with_step_timing
+from BMM.runcache      import runcache
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Adaptive XANES                                                        #
+#                                                                       #
+# A conventional grid spends most of its points at the finest step      #
+# (0.5 eV from -30 to +15.3, typically), wherever the features of the   #
+# edge happen to be.  An adaptive scan measures the conventional grid   #
+# with only every third point of that edge region, computes mu(E) from  #
+# the live data (with the same functions DerivedPlot uses), and then,   #
+# in a few rounds, adds the skipped points of the grid where the        #
+# derivative and curvature of mu(E) are largest, until the point        #
+# budget is spent -- the last round spends all that is left, so the     #
+# number of points is known when the run starts.  All points go into a  #
+# single run, so the data file and the database record look like any    #
+# other XAFS scan, except that the measurements are not in energy       #
+# order.  The XDI file and the live plot are sorted.                    #
+#                                                                       #
+# In an INI file:                                                       #
+#     adaptive = True                                                   #
+#     budget   = 0.5    # fraction of the edge-region points measured   #
+#########################################################################
+
+
+def absorption(mode):
+    '''Return a list of (function, ylabel) for plotting an XAFS scan in
+    the given measurement mode.  Each function takes an event document
+    (or anything with a "data" item holding columns) and returns
+    (energy, mu).  Return None for an unknown mode.'''
+    BMMuser = user_ns['BMMuser']
+    test  = lambda doc: (doc['data']['dcm_energy'], doc['data']['I0'])
+    trans = lambda doc: (doc['data']['dcm_energy'], numpy.log(doc['data']['I0'] / doc['data']['It']))
+    ref   = lambda doc: (doc['data']['dcm_energy'], numpy.log(doc['data']['It'] / doc['data']['Ir']))
+    Yield = lambda doc: (doc['data']['dcm_energy'], 1000*doc['data']['Iy'] / doc['data']['I0'])
+    if BMMuser.detector == 1:
+        fluo  = lambda doc: (doc['data']['dcm_energy'], doc['data'][BMMuser.dtc1] / doc['data']['I0'])
+    else:
+        fluo  = lambda doc: (doc['data']['dcm_energy'], (doc['data'][BMMuser.dtc1] +
+                                                         doc['data'][BMMuser.dtc2] + # removed doc['data'][BMMuser.dtc3] +
+                                                         doc['data'][BMMuser.dtc4]) / doc['data']['I0'])
+    xspress3 = lambda doc: (doc['data']['dcm_energy'], (doc['data'][BMMuser.xs1] +
+                                                        doc['data'][BMMuser.xs2] +
+                                                        doc['data'][BMMuser.xs3] +
+                                                        doc['data'][BMMuser.xs4] ) / doc['data']['I0'])
+    if 'fluo'    in mode or 'flou' in mode:
+        return [(fluo,     'absorption (fluorescence)')]
+    elif 'trans' in mode:
+        return [(trans,    'absorption (transmission)')]
+    elif 'ref'   in mode:
+        return [(ref,      'absorption (reference)')]
+    elif 'yield' in mode:
+        return [(Yield,    'absorption (electron yield)'),
+                (trans,    'absorption (transmission)')]
+    elif 'test'  in mode:
+        return [(test,     'I0 (test)')]
+    elif 'both'  in mode:
+        return [(trans,    'absorption (transmission)'),
+                (fluo,     'absorption (fluorescence)')]
+    elif 'xs'    in mode:
+        return [(xspress3, 'If / I0 (Xspress3)')]
+    return None
+
+
+class AdaptiveXANES():
+    '''Choose the points of an adaptive XANES scan from a conventional grid.
+
+      energy, dwell: the conventional energy and dwell time grids
+      budget:        fraction of the edge-region points to measure
+      coarsen:       the first pass measures every coarsen-th edge-region point
+      rounds:        number of refinement passes
+
+    The edge region is the span of the grid with the finest step.  All
+    other points are measured in the first pass.  Every point measured
+    is a point of the conventional grid, with its dwell time.
+    '''
+    def __init__(self, energy, dwell, budget=0.5, coarsen=3, rounds=3):
+        energy, dwell  = numpy.asarray(energy, dtype=float), numpy.asarray(dwell, dtype=float)
+        self.reverse   = bool(len(energy) > 1 and energy[0] > energy[-1])
+        order          = numpy.argsort(energy)
+        self.energy    = energy[order]
+        self.dwell     = dwell[order]
+        self.rounds    = rounds
+        self.round     = 0
+
+        region = numpy.zeros(len(self.energy), dtype=bool)
+        if len(self.energy) > 2:
+            steps = numpy.diff(self.energy)
+            (sizes, counts) = numpy.unique(numpy.round(steps, 3), return_counts=True)
+            finest = sizes[counts >= 3][0] if any(counts >= 3) else sizes[0]  # not the odd step at a boundary
+            fine  = steps <= finest*1.01 + 1e-6
+            region[:-1] |= fine
+            region[1:]  |= fine
+        self.region   = numpy.flatnonzero(region)
+        self.measured = ~region
+        if len(self.region) > 0:
+            self.measured[self.region[::coarsen]] = True
+            self.measured[self.region[-1]] = True
+        first = int(self.measured[self.region].sum())
+        self.budget = max(int(round(budget*len(self.region))), first)
+
+    def __repr__(self):
+        return '<AdaptiveXANES: %d of %d points, %d in the edge region>' % \
+            (self.measured.sum(), len(self.energy), self.measured[self.region].sum())
+
+    def _points(self, index):
+        index = sorted(index, reverse=self.reverse)
+        return [float(x) for x in self.energy[index]], [float(x) for x in self.dwell[index]]
+
+    def coarse(self):
+        '''Return (energies, dwells) of the first pass, in scan order.'''
+        return self._points(numpy.flatnonzero(self.measured))
+
+    def size(self):
+        '''Return (number of points, total dwell time) of the whole scan.'''
+        outside = numpy.ones(len(self.energy), dtype=bool)
+        outside[self.region] = False
+        dwell = self.dwell[outside].sum()
+        if len(self.region) > 0:
+            dwell += self.budget * self.dwell[self.region].mean()
+        return int(outside.sum()) + self.budget, float(dwell)
+
+    def refine(self, energy, mu):
+        '''Given the energies and mu(E) measured so far, in any order,
+        return (energies, dwells) of the points to measure next, or empty
+        lists when the budget is spent.'''
+        remaining = self.budget - int(self.measured[self.region].sum())
+        if self.round >= self.rounds or remaining <= 0:
+            return [], []
+        energy, mu = numpy.asarray(energy, dtype=float), numpy.nan_to_num(numpy.asarray(mu, dtype=float))
+        order  = numpy.argsort(energy)
+        energy, mu = energy[order], mu[order]
+
+        ## derivative and curvature of mu(E) at the measured edge-region points
+        ms = self.region[self.measured[self.region]]
+        if len(ms) < 3:
+            ## too few points for a derivative, spend the budget evenly
+            gaps = self.region[~self.measured[self.region]]
+            new = gaps[numpy.linspace(0, len(gaps)-1, min(remaining, len(gaps))).round().astype(int)]
+            self.round = self.rounds
+            self.measured[new] = True
+            return self._points(new)
+        e  = self.energy[ms]
+        m  = numpy.interp(e, energy, mu)
+        d1 = numpy.abs(numpy.gradient(m, e))
+        d2 = numpy.abs(numpy.gradient(numpy.gradient(m, e), e))
+        d1 = d1 / d1.max() if d1.max() > 0 else d1
+        d2 = d2 / d2.max() if d2.max() > 0 else d2
+
+        ## score each interval which still has unmeasured grid points in it
+        width  = numpy.diff(e)
+        score  = (width/width.min()) * ((d1[:-1]+d1[1:])/2 + (d2[:-1]+d2[1:])/2)
+        gaps   = [numpy.flatnonzero(~self.measured[ms[j]+1:ms[j+1]]) + ms[j]+1 for j in range(len(ms)-1)]
+        for j, g in enumerate(gaps):
+            if len(g) == 0:
+                score[j] = -1
+
+        ## split the best intervals at the unmeasured grid point nearest their middles
+        n = int(numpy.ceil(remaining / (self.rounds - self.round)))
+        self.round += 1
+        chosen = [j for j in numpy.argsort(-score)[:n] if score[j] >= 0]
+        new = [gaps[j][numpy.argmin(numpy.abs(gaps[j] - (ms[j]+ms[j+1])/2))] for j in chosen]
+
+        ## the last round spends whatever is left of the budget, so that the
+        ## scan has the number of points promised in the start document
+        if self.round == self.rounds:
+            for j in numpy.argsort(-score):
+                if len(new) >= remaining:
+                    break
+                for i in sorted(gaps[j], key=lambda i: abs(i - (ms[j]+ms[j+1])/2)):
+                    if len(new) >= remaining:
+                        break
+                    if i not in new:
+                        new.append(i)
+        self.measured[new] = True
+        return self._points(new)
+
+
+def adaptive_xanes(detectors, energy, dwell, mode, budget=0.5, md=None):
+    '''Measure an adaptive XANES scan in one run.  See the comment above.
+
+      detectors:     list of detectors, as for scan_nd
+      energy, dwell: the conventional energy and dwell time grids
+      mode:          measurement mode, used to compute mu(E)
+      budget:        fraction of the edge-region points to measure
+      md:            metadata
+
+    Return the uid of the run.
+    '''
+    dcm, dwell_time = user_ns['dcm'], user_ns['dwell_time']
+    functions = absorption(mode)
+    if functions is None:
+        functions = absorption('transmission')
+    mu = functions[-1][0] if 'both' in mode else functions[0][0]
+
+    adaptive = AdaptiveXANES(energy, dwell, budget=budget)
+    (npoints, total) = adaptive.size()
+    (these_energies, these_times) = adaptive.coarse()
+    fused = FusedStep(cycler(dcm.energy, these_energies) + cycler(dwell_time, these_times), dwell=dwell_time)
+    _md = {'detectors':  [d.name for d in detectors],
+           'motors':     [dcm.energy.name],
+           'num_points': npoints,
+           'plan_name':  'adaptive_xanes',
+           'plan_args':  {'detectors': list(map(repr, detectors)), 'budget': budget,
+                          'energy': list(energy), 'dwell': list(dwell), 'mode': mode},
+           'hints':      {'dimensions': [([dcm.energy.name], 'primary')]},
+    }
+    _md.update(md or {})
+
+    def measure(start):
+        pos_cache = defaultdict(lambda: None)
+        for step in fused.points[start:]:
+            yield from fused(detectors, step, pos_cache)
+
+    def inner():
+        yield from measure(0)
+        while True:
+            table = runcache.table(-1)
+            (e, m) = mu({'data': table})
+            (these_energies, these_times) = adaptive.refine(e, m)
+            if len(these_energies) == 0:
+                break
+            print(whisper('  adaptive XANES: adding %d points' % len(these_energies)))
+            start = len(fused.points)
+            fused.points.extend(list(cycler(dcm.energy, these_energies) + cycler(dwell_time, these_times)))
+            yield from measure(start)
+        print(whisper('  adaptive XANES: measured %d points, %d in the edge region' %
+                      (adaptive.measured.sum(), adaptive.measured[adaptive.region].sum())))
+
+    plan = stage_wrapper(run_wrapper(inner(), md=_md), list(detectors) + [dcm.energy, dwell_time])
+    return (yield from with_step_timing(plan, fused))
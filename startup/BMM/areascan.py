@@ -3,18 +3,21 @@ from bluesky.plans import grid_scan
 from bluesky.callbacks import LiveGrid
 from bluesky.plan_stubs import abs_set, sleep, mv, mvr, null
 import numpy
-import os
+import os, datetime
 
-from bluesky.preprocessors import subs_decorator
+from bluesky.preprocessors import subs_decorator, finalize_wrapper
 ## see 65-derivedplot.py for DerivedPlot class
 ## see 10-motors.py and 20-dcm.py for motor definitions
 
 from BMM.resting_state import resting_state_plan
-from BMM.suspenders    import BMM_clear_to_start
+from BMM.suspenders    import BMM_clear_to_start, BMM_suspenders
 from BMM.logging       import BMM_log_info, BMM_msg_hook
-from BMM.functions     import countdown
-from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
-from BMM.derivedplot   import DerivedPlot, interpret_click
+from BMM.preflight     import preflight, dryrun
+from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, whisper
+from BMM.derivedplot   import DerivedPlot, interpret_click, handle_close
+from BMM.flyscan       import fly_raster
+from BMM.linescans     import motor_nicknames
+from BMM.runcache      import runcache
 
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
@@ -23,7 +26,7 @@ user_ns = get_ipython().user_ns
 def areascan(detector,
              slow, startslow, stopslow, nslow,
              fast, startfast, stopfast, nfast,
-             pluck=True, force=False, dwell=0.1, md={}):
+             pluck=True, force=False, dwell=0.1, snake=False, fly=False, refine=None, md={}):
     '''
     Generic areascan plan.  This is a RELATIVE scan, relative to the
     current positions of the selected motors.
@@ -43,6 +46,9 @@ def areascan(detector,
        pluck:    optional flag for whether to offer to pluck & move motor
        force:    optional flag for forcing a scan even if not clear to start
        dwell:    dwell time at each point (0.1 sec default)
+       snake:    optional flag for measuring alternate rows in opposite directions
+       fly:      optional flag for flying the fast axis (implies snake)
+       refine:   optional gradient threshold for a second, finer pass
        md:       composable dictionary of metadata
 
     slow and fast are either the BlueSky name for a motor (e.g. xafs_linx)
@@ -52,12 +58,26 @@ def areascan(detector,
 
     Use the as2dat() function to extract the areascan from the
     database and write it to a file.
+
+    With snake=True, the fast axis does not return to its start at the
+    end of each row.  With fly=True, the fast motor moves at constant
+    velocity across each row while the detectors are sampled, and the
+    samples are binned onto the nfast pixels (see fly_raster in
+    BMM/flyscan.py), removing the per-point overhead.  The fast axis
+    must be an EpicsMotor.
+
+    With refine set to a number between 0 and 1, the map is examined
+    after it is measured.  Pixels where the gradient of the signal is
+    larger than refine times its largest value are found, and the box
+    around them (plus one pixel) is measured again with twice the
+    density on both axes, as a second run with its own plot.  Plucking
+    then uses the finer map.
     '''
 
     def main_plan(detector,
                   slow, startslow, stopslow, nslow,
                   fast, startfast, stopfast, nfast,
-                  pluck, force, dwell, md):
+                  pluck, force, dwell, snake, fly, refine, md):
         (ok, text) = BMM_clear_to_start()
         if force is False and ok is False:
             print(error_msg(text))
@@ -89,11 +109,16 @@ def areascan(detector,
         if fast in motor_nicknames.keys():
             fast = motor_nicknames[fast]
 
+        if fly and 'EpicsMotor' not in str(type(fast)):
+            print(warning_msg('\nCannot fly %s, stepping instead.\n' % fast.name))
+            fly = False
+        snake = snake or fly
+
         detector = detector.capitalize()
         yield from abs_set(_locked_dwell_time, dwell, wait=True)
-        dets = [quadem1,]
+        dets = [user_ns['quadem1'],]
         if detector == 'If':
-            dets.append(vor)
+            dets.append(user_ns['vor'])
             detector = 'ROI1'
 
         
@@ -112,7 +137,10 @@ def areascan(detector,
                 (fast.name, startfast, stopfast, nfast, valuefast)
 
         npoints = nfast * nslow
-        estimate = int(npoints*(dwell+0.7))
+        if fly:
+            estimate = int(nslow*(nfast*dwell+3))
+        else:
+            estimate = int(npoints*(dwell+0.7))
     
         # extent = (
         #     valuefast + startfast,
@@ -133,15 +161,6 @@ def areascan(detector,
         # areaplot = LiveScatter(fast.name, slow.name, detector,
         #                        xlim=(startfast, stopfast), ylim=(startslow, stopslow))
     
-        areaplot = LiveGrid((nslow, nfast), detector, #aspect='equal', #aspect=float(nslow/nfast), extent=extent,
-                            xlabel='fast motor: %s' % fast.name,
-                            ylabel='slow motor: %s' % slow.name)
-        BMMuser.ax     = areaplot.ax
-        BMMuser.fig    = areaplot.ax.figure
-        BMMuser.motor  = fast
-        BMMuser.motor2 = slow
-        BMMuser.fig.canvas.mpl_connect('close_event', handle_close)
-
         thismd = dict()
         thismd['XDI'] = dict()
         thismd['XDI']['Facility'] = dict()
@@ -154,17 +173,33 @@ def areascan(detector,
         ## engage suspenders right before starting scan sequence
         if force is False: BMM_suspenders()
     
-        @subs_decorator(areaplot)
-        #@subs_decorator(src.callback)
         def make_areascan(dets,
                           slow, startslow, stopslow, nslow,
                           fast, startfast, stopfast, nfast,
                           snake=False):
+            areaplot = LiveGrid((nslow, nfast), detector, #aspect='equal', #aspect=float(nslow/nfast), extent=extent,
+                                xlabel='fast motor: %s' % fast.name,
+                                ylabel='slow motor: %s' % slow.name)
+            BMMuser.ax     = areaplot.ax
+            BMMuser.fig    = areaplot.ax.figure
+            BMMuser.motor  = fast
+            BMMuser.motor2 = slow
+            BMMuser.fig.canvas.mpl_connect('close_event', handle_close)
+
+            @subs_decorator(areaplot)
+            #@subs_decorator(src.callback)
+            def scan():
+                if fly:
+                    return (yield from fly_raster(dets,
+                                                  slow, numpy.linspace(startslow, stopslow, nslow),
+                                                  fast, numpy.linspace(startfast, stopfast, nfast),
+                                                  dwell=dwell, snake=snake, md={**thismd, **md}))
+                return (yield from grid_scan(dets,
+                                             slow, startslow, stopslow, nslow,
+                                             fast, startfast, stopfast, nfast,
+                                             snake, md={**thismd, **md}))
             BMMuser.final_log_entry = False
-            uid = yield from grid_scan(dets,
-                                       slow, startslow, stopslow, nslow,
-                                       fast, startfast, stopfast, nfast,
-                                       snake)
+            uid = yield from scan()
             BMMuser.final_log_entry = True
             return uid
 
@@ -175,7 +210,21 @@ def areascan(detector,
         uid = yield from make_areascan(dets,
                                        slow, valueslow+startslow, valueslow+stopslow, nslow,
                                        fast, valuefast+startfast, valuefast+stopfast, nfast,
-                                       False)
+                                       snake)
+
+        ## pluck converts plot coordinates using the most recent grid
+        grid = (valueslow+startslow, valueslow+stopslow, nslow, valuefast+startfast, valuefast+stopfast, nfast)
+        if refine is not None:
+            box = refinement(uid, detector, grid, snake, refine)
+            if box is None:
+                print(whisper('No part of the map has a gradient above %.2f of the largest, not refining.' % refine))
+            else:
+                print(bold_msg('Refining the map over %s %.3f to %.3f and %s %.3f to %.3f' %
+                               (slow.name, box[0], box[1], fast.name, box[3], box[4])))
+                BMM_log_info('areascan refinement\n\tslow motor: %s, %.3f, %.3f, %d\n\tfast motor: %s, %.3f, %.3f, %d' %
+                             (slow.name, box[0], box[1], box[2], fast.name, box[3], box[4], box[5]))
+                yield from make_areascan(dets, slow, *box[:3], fast, *box[3:], snake)
+                grid = box
 
         if pluck is True:
             action = input('\n' + bold_msg('Pluck motor position from the plot? [Y/n then Enter] '))
@@ -187,13 +236,13 @@ def areascan(detector,
                 yield from sleep(0.5)
 
             print('Converting plot coordinates to real coordinates...')
-            begin = valuefast + startfast
-            stepsize = (stopfast - startfast) / (nfast - 1)
+            begin = grid[3]
+            stepsize = (grid[4] - grid[3]) / (grid[5] - 1)
             pointfast = begin + stepsize * BMMuser.x
             #print(BMMuser.x, pointfast)
         
-            begin = valueslow + startslow
-            stepsize = (stopslow - startslow) / (nslow - 1)
+            begin = grid[0]
+            stepsize = (grid[1] - grid[0]) / (grid[2] - 1)
             pointslow = begin + stepsize * BMMuser.y
             #print(BMMuser.y, pointslow)
 
@@ -205,6 +254,7 @@ def areascan(detector,
         RE.clear_suspenders()
         if os.path.isfile(dotfile): os.remove(dotfile)
         if BMMuser.final_log_entry is True:
+            db = user_ns['db']
             BMM_log_info('areascan finished\n\tuid = %s, scan_id = %d' % (db[-1].start['uid'], db[-1].start['scan_id']))
         yield from resting_state_plan()
         RE.msg_hook = BMM_msg_hook
@@ -226,23 +276,57 @@ def areascan(detector,
     # this is a tool for verifying a macro.  this replaces an xafs scan  #
     # with a sleep, allowing the user to easily map out motor motions in #
     # a macro                                                            #
-    if BMMuser.macro_dryrun:
-        print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running an area scan.\n' %
-                       BMMuser.macro_sleep))
-        countdown(BMMuser.macro_sleep)
-        return(yield from null())
+    if BMMuser.macro_dryrun or preflight.active:
+        return(yield from dryrun('areascan', 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running an area scan.' %
+                                 BMMuser.macro_sleep, slow=slow, startslow=startslow, stopslow=stopslow, nslow=nslow,
+                                 fast=fast, startfast=startfast, stopfast=stopfast, nfast=nfast, dwell=dwell,
+                                 snake=snake, fly=fly))
     ######################################################################
     dotfile = '/home/xf06bm/Data/.area.scan.running'
     BMMuser.final_log_entry = True
     RE.msg_hook = None
     ## encapsulation!
-    yield from bluesky.preprocessors.finalize_wrapper(main_plan(detector,
-                                                                slow, startslow, stopslow, nslow,
-                                                                fast, startfast, stopfast, nfast,
-                                                                pluck, force, dwell, md),
-                                                      cleanup_plan())
+    yield from finalize_wrapper(main_plan(detector,
+                                          slow, startslow, stopslow, nslow,
+                                          fast, startfast, stopfast, nfast,
+                                          pluck, force, dwell, snake, fly, refine, md),
+                                cleanup_plan())
     RE.msg_hook = BMM_msg_hook
 
+
+def refinement(uid, detector, grid, snake, threshold):
+    '''Find the box around the pixels of an area scan where the gradient
+    of the signal is more than threshold times its largest value.
+
+      uid:       the area scan
+      detector:  the data key shown in the plot
+      grid:      (startslow, stopslow, nslow, startfast, stopfast, nfast), absolute
+      snake:     True if alternate rows were measured in reverse
+      threshold: fraction of the largest gradient
+
+    Return the grid of a scan of that box, extended by one pixel, at
+    twice the density, or None if there is nothing to refine.
+    '''
+    (startslow, stopslow, nslow, startfast, stopfast, nfast) = grid
+    signal = numpy.array(runcache.table(uid, columns=[detector])[detector], dtype=float)
+    if len(signal) != nslow*nfast or nslow < 2 or nfast < 2:
+        return None
+    signal = signal.reshape(nslow, nfast)
+    if snake:
+        signal[1::2] = signal[1::2, ::-1]
+    gy, gx = numpy.gradient(signal)
+    gradient = numpy.hypot(gx, gy)
+    if gradient.max() <= 0:
+        return None
+    rows, columns = numpy.nonzero(gradient > threshold * gradient.max())
+    if len(rows) == 0 or (len(set(rows)) == nslow and len(set(columns)) == nfast):
+        return None
+    r0, r1 = max(rows.min()-1, 0), min(rows.max()+1, nslow-1)
+    c0, c1 = max(columns.min()-1, 0), min(columns.max()+1, nfast-1)
+    slow = numpy.linspace(startslow, stopslow, nslow)
+    fast = numpy.linspace(startfast, stopfast, nfast)
+    return (float(slow[r0]), float(slow[r1]), int(2*(r1-r0)+1), float(fast[c0]), float(fast[c1]), int(2*(c1-c0)+1))
+
         
 def as2dat(datafile, key):
     '''
@@ -270,8 +354,9 @@ def as2dat(datafile, key):
         return
 
     devices = dataframe.devices() # note: this is a _set_ (this is helpful: https://snakify.org/en/lessons/sets/)
+    table = dataframe.table()
 
-    if 'vor' in devices:
+    if 'vor' in devices or BMMuser.dtc1 in table.columns:   # a fly scan's detectors are all in the 'fly' device
         column_list = [dataframe['start']['slow_motor'], dataframe['start']['fast_motor'],
                        'I0', 'It', 'Ir',
                        BMMuser.dtc1, BMMuser.dtc2, BMMuser.dtc3, BMMuser.dtc4,
@@ -284,7 +369,6 @@ def as2dat(datafile, key):
         column_list = [dataframe['start']['slow_motor'], dataframe['start']['fast_motor'], 'I0', 'It', 'Ir']
         template = "  %.3f  %.3f  %.6f  %.6f  %.6f\n"
 
-    table = dataframe.table()
     this = table.loc[:,column_list]
 
     handle = open(datafile, 'w')
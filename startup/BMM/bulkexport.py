@@ -0,0 +1,208 @@
+from databroker import catalog
+from databroker.queries import TimeRange
+
+import os, json, time, traceback, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from BMM.functions     import error_msg, warning_msg, go_msg, bold_msg, whisper
+from BMM.logging       import BMM_log_info
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Bulk re-export of the runs of an experiment                           #
+#                                                                       #
+# The runs matching a catalog query are exported by a pool of forked    #
+# worker processes, each with its own databroker connection.  The       #
+# exporter is chosen by the plan which made the run:                    #
+#                                                                       #
+#    scan_nd, fly_energy_scan, --> write_XDI  (XAFS)                    #
+#    adaptive_xanes                                                     #
+#    count                     --> write_XDI  (sead) or ts2dat          #
+#    rel_scan, scan,           --> ls2dat                               #
+#    fly_linescan                                                       #
+#    grid_scan, rel_grid_scan, --> as2dat                               #
+#    fly_raster                                                         #
+#                                                                       #
+# peak_search runs (the adaptive alignment scans) are not exported:     #
+# their points are measured out of position order and the result is     #
+# already in the experiment log.                                        #
+#                                                                       #
+# Progress is kept in a JSON manifest in the output folder.  Running    #
+# the same export again skips everything the manifest says is done.     #
+#########################################################################
+
+EXPORTERS = {'scan_nd'         : 'xdi',
+             'fly_energy_scan' : 'xdi',
+             'adaptive_xanes'  : 'xdi',
+             'count'           : 'ts',
+             'rel_scan'        : 'ls',
+             'scan'            : 'ls',
+             'fly_linescan'    : 'ls',
+             'grid_scan'       : 'as',
+             'rel_grid_scan'   : 'as',
+             'fly_raster'      : 'as',}
+
+
+def _bulk_init():
+    '''Worker initializer.  A Mongo client must not be shared across a
+    fork, so each worker process makes its own Broker.'''
+    from databroker import Broker
+    user_ns['db'] = Broker.named('bmm')
+
+
+def _export_one(uid, exporter, datafile):
+    '''Export one run in a worker process.  The file is written under a
+    temporary name and moved into place, so a killed job never leaves
+    a partial file behind.  An XDI file's sidecar is moved with it.
+    Return (uid, datafile, error, seconds).'''
+    from BMM.sidecar import sidecar_name, move_sidecar
+    t0 = time.time()
+    part = datafile + '.part'
+    try:
+        for stale in (part, sidecar_name(part)):
+            if os.path.isfile(stale):
+                os.remove(stale)
+        if exporter == 'xdi':
+            from BMM.xdi import write_XDI
+            write_XDI(part, user_ns['db'][uid], final=datafile)
+        elif exporter == 'ts':
+            from BMM.timescan import ts2dat
+            ts2dat(part, uid)
+        elif exporter == 'ls':
+            from BMM.linescans import ls2dat
+            ls2dat(part, uid)
+        elif exporter == 'as':
+            from BMM.areascan import as2dat
+            as2dat(part, uid)
+        if not os.path.isfile(part):
+            raise RuntimeError('%s exporter did not write a file' % exporter)
+        move_sidecar(part, datafile)
+        os.replace(part, datafile)
+        return (uid, datafile, None, time.time()-t0)
+    except Exception:
+        return (uid, datafile, traceback.format_exc(), time.time()-t0)
+
+
+def _run_query(gup=None, saf=None, since=None, until=None, plan_name=None):
+    query = dict()
+    if gup is not None:
+        query['XDI.Facility.GUP'] = str(gup)
+    if saf is not None:
+        query['XDI.Facility.SAF'] = str(saf)
+    if plan_name is not None:
+        query['plan_name'] = plan_name
+    results = catalog['bmm'].search(query)
+    if since is not None or until is not None:
+        results = results.search(TimeRange(since=since, until=until, timezone="US/Eastern"))
+    return results
+
+
+def _output_name(start, exporter):
+    '''Use the file name recorded at measurement time when there is one,
+    otherwise make one from the plan name and scan_id.'''
+    try:
+        name = start['XDI']['_filename']
+        if name:
+            return os.path.basename(name)
+    except (KeyError, TypeError):
+        pass
+    ext = 'xdi' if exporter == 'xdi' else 'dat'
+    return '%s_%d.%s' % (start.get('plan_name', 'run'), start['scan_id'], ext)
+
+
+def _save_manifest(manifest, data):
+    with open(manifest + '.part', 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(manifest + '.part', manifest)
+
+
+def bulk_export(folder, gup=None, saf=None, since=None, until=None, plan_name=None,
+                workers=4, manifest=None, overwrite=False):
+    '''Export every run matching a catalog query to a data file.
+
+      folder:    output folder
+      gup, saf:  GUP and SAF numbers recorded in the XDI metadata
+      since, until: date range, e.g. '2021-03-01', '2021-03-04 18:00'
+      plan_name: e.g. 'scan_nd' for XAFS scans only
+      workers:   number of worker processes
+      manifest:  progress file, default <folder>/.bulk_export.json
+      overwrite: True to replace existing files not made by this export
+
+    For example, all the XAFS data from a proposal:
+
+       bulk_export('/nsls2/data/bmm/.../regenerated', gup=308765, plan_name='scan_nd')
+
+    If interrupted, run the same command again to pick up where it
+    stopped.  Files which failed are listed in the manifest with
+    their tracebacks and are tried again on the next run.
+
+    Return the manifest as a dict keyed by uid.
+    '''
+    if not os.path.isdir(folder):
+        print(error_msg('%s is not a folder' % folder))
+        return None
+    if manifest is None:
+        manifest = os.path.join(folder, '.bulk_export.json')
+    progress = dict()
+    if os.path.isfile(manifest):
+        with open(manifest, 'r') as f:
+            progress = json.load(f)
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## gather the work to be done
+    results = _run_query(gup=gup, saf=saf, since=since, until=until, plan_name=plan_name)
+    todo, skipped, unknown = [], 0, 0
+    for uid in results:
+        start = results[uid].metadata['start']
+        if uid in progress and progress[uid]['status'] == 'done':
+            skipped += 1
+            continue
+        exporter = EXPORTERS.get(start.get('plan_name'))
+        if exporter == 'ts' and start.get('XDI', {}).get('_kind') == 'sead':
+            exporter = 'xdi'
+        if exporter is None:
+            unknown += 1
+            continue
+        datafile = os.path.join(folder, _output_name(start, exporter))
+        if os.path.isfile(datafile) and not overwrite:
+            progress[uid] = {'file': datafile, 'status': 'exists'}
+            continue
+        todo.append((uid, exporter, datafile))
+    print(bold_msg('%d runs to export, %d already done, %d with no exporter' % (len(todo), skipped, unknown)))
+    if len(todo) == 0:
+        _save_manifest(manifest, progress)
+        return progress
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## fan out over a pool of forked processes
+    t0, done, failed = time.time(), 0, 0
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_bulk_init) as pool:
+        futures = [pool.submit(_export_one, *job) for job in todo]
+        try:
+            for future in as_completed(futures):
+                (uid, datafile, error, seconds) = future.result()
+                if error is None:
+                    done += 1
+                    progress[uid] = {'file': datafile, 'status': 'done', 'seconds': round(seconds, 3)}
+                else:
+                    failed += 1
+                    progress[uid] = {'file': datafile, 'status': 'failed', 'error': error}
+                    print(error_msg('failed: %s (%s)' % (os.path.basename(datafile), uid)))
+                _save_manifest(manifest, progress)
+                if (done+failed) % 25 == 0:
+                    elapsed = time.time() - t0
+                    print(whisper('  %d of %d, %.1f runs/sec' % (done+failed, len(todo), (done+failed)/elapsed)))
+        except KeyboardInterrupt:
+            for f in futures:
+                f.cancel()
+            print(warning_msg('bulk export interrupted -- run it again to resume'))
+
+    elapsed = time.time() - t0
+    rate = (done+failed)/elapsed if elapsed > 0 else 0
+    print(go_msg('exported %d runs (%d failed) in %.1f seconds, %.2f runs/sec' % (done, failed, elapsed, rate)))
+    BMM_log_info('bulk export to %s: %d runs exported, %d failed, %.2f runs/sec' % (folder, done, failed, rate))
+    return progress
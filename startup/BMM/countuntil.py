@@ -0,0 +1,179 @@
+from bluesky.plan_stubs import trigger, wait, create, read
+from bluesky.utils import short_uid, separate_devices
+
+import numpy, numbers
+
+from BMM.adaptive      import absorption
+from BMM.flyscan       import BinnedReadings
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+from BMM.perstep       import FusedStep
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Count-until-statistics integration                                    #
+#                                                                       #
+# With a fixed dwell time per region (or a k-weighted one), a dilute    #
+# sample is measured for too long at low k and for too short at high    #
+# k.  CountUntil is a per_step for scan_nd which integrates each point  #
+# in short sub-frames -- the dwell time is set to the sub-frame length  #
+# once, at the first point -- and keeps going until the relative        #
+# uncertainty of mu(E) is below a target or a time limit is reached.    #
+#                                                                       #
+# The uncertainty is the standard error of the mean of mu over the      #
+# sub-frames, but never less than 1/sqrt(N), N being the fluorescence   #
+# counts for a counting detector (Struck DTC signals or Xspress3 ROIs). #
+#                                                                       #
+# The event for the point comes from an accumulator, a soft device      #
+# with the same data keys as the detectors, holding the average of the  #
+# sub-frames, so every point is on the same (one sub-frame) scale no    #
+# matter how many frames it took.  The summed counts are used only for  #
+# the 1/sqrt(N) test.  dwti_dwell_time is the integration time          #
+# achieved, and the number of frames and the uncertainty are recorded   #
+# alongside.                                                            #
+#                                                                       #
+# In an INI file:                                                       #
+#     precision = 0.002   # target relative uncertainty, 0 = off        #
+#     maxdwell  = 10      # most seconds at one point                   #
+#     subframe  = 0.25    # length of one sub-frame                     #
+#########################################################################
+
+
+class CountUntil(FusedStep):
+    '''A per_step for scan_nd.  See the comment above.
+
+      trajectory: the cycler given to scan_nd
+      dwell:      the dwell time axis (dwell_time)
+      mode:       measurement mode, used to compute mu(E)
+      precision:  target relative uncertainty of mu at each point
+      maxdwell:   integration time limit at each point, in seconds
+      subframe:   length of one sub-frame, in seconds
+      minframes:  fewest sub-frames at each point
+    '''
+    def __init__(self, trajectory, dwell, mode, precision=0.002, maxdwell=10, subframe=0.25, minframes=2):
+        super().__init__(trajectory, dwell=dwell)
+        self.mode        = mode
+        self.precision   = precision
+        self.maxdwell    = maxdwell
+        self.subframe    = subframe
+        self.minframes   = max(int(minframes), 2)
+        self.accumulator = BinnedReadings(name='accumulator')
+        self.dwell_keys  = []
+        self.achieved    = []
+        self.frames      = []
+        self.warned      = False
+        functions = absorption(mode) or absorption('transmission')
+        self.mu = functions[-1][0] if 'both' in mode else functions[0][0]
+        BMMuser = user_ns['BMMuser']
+        if 'xs' in mode:
+            self.counted = [BMMuser.xs1, BMMuser.xs2, BMMuser.xs3, BMMuser.xs4]
+        elif 'fluo' in mode or 'flou' in mode or 'both' in mode:
+            self.counted = [BMMuser.dtc1] if BMMuser.detector == 1 else [BMMuser.dtc1, BMMuser.dtc2, BMMuser.dtc4]
+        else:
+            self.counted = []
+        ## the dwell time axis is set to the sub-frame length, rather than the grid's dwell time
+        self.points = [{m: (subframe if m is dwell else v) for m,v in p.items()} for p in self.points]
+
+    def __call__(self, detectors, step, pos_cache):
+        step = {m: (self.subframe if m is self.dwell else v) for m,v in step.items()}
+        return (yield from super().__call__(detectors, step, pos_cache))
+
+    def max_frames(self):
+        return int(numpy.ceil(self.maxdwell / self.subframe))
+
+    def _describe(self, detectors):
+        self.accumulator.describe_from(list(detectors) + [self.dwell], extra=('frames', 'uncertainty'))
+        self.dwell_keys = list(self.dwell.describe().keys())
+
+    def uncertainty(self, frames):
+        '''Relative uncertainty of mu from the sub-frames measured so far.'''
+        if len(frames) < 2:
+            return numpy.inf
+        try:
+            mu = numpy.array([self.mu({'data': {**f, 'dcm_energy': 0}})[1] for f in frames], dtype=float)  # energy not needed
+        except Exception as e:
+            if not self.warned:
+                print(warning_msg('cannot compute mu from the sub-frames (%s), counting for the minimum time' % e))
+                self.warned = True
+            return 0
+        mean = mu.mean()
+        if mean == 0 or not numpy.isfinite(mean):
+            return numpy.inf
+        relative = mu.std(ddof=1) / numpy.sqrt(len(mu)) / abs(mean)
+        counts = sum(f.get(k, 0) for f in frames for k in self.counted)
+        if counts > 0:
+            relative = max(relative, 1/numpy.sqrt(counts))
+        return relative
+
+    def accumulate(self, frames):
+        '''The per-frame mean of each detector value.'''
+        values = dict()
+        for k in frames[0].keys():
+            these = [f[k] for f in frames if isinstance(f.get(k), numbers.Number)]
+            if len(these) == 0:
+                continue
+            values[k] = numpy.mean(these)
+        return values
+
+    def integrate(self, detectors, devices):
+        '''Trigger and read the detectors one sub-frame at a time until
+        the target uncertainty or the time limit is reached.'''
+        if len(self.accumulator.describe()) == 0:
+            self._describe(separate_devices(detectors))
+        readers = separate_devices(detectors)
+        frames, uncertainty = [], numpy.inf
+        while True:
+            group = short_uid('trigger')
+            for obj in devices:
+                if hasattr(obj, 'trigger'):
+                    yield from trigger(obj, group=group)
+            yield from wait(group=group)
+            reading = dict()
+            for obj in readers:
+                r = yield from read(obj)
+                if r:
+                    reading.update({k: v['value'] for k,v in r.items()})
+            frames.append(reading)
+            uncertainty = self.uncertainty(frames)
+            if len(frames) >= self.minframes and (uncertainty <= self.precision or len(frames) >= self.max_frames()):
+                break
+        values = self.accumulate(frames)
+        dwell = len(frames) * self.subframe
+        for k in self.dwell_keys:
+            values[k] = dwell
+        values['frames']      = len(frames)
+        values['uncertainty'] = uncertainty
+        self.accumulator.load(values)
+        self.achieved.append(dwell)
+        self.frames.append(len(frames))
+
+    def readout(self, detectors, devices):
+        '''The event holds the positioners (except the dwell time) and
+        the accumulated detector values.'''
+        readers = separate_devices(detectors)
+        yield from create('primary')
+        for obj in devices:
+            if obj is self.dwell or obj in readers:
+                continue
+            yield from read(obj)
+        yield from read(self.accumulator)
+
+    def dwell_of(self, step):
+        return self.achieved[-1]
+
+    def summary(self):
+        result = super().summary()
+        result['achieved'] = float(numpy.mean(self.achieved)) if len(self.achieved) else 0.0
+        result['frames']   = float(numpy.mean(self.frames))   if len(self.frames)   else 0.0
+        result['limited']  = sum(1 for f in self.frames if f >= self.max_frames())
+        return result
+
+    def report(self):
+        text = super().report()
+        s = self.summary()
+        more = '  count-until-statistics: %.2f s/point achieved, %.1f sub-frames/point, %d points stopped at the %.1f s limit' % \
+            (s['achieved'], s['frames'], s['limited'], self.maxdwell)
+        print(whisper(more))
+        return text + '\n' + more
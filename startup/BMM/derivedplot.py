@@ -71,7 +71,7 @@ def close_all_plots():
 initialize_qt_teleporter()
 #class DerivedPlot(CallbackBase):
 class DerivedPlot(QtAwareCallback):
-    def __init__(self, func, ax=None, xlabel=None, ylabel=None, title=None, legend_keys=None, stream_name='primary', **kwargs):
+    def __init__(self, func, ax=None, xlabel=None, ylabel=None, title=None, legend_keys=None, stream_name='primary', sort=False, **kwargs):
         """
         func expects an Event document which looks like this:
         {'time': <UNIX epoch>,
@@ -81,6 +81,9 @@ class DerivedPlot(QtAwareCallback):
          'filled': {}  # only important if you have big array data
         }
         and should return (x, y)
+
+        sort=True draws the line in order of x rather than in order of
+        arrival, for a scan which does not measure in position order
         """
         super().__init__()
         self.__setup_lock = threading.Lock()
@@ -122,6 +125,7 @@ class DerivedPlot(QtAwareCallback):
             self.legend = None
             self.legend_title = " :: ".join([name for name in self.legend_keys])
             self.stream_name = stream_name
+            self.sort = sort
             self.descriptors = {}
         self.__setup = setup
 
@@ -150,7 +154,11 @@ class DerivedPlot(QtAwareCallback):
         x, y = self.func(doc)
         self.y_data.append(y)
         self.x_data.append(x)
-        self.current_line.set_data(self.x_data, self.y_data)
+        if self.sort:
+            order = np.argsort(self.x_data)
+            self.current_line.set_data(np.array(self.x_data)[order], np.array(self.y_data)[order])
+        else:
+            self.current_line.set_data(self.x_data, self.y_data)
         # Rescale and redraw.
         self.ax.relim(visible_only=True)
         self.ax.autoscale_view(tight=True)
@@ -6,12 +6,14 @@ from bluesky.plan_stubs import null, abs_set, sleep, mv, mvr
 
 from BMM.logging       import BMM_log_info, BMM_msg_hook, report
 from BMM.periodictable import edge_energy, Z_number, element_symbol
-from BMM.functions     import boxedtext, countdown
+from BMM.functions     import boxedtext
 from BMM.suspenders    import BMM_clear_to_start
-from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
+from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, whisper
 from BMM.wheel         import show_reference_wheel
 from BMM.modes         import change_mode, get_mode, pds_motors_ready
+from BMM.preflight     import preflight, dryrun
 from BMM.linescans     import rocking_curve, slit_height
+from BMM.pitchtable    import pitch_table, VERIFY
 from BMM.derivedplot   import close_all_plots, close_last_plot, interpret_click
 
 from IPython import get_ipython
@@ -35,7 +37,7 @@ def show_edges():
     text = show_reference_wheel() + '\n' + rois.show() + '\n' + xs.show_rois()
     boxedtext('Foils and ROIs configuration', text[:-1], 'brown', width=85)
     
-def change_edge(el, focus=False, edge='K', energy=None, slits=True, target=300., xrd=False, bender=True):
+def change_edge(el, focus=False, edge='K', energy=None, slits=True, target=300., xrd=False, bender=True, verify=True):
     '''Change edge energy by:
        1. Moving the DCM above the edge energy
        2. Moving the photon delivery system to the correct mode
@@ -51,6 +53,12 @@ def change_edge(el, focus=False, edge='K', energy=None, slits=True, target=300.,
        slits:  (Boolean) perform slit_height() scan            [False]
        target: (float) energy where rocking curve is measured  [300]
        xrd:    (Boolean) force photon delivery system to XRD   [False]
+       verify: (Boolean) short scans when the pitch table is fresh [True]
+
+    The DCM pitch (and the slit height) are first moved to the
+    optimum predicted by the pitch table.  When the table is fresh,
+    only a short verification scan is made around that position, or
+    none if verify is False.  See pitchtable.py.
 
     Examples:
 
@@ -84,11 +92,9 @@ def change_edge(el, focus=False, edge='K', energy=None, slits=True, target=300.,
     # this is a tool for verifying a macro.  this replaces an xafsmod scan  #
     # with a sleep, allowing the user to easily map out motor motions in #
     # a macro                                                            #
-    if BMMuser.macro_dryrun:
-        print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than changing to the %s edge.\n' %
-                       (BMMuser.macro_sleep, el)))
-        countdown(BMMuser.macro_sleep)
-        return(yield from null())
+    if BMMuser.macro_dryrun or preflight.active:
+        return(yield from dryrun('change_edge', 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than changing to the %s edge.' %
+                                 (BMMuser.macro_sleep, el), el=el, edge=edge, focus=focus, energy=energy, slits=slits, target=target, xrd=xrd, verify=verify))
     ######################################################################
 
     if pds_motors_ready() is False:
@@ -186,20 +192,43 @@ def change_edge(el, focus=False, edge='K', energy=None, slits=True, target=300.,
     # run a rocking curve scan #
     ############################
     print('Optimizing rocking curve...')
+    (pitch, fresh) = pitch_table.predict('pitch', energy+target, fallback=approximate_pitch)
     yield from abs_set(dcm_pitch.kill_cmd, 1, wait=True)
-    yield from mv(dcm_pitch, approximate_pitch(energy+target))
+    yield from mv(dcm_pitch, pitch)
     yield from sleep(1)
     yield from abs_set(dcm_pitch.kill_cmd, 1, wait=True)
-    yield from rocking_curve()
-    close_last_plot()
+    if fresh and not verify:
+        print(whisper('  the pitch table is fresh, skipping the rocking curve'))
+    elif fresh:
+        print(whisper('  the pitch table is fresh, verifying with a short rocking curve'))
+        yield from rocking_curve(*VERIFY['pitch'])
+        close_last_plot()
+        if pitch_table.boundary:
+            yield from rocking_curve()
+            close_last_plot()
+    else:
+        yield from rocking_curve()
+        close_last_plot()
     
     ##########################
     # run a slits height scan #
     ##########################
     if slits:
         print('Optimizing slits height...')
-        yield from slit_height(move=True)
-        close_last_plot()
+        (height, fresh) = pitch_table.predict('slit', energy+target)
+        if fresh:
+            yield from mv(dm3_bct, height)
+        if fresh and not verify:
+            print(whisper('  the pitch table is fresh, skipping the slit height scan'))
+        elif fresh:
+            yield from slit_height(*VERIFY['slit'], move=True)
+            close_last_plot()
+            if pitch_table.boundary:
+                yield from slit_height(move=True)
+                close_last_plot()
+        else:
+            yield from slit_height(move=True)
+            close_last_plot()
         ## redo rocking curve?
 
     ###################
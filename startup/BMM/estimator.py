@@ -0,0 +1,287 @@
+from databroker import catalog
+from databroker.queries import TimeRange
+
+import numpy, os, re, json, time
+
+from BMM.adaptive      import AdaptiveXANES
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# A scan time estimator trained on past XAFS scans                      #
+#                                                                       #
+# Every successful step scan (plan_name = scan_nd) in the catalog is    #
+# reduced to a handful of numbers: the number of points, the summed     #
+# dwell time, the measurement mode, the mono crystal, its duration      #
+# (stop time - start time), and the time from its end to the start of   #
+# the next scan in the same sequence.  For each mode and crystal,       #
+#                                                                       #
+#     duration = a * npoints + b * dwell + c                            #
+#                                                                       #
+# is fit by least squares, and the gaps between scans (rewinds,         #
+# metadata, snapshots, post-scan queueing) are summarized separately    #
+# for sequences measured one way and both ways.  The reduced runs and   #
+# the fits are kept in a JSON file and only newer runs are fetched when #
+# the model is refreshed.                                               #
+#                                                                       #
+#    estimator.refresh()          # fetch new runs and refit            #
+#    estimator.predict(npoints, dwell, mode='fluorescence', nscans=6)   #
+#    estimator.estimate(grid, p)  # for a ScanGrid and INI parameters   #
+#                                                                       #
+# When a group has too few runs, the whole history is used.  With too   #
+# little history, the estimate falls back to ScanGrid.approximate_time. #
+#########################################################################
+
+MODEL_FILE = '/home/xf06bm/Data/.howlong_model.json'
+MIN_RUNS   = 10              # fewest runs for a fit of a mode/crystal group
+HISTORY    = 365             # days of history fetched on the first refresh
+STALE      = 86400           # seconds after which howlong refreshes the model
+MAX_GAP    = 1800            # longer than this between scans is not part of a sequence
+Z95        = 1.96
+
+
+def mode_class(mode):
+    '''Reduce a measurement mode to the detector configuration which
+    sets the per-point overhead.'''
+    if isinstance(mode, (list, tuple)):
+        mode = mode[0] if len(mode) > 0 else ''
+    mode = str(mode).lower()
+    if 'xs' in mode:
+        return 'xs'
+    if mode in ('fluorescence', 'flourescence', 'both', 'fluo', 'flou'):
+        return 'fluorescence'
+    return 'transmission'
+
+
+def _crystal(start):
+    try:
+        name = start['XDI']['Mono']['name']
+    except (KeyError, TypeError):
+        return '111'
+    return '311' if '311' in name else '111'
+
+
+def _dwell_from_plan_args(start):
+    '''Sum the dwell times from the repr of the scan_nd cycler.  Of the
+    numerical lists with one value per point, the dwell times are the
+    ones which are not energies.'''
+    try:
+        text, npoints = start['plan_args']['cycler'], start['num_points']
+    except (KeyError, TypeError):
+        return None
+    for found in re.findall(r'\[([-+0-9.eE, ]+)\]', text):
+        values = [float(x) for x in found.split(',') if x.strip()]
+        if len(values) == npoints and max(values) < 1000:
+            return sum(values)
+    return None
+
+
+def _sequence(start):
+    '''The name of the sequence a scan belongs to: its file name less the
+    extension with the scan number.'''
+    try:
+        return os.path.splitext(os.path.basename(start['XDI']['_filename']))[0]
+    except (KeyError, TypeError):
+        return None
+
+
+class HowlongEstimator():
+    '''See the comment above.
+
+    attributes:
+      filename:  the JSON file holding the reduced runs and the fits
+      runs:      uid -> reduced run
+      fits:      group -> least-squares coefficients and residual
+      gaps:      'oneway' or 'bothways' -> mean and deviation of the time between scans
+      refreshed: epoch seconds of the most recent refresh
+    '''
+    def __init__(self, filename=MODEL_FILE):
+        self.filename  = filename
+        self.runs      = dict()
+        self.fits      = dict()
+        self.gaps      = dict()
+        self.refreshed = 0
+        self.load()
+
+    def __repr__(self):
+        return '<HowlongEstimator: %d runs, %d fits>' % (len(self.runs), len(self.fits))
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(warning_msg('could not read scan time model %s: %s' % (self.filename, e)))
+            return
+        self.runs      = data.get('runs', dict())
+        self.fits      = data.get('fits', dict())
+        self.gaps      = data.get('gaps', dict())
+        self.refreshed = data.get('refreshed', 0)
+
+    def save(self):
+        data = {'runs': self.runs, 'fits': self.fits, 'gaps': self.gaps, 'refreshed': self.refreshed}
+        try:
+            with open(self.filename + '.part', 'w') as f:
+                json.dump(data, f)
+            os.replace(self.filename + '.part', self.filename)
+        except Exception as e:
+            print(warning_msg('could not write scan time model %s: %s' % (self.filename, e)))
+
+    def latest(self):
+        if len(self.runs) == 0:
+            return None
+        return max(r['start'] for r in self.runs.values())
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## gathering history
+    def reduce(self, run):
+        '''Reduce a catalog entry to the numbers used by the fit.  Return
+        None for a run which is not useful.'''
+        start, stop = run.metadata['start'], run.metadata['stop']
+        if stop is None or stop.get('exit_status') != 'success':
+            return None
+        npoints = stop.get('num_events', {}).get('primary', 0)
+        if npoints < 2 or npoints != start.get('num_points', npoints):
+            return None
+        dwell = start.get('XDI', {}).get('_dwell_total') or _dwell_from_plan_args(start)
+        if dwell is None:
+            try:
+                dwell = float(run.primary.read()['dwti_dwell_time'].sum())
+            except Exception:
+                return None
+        try:
+            direction = start['XDI']['Mono']['direction']
+        except (KeyError, TypeError):
+            direction = 'forward'
+        return {'start':     start['time'],
+                'duration':  stop['time'] - start['time'],
+                'npoints':   npoints,
+                'dwell':     float(dwell),
+                'mode':      mode_class(start.get('XDI', {}).get('_mode', 'transmission')),
+                'crystal':   _crystal(start),
+                'sequence':  _sequence(start),
+                'direction': direction,}
+
+    def refresh(self, since=None):
+        '''Fetch the step scans measured since the most recent one in the
+        model (or since the given date), then refit.'''
+        if since is None:
+            since = self.latest()
+            if since is None:
+                since = time.time() - HISTORY*86400
+            else:
+                since += 1
+        t0 = time.time()
+        results = catalog['bmm'].search({'plan_name': 'scan_nd'}).search(TimeRange(since=since, timezone="US/Eastern"))
+        added = 0
+        for uid in results:
+            if uid in self.runs:
+                continue
+            try:
+                row = self.reduce(results[uid])
+            except Exception:
+                row = None
+            if row is not None:
+                self.runs[uid] = row
+                added += 1
+        self.refreshed = time.time()
+        self.fit()
+        self.save()
+        print(whisper('scan time model: added %d runs in %.1f seconds, %d runs in all' % (added, time.time()-t0, len(self.runs))))
+        return added
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## fitting
+    def _fit_group(self, rows):
+        if len(rows) < MIN_RUNS:
+            return None
+        X = numpy.array([[r['npoints'], r['dwell'], 1.0] for r in rows])
+        y = numpy.array([r['duration'] for r in rows])
+        keep = numpy.ones(len(y), dtype=bool)
+        for i in range(2):      # a second pass without the paused and interrupted scans
+            coef = numpy.linalg.lstsq(X[keep], y[keep], rcond=None)[0]
+            residual = y - X.dot(coef)
+            sigma = numpy.sqrt((residual[keep]**2).sum() / max(keep.sum()-3, 1))
+            keep = numpy.abs(residual) < 3*sigma + 1
+            if keep.sum() < MIN_RUNS:
+                break
+        return {'per_point': float(coef[0]), 'per_dwell': float(coef[1]), 'constant': float(coef[2]),
+                'sigma': float(sigma), 'runs': int(keep.sum())}
+
+    def fit(self):
+        rows = sorted(self.runs.values(), key=lambda r: r['start'])
+        self.fits = dict()
+        groups = dict()
+        for r in rows:
+            groups.setdefault('%s/%s' % (r['mode'], r['crystal']), []).append(r)
+        for g, these in groups.items():
+            f = self._fit_group(these)
+            if f is not None:
+                self.fits[g] = f
+        f = self._fit_group(rows)
+        if f is not None:
+            self.fits['all'] = f
+
+        ## time from the end of one scan to the start of the next in a sequence
+        gaps = {'oneway': [], 'bothways': []}
+        for this, following in zip(rows[:-1], rows[1:]):
+            if this['sequence'] is None or this['sequence'] != following['sequence']:
+                continue
+            gap = following['start'] - (this['start'] + this['duration'])
+            if gap < 0 or gap > MAX_GAP:
+                continue
+            gaps['bothways' if this['direction'] != following['direction'] else 'oneway'].append(gap)
+        self.gaps = dict()
+        for k, v in gaps.items():
+            if len(v) >= MIN_RUNS:
+                self.gaps[k] = {'mean': float(numpy.median(v)), 'sigma': float(numpy.std(v)), 'runs': len(v)}
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## prediction
+    def predict(self, npoints, dwell, mode='transmission', crystal='111', nscans=1, bothways=False):
+        '''Predict the time of a sequence of nscans scans of npoints points
+        and summed dwell time, in seconds.  Return a dict with the time of
+        one scan, the time of the sequence, the half width of its 95%
+        interval, and the number of runs the fit is based on, or None if
+        there is not enough history.'''
+        group = '%s/%s' % (mode_class(mode), crystal)
+        if group not in self.fits:
+            group = 'all'
+        if group not in self.fits:
+            return None
+        f = self.fits[group]
+        scan = f['per_point']*npoints + f['per_dwell']*dwell + f['constant']
+        gap = self.gaps.get('bothways' if bothways else 'oneway', {'mean': 0, 'sigma': 0})
+        nscans = max(int(nscans), 1)
+        total = nscans*scan + (nscans-1)*gap['mean']
+        halfwidth = Z95 * numpy.sqrt(nscans*f['sigma']**2 + (nscans-1)*gap['sigma']**2)
+        return {'scan': scan, 'total': total, 'halfwidth': float(halfwidth), 'runs': f['runs'], 'group': group}
+
+    def estimate(self, grid, p):
+        '''Estimate the time of the scan sequence described by a ScanGrid
+        and a dict of INI parameters.  Times are in minutes.  halfwidth is
+        None when the estimate is ScanGrid.approximate_time.'''
+        crystal = user_ns['dcm']._crystal
+        nscans = int(p.get('nscans', 1) or 1)
+        npoints, dwell = grid.npoints, grid.dwell.sum()
+        if p.get('adaptive', False):
+            npoints, dwell = AdaptiveXANES(grid.energy, grid.dwell, budget=p.get('budget', 0.5)).size()
+        elif p.get('precision', 0) > 0:
+            dwell = npoints * p.get('maxdwell', 10)      # counting to a precision: an upper limit
+        if p.get('scantype', 'step') == 'step':
+            e = self.predict(npoints, dwell, mode=p.get('mode', 'transmission'),
+                             crystal=crystal, nscans=nscans, bothways=p.get('bothways', False))
+            if e is not None:
+                return {'scan': e['scan']/60, 'total': e['total']/60, 'halfwidth': e['halfwidth']/60, 'runs': e['runs']}
+        return {'scan': grid.approximate_time, 'total': grid.approximate_time*nscans, 'halfwidth': None, 'runs': 0}
+
+    def stale(self):
+        return time.time() - self.refreshed > STALE
+
+
+estimator = HowlongEstimator()
@@ -0,0 +1,488 @@
+from bluesky.plan_stubs import abs_set, sleep, mv, null, wait, trigger_and_read
+from bluesky.preprocessors import run_decorator, finalize_wrapper
+
+import numpy, time
+
+from BMM.functions     import HBARC
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Continuous-motion ("fly" or "slew") scanning                          #
+#                                                                       #
+# A motor is sent on a long move while the detectors are read on a      #
+# fixed time base.  Each reading is given a position by interpolating   #
+# the motor readback history at the reading's timestamp.  The readings #
+# are then averaged into bins centered on the points of a conventional #
+# step scan grid and each bin is emitted as an ordinary event, so that  #
+# everything downstream (DerivedPlot, write_XDI, the dossier, ls2dat,  #
+# as2dat) sees the same event stream as from a step scan.               #
+#########################################################################
+
+
+class BinnedReadings():
+    '''A stand-in detector which hands the RunEngine one bin of
+    fly-scan data at a time.  It looks just enough like an ophyd
+    device to be used with trigger_and_read.
+
+      binned = BinnedReadings(name='fly')
+      binned.describe_from(detectors, extra={'dcm_energy':..., })
+      binned.load({'dcm_energy': 7112.0, 'I0': 1.23, ...})
+      yield from trigger_and_read([binned])
+    '''
+    def __init__(self, name='fly'):
+        self.name    = name
+        self.parent  = None
+        self.hints   = {'fields': []}
+        self._desc   = dict()
+        self._values = dict()
+        self._config_desc = dict()
+        self._config      = dict()
+
+    def describe_from(self, detectors, extra=()):
+        '''Build the data keys from the detectors being flown, plus
+        the positioner-like keys (e.g. dcm_energy, dcm_energy_setpoint)
+        named in extra.  The configuration of the detectors (e.g. the
+        vor channel names) is passed through as this device's
+        configuration.'''
+        self._desc = dict()
+        self._config_desc, self._config = dict(), dict()
+        for k in extra:
+            self._desc[k] = {'dtype': 'number', 'shape': [], 'source': '%s:%s' % (self.name, k)}
+        fields = []
+        for det in detectors:
+            for k,v in det.describe().items():
+                if v['dtype'] != 'number' or len(v['shape']) > 0:
+                    continue
+                self._desc[k] = {'dtype': 'number', 'shape': [], 'source': '%s:%s' % (self.name, v['source'])}
+            if hasattr(det, 'hints') and 'fields' in det.hints:
+                fields.extend(det.hints['fields'])
+            if hasattr(det, 'read_configuration'):
+                self._config_desc.update(det.describe_configuration())
+                self._config.update(det.read_configuration())
+        self.hints = {'fields': fields}
+        return list(self._desc.keys())
+
+    def load(self, values, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._values = dict()
+        for k in self._desc.keys():
+            self._values[k] = {'value': values.get(k, numpy.nan), 'timestamp': timestamp}
+
+    def describe(self):
+        return self._desc
+
+    def read(self):
+        return self._values
+
+    def describe_configuration(self):
+        return self._config_desc
+
+    def read_configuration(self):
+        return self._config
+
+
+class FlyBinner():
+    '''Accumulate a stream of (position, readings) samples into bins.
+
+    centers:  the positions of the step scan grid, in the order they
+              are traversed
+
+    The bin edges are the midpoints between neighboring centers, with
+    the outer edges placed half a step beyond the first and last
+    centers.  Bins are considered complete once the sampled position
+    has moved past their far edge in the direction of travel.  A bin
+    which received no samples inherits the most recent sample, which
+    only happens when the sampling rate is too slow for the motor
+    velocity.
+    '''
+    def __init__(self, centers, keys):
+        self.centers   = numpy.asarray(centers, dtype=float)
+        self.keys      = list(keys)
+        self.direction = 1 if self.centers[-1] >= self.centers[0] else -1
+        mid            = (self.centers[1:] + self.centers[:-1]) / 2
+        first          = self.centers[0]  - (mid[0]  - self.centers[0])  if len(mid) else self.centers[0]
+        last           = self.centers[-1] + (self.centers[-1] - mid[-1]) if len(mid) else self.centers[-1]
+        self.edges     = numpy.concatenate(([first], mid, [last]))
+        self.sums      = numpy.zeros((len(self.centers), len(self.keys)))
+        self.npts      = numpy.zeros(len(self.centers), dtype=int)
+        self.psum      = numpy.zeros(len(self.centers))
+        self.emitted   = 0
+        self.last      = None
+
+    def add(self, positions, values):
+        '''Add samples.  positions is an array of length N, values is
+        an (N, len(keys)) array.'''
+        positions = numpy.asarray(positions, dtype=float)
+        values    = numpy.asarray(values, dtype=float).reshape(len(positions), len(self.keys))
+        if len(positions) == 0:
+            return
+        if self.direction > 0:
+            index = numpy.searchsorted(self.edges, positions, side='right') - 1
+        else:
+            index = len(self.edges) - 1 - numpy.searchsorted(self.edges[::-1], positions, side='right')
+        good = (index >= 0) & (index < len(self.centers))
+        numpy.add.at(self.sums, index[good], values[good])
+        numpy.add.at(self.npts, index[good], 1)
+        numpy.add.at(self.psum, index[good], positions[good])
+        self.last = (positions[-1], values[-1])
+
+    def complete(self, position):
+        '''Return the indeces of bins which are finished given that the
+        motor is now at position, but which have not yet been emitted.'''
+        if self.direction > 0:
+            done = numpy.searchsorted(self.edges[1:], position, side='right')
+        else:
+            done = numpy.searchsorted(-self.edges[1:], -position, side='right')
+        done = min(done, len(self.centers))
+        these = list(range(self.emitted, done))
+        self.emitted = max(self.emitted, done)
+        return these
+
+    def remaining(self):
+        these = list(range(self.emitted, len(self.centers)))
+        self.emitted = len(self.centers)
+        return these
+
+    def bin(self, i):
+        '''Return (mean position, mean values, number of samples) for bin i.'''
+        if self.npts[i] == 0:
+            if self.last is None:
+                return self.centers[i], numpy.full(len(self.keys), numpy.nan), 0
+            return self.last[0], self.last[1], 0
+        return self.psum[i]/self.npts[i], self.sums[i]/self.npts[i], self.npts[i]
+
+
+def sample_detectors(detectors, keys):
+    '''Read the current values of the flown detectors without
+    triggering them.  Return (timestamp, values) where values is
+    ordered like keys.'''
+    reading = dict()
+    for det in detectors:
+        reading.update(det.read())
+    stamps = [reading[k]['timestamp'] for k in keys if k in reading]
+    stamp  = max(stamps) if len(stamps) > 0 else time.time()
+    return stamp, [reading[k]['value'] if k in reading else numpy.nan for k in keys]
+
+
+def fly_segments(positions, times, tolerance=0.25):
+    '''Group a trajectory into segments of nearly constant velocity.
+
+    positions: motor positions of the step scan grid
+    times:     dwell time at each grid point
+
+    Each grid point asks for a velocity of (bin width)/(dwell time).
+    Consecutive points are grouped while their requested velocity is
+    within tolerance of the first point in the group.  Return a list
+    of (end position, velocity) tuples.
+    '''
+    positions = numpy.asarray(positions, dtype=float)
+    times     = numpy.asarray(times, dtype=float)
+    if len(positions) < 2:
+        return [(positions[-1], None)]
+    width = numpy.abs(numpy.gradient(positions))
+    speed = width / numpy.clip(times, 1e-3, None)
+    segments, first = [], 0
+    for i in range(1, len(positions)+1):
+        if i == len(positions) or abs(speed[i] - speed[first]) > tolerance*speed[first]:
+            span = abs(positions[i-1] - positions[first]) + width[first]/2 + width[i-1]/2
+            segments.append((positions[i-1] + numpy.sign(positions[-1]-positions[0])*width[i-1]/2,
+                             span / numpy.sum(times[first:i])))
+            first = i
+    return segments
+
+
+def velocity_limits(motor):
+    '''Return (slowest, fastest) velocity of an EpicsMotor.  These are
+    the control limits of the VELO field, which the motor record sets
+    to VBAS and VMAX.  A limit of 0 means no limit.'''
+    try:
+        (low, high) = motor.velocity.limits
+    except Exception:
+        return (0, 0)
+    return (abs(low), abs(high))
+
+
+def velocity_ok(motor, segments):
+    '''Check the velocities of a fly scan against the motor's limits,
+    complaining if any is outside them.'''
+    (low, high) = velocity_limits(motor)
+    for (end, velocity) in segments:
+        if velocity is None:
+            continue
+        if high > 0 and velocity > high:
+            print(error_msg('%s cannot fly at %.4f/sec, its fastest is %.4f/sec -- use a longer dwell time or a coarser grid' %
+                            (motor.name, velocity, high)))
+            return False
+        if velocity < low:
+            print(error_msg('%s cannot fly at %.4f/sec, its slowest is %.4f/sec -- use a shorter dwell time or a finer grid' %
+                            (motor.name, velocity, low)))
+            return False
+    return True
+
+
+def fly_and_bin(motor, segments, detectors, binner, binned, keys, to_coordinate, period, extra):
+    '''Plan: move motor through each segment at that segment's
+    velocity, reading detectors every period seconds, and emit each
+    bin as an event as soon as it is complete.
+
+      to_coordinate: function which converts motor position (as an
+                     array) into the binning coordinate
+      extra:         function of (bin index, mean coordinate, nsamples)
+                     returning the dict of positioner-like values for
+                     that bin
+    '''
+    def emit(these):
+        for i in these:
+            position, values, n = binner.bin(i)
+            row = dict(zip(keys, values))
+            row.update(extra(i, position, n))
+            binned.load(row)
+            yield from trigger_and_read([binned])
+
+    history_t, history_x = [], []
+    original_velocity = motor.velocity.get()
+    try:
+        for (end, velocity) in segments:
+            if velocity is not None:
+                yield from abs_set(motor.velocity, velocity, wait=True)
+            status = yield from abs_set(motor, end, group='fly')
+            while True:
+                readback = motor.user_readback.read()[motor.user_readback.name]
+                history_t.append(readback['timestamp'])
+                history_x.append(readback['value'])
+                stamp, values = sample_detectors(detectors, keys)
+                where = numpy.interp(stamp, history_t, history_x)
+                coordinate = to_coordinate(numpy.array([where]))
+                binner.add(coordinate, [values])
+                yield from emit(binner.complete(coordinate[0]))
+                if status is None or status.done:
+                    break
+                yield from sleep(period)
+        yield from wait(group='fly')
+        yield from emit(binner.remaining())
+        yield from abs_set(motor.velocity, original_velocity, wait=True)
+    finally:
+        motor.velocity.put(original_velocity)
+
+
+def fly_energy_scan(detectors, energy_grid, time_grid, period=0.1, md=None):
+    '''
+    Slew dcm_bragg continuously across an energy grid, reading the
+    detectors on a fixed time base, then bin the readings onto the
+    energy grid.
+
+      detectors:   list of detectors, e.g. [quadem1] or [quadem1, vor]
+      energy_grid: energy values of the step scan (from conventional_grid)
+      time_grid:   dwell times of the step scan
+      period:      sampling period in seconds
+      md:          metadata dictionary
+
+    The velocity of Bragg is chosen so that the time spent crossing
+    each bin approximates the requested dwell time.  Regions with
+    different dwell/step ratios are flown as separate segments.
+
+    Each bin is emitted as an event with dcm_energy (the mean measured
+    energy of the bin), dcm_energy_setpoint (the grid energy),
+    dwti_dwell_time (the time spent in the bin), and
+    dwti_dwell_time_setpoint (the requested dwell), plus the averaged
+    detector values under their usual names.  Thus the event stream
+    is column-for-column the same as the stream from scan_nd.
+
+    The monochromator should already be in pseudo-channel-cut mode and
+    parked just ahead of the first grid point.
+    '''
+    dcm, dcm_bragg, _locked_dwell_time = user_ns['dcm'], user_ns['dcm_bragg'], user_ns['_locked_dwell_time']
+
+    energy_grid = numpy.asarray(energy_grid, dtype=float)
+    time_grid   = numpy.asarray(time_grid,   dtype=float)
+    period      = min(period, numpy.min(time_grid)/2)
+    angles      = dcm.e2a(energy_grid)
+    segments    = fly_segments(angles, time_grid)
+    to_energy   = lambda angle: 2*numpy.pi*HBARC/(dcm._twod*numpy.sin(numpy.radians(angle)))
+
+    binned = BinnedReadings(name='fly')
+    extra  = ('dcm_energy', 'dcm_energy_setpoint', 'dwti_dwell_time', 'dwti_dwell_time_setpoint')
+    keys   = [k for k in binned.describe_from(detectors, extra=extra) if k not in extra]
+    binner = FlyBinner(energy_grid, keys)
+    if not velocity_ok(dcm_bragg, segments):
+        yield from null()
+        return
+
+    def extra_values(i, energy, n):
+        return {'dcm_energy'               : energy,
+                'dcm_energy_setpoint'      : energy_grid[i],
+                'dwti_dwell_time'          : n*period,
+                'dwti_dwell_time_setpoint' : time_grid[i]}
+
+    _md = {'detectors'  : [det.name for det in detectors],
+           'motors'     : [dcm.energy.name],
+           'num_points' : len(energy_grid),
+           'num_intervals' : len(energy_grid) - 1,
+           'plan_args'  : {'detectors': list(map(repr, detectors)),
+                           'energy_grid': list(energy_grid), 'period': period},
+           'plan_name'  : 'fly_energy_scan',
+           'hints'      : {'dimensions': [([dcm.energy.name], 'primary')]},
+           }
+    _md.update(md or {})
+
+    ## detectors free-running, quadem averaging time (and Struck count
+    ## time) set to the sampling period
+    for det in detectors:
+        if hasattr(det, 'on_plan'):
+            yield from det.on_plan()
+    yield from abs_set(_locked_dwell_time, period, wait=True)
+    print(whisper('  flying Bragg in %d segment(s), sampling every %.3f sec' % (len(segments), period)))
+
+    @run_decorator(md=_md)
+    def fly():
+        yield from fly_and_bin(dcm_bragg, segments, detectors, binner, binned, keys,
+                               to_energy, period, extra_values)
+    return (yield from fly())
+
+
+def fly_linescan(detectors, motor, start, stop, nsteps, inttime=0.1, md=None):
+    '''
+    Fly a sample stage across a relative range at constant velocity,
+    reading the detectors on a fixed time base, then bin the readings
+    onto the grid of the equivalent step scan.
+
+      detectors: list of detectors, e.g. [quadem1] or [quadem1, vor]
+      motor:     the stage, an EpicsMotor
+      start:     starting value, relative to the current position
+      stop:      ending value, relative to the current position
+      nsteps:    number of points of the equivalent step scan
+      inttime:   time spent crossing each bin, in seconds
+      md:        metadata dictionary
+
+    The motor runs up from the outer edge of the first bin and the
+    velocity is the bin width divided by inttime.  The detectors are
+    sampled twice per bin.  Each bin is emitted as an event with the
+    motor's name (the mean measured position of the bin) and
+    <motor>_user_setpoint (the grid position), plus the averaged
+    detector values under their usual names, so DerivedPlot, pluck,
+    and ls2dat see the same columns as from rel_scan.
+
+    The motor is returned to its starting position at the end.
+    '''
+    _locked_dwell_time = user_ns['_locked_dwell_time']
+
+    origin  = motor.position
+    centers = origin + numpy.linspace(start, stop, nsteps)
+    period  = inttime / 2
+    segments = fly_segments(centers, numpy.full(nsteps, inttime))
+
+    binned = BinnedReadings(name='fly')
+    extra  = (motor.name, motor.name+'_user_setpoint')
+    keys   = [k for k in binned.describe_from(detectors, extra=extra) if k not in extra]
+    binner = FlyBinner(centers, keys)
+    if not velocity_ok(motor, segments):
+        yield from null()
+        return
+
+    def extra_values(i, position, n):
+        return {motor.name                  : position,
+                motor.name+'_user_setpoint' : centers[i]}
+
+    _md = {'detectors'  : [det.name for det in detectors],
+           'motors'     : [motor.name],
+           'num_points' : nsteps,
+           'num_intervals' : nsteps - 1,
+           'plan_args'  : {'detectors': list(map(repr, detectors)), 'motor': repr(motor),
+                           'start': start, 'stop': stop, 'nsteps': nsteps, 'inttime': inttime},
+           'plan_name'  : 'fly_linescan',
+           'hints'      : {'dimensions': [([motor.name], 'primary')]},
+           }
+    _md.update(md or {})
+
+    ## run up from the outer edge of the first bin
+    yield from mv(motor, binner.edges[0])
+    for det in detectors:
+        if hasattr(det, 'on_plan'):
+            yield from det.on_plan()
+    yield from abs_set(_locked_dwell_time, period, wait=True)
+    print(whisper('  flying %s at %.4f/sec, sampling every %.3f sec' % (motor.name, segments[0][1], period)))
+
+    @run_decorator(md=_md)
+    def fly():
+        yield from fly_and_bin(motor, segments, detectors, binner, binned, keys,
+                               lambda x: x, period, extra_values)
+    return (yield from finalize_wrapper(fly(), mv(motor, origin)))
+
+
+def fly_raster(detectors, slow, slow_positions, fast, fast_positions, dwell=0.1, snake=True, md=None):
+    '''
+    An area scan which steps the slow motor and flies the fast motor
+    across each row, binning each row onto the fast axis grid as in
+    fly_linescan.
+
+      detectors:      list of detectors, e.g. [quadem1] or [quadem1, vor]
+      slow:           the slow motor
+      slow_positions: absolute positions of the rows
+      fast:           the fast motor, an EpicsMotor
+      fast_positions: absolute positions of the fast axis grid
+      dwell:          time spent crossing each pixel, in seconds
+      snake:          True to fly alternate rows in opposite directions
+      md:             metadata dictionary
+
+    This is one run with nslow*nfast events in the order grid_scan
+    would make them, including the 'snaking' metadata, so LiveGrid and
+    as2dat work as for grid_scan.  Each event has both motor names (the
+    measured positions) and <motor>_user_setpoint (the grid positions).
+    '''
+    _locked_dwell_time = user_ns['_locked_dwell_time']
+
+    slow_positions = numpy.asarray(slow_positions, dtype=float)
+    fast_positions = numpy.asarray(fast_positions, dtype=float)
+    nslow, nfast   = len(slow_positions), len(fast_positions)
+    period         = dwell / 2
+
+    binned = BinnedReadings(name='fly')
+    extra  = (slow.name, slow.name+'_user_setpoint', fast.name, fast.name+'_user_setpoint')
+    keys   = [k for k in binned.describe_from(detectors, extra=extra) if k not in extra]
+    if not velocity_ok(fast, fly_segments(fast_positions, numpy.full(nfast, dwell))):
+        yield from null()
+        return
+    normal = fast.velocity.get()
+
+    _md = {'detectors'  : [det.name for det in detectors],
+           'motors'     : [slow.name, fast.name],
+           'num_points' : nslow*nfast,
+           'num_intervals' : nslow*nfast - 1,
+           'shape'      : (nslow, nfast),
+           'extents'    : ([slow_positions[0], slow_positions[-1]], [fast_positions[0], fast_positions[-1]]),
+           'snaking'    : (False, snake),
+           'plan_args'  : {'detectors': list(map(repr, detectors)), 'slow': repr(slow), 'fast': repr(fast),
+                           'nslow': nslow, 'nfast': nfast, 'dwell': dwell, 'snake': snake},
+           'plan_name'  : 'fly_raster',
+           'hints'      : {'dimensions': [([slow.name], 'primary'), ([fast.name], 'primary')]},
+           }
+    _md.update(md or {})
+
+    for det in detectors:
+        if hasattr(det, 'on_plan'):
+            yield from det.on_plan()
+    yield from abs_set(_locked_dwell_time, period, wait=True)
+    print(whisper('  flying %s in %d rows of %d pixels, sampling every %.3f sec' % (fast.name, nslow, nfast, period)))
+
+    @run_decorator(md=_md)
+    def fly():
+        for i, y in enumerate(slow_positions):
+            centers = fast_positions[::-1] if snake and i % 2 else fast_positions
+            binner  = FlyBinner(centers, keys)
+            segments = fly_segments(centers, numpy.full(nfast, dwell))
+            def extra_values(j, position, n, y=y, centers=centers):
+                return {slow.name                  : slow.position,
+                        slow.name+'_user_setpoint' : y,
+                        fast.name                  : position,
+                        fast.name+'_user_setpoint' : centers[j]}
+            ## run up to the start of the row at the normal velocity
+            yield from abs_set(fast.velocity, normal, wait=True)
+            yield from mv(slow, y, fast, binner.edges[0])
+            yield from fly_and_bin(fast, segments, detectors, binner, binned, keys,
+                                   lambda x: x, period, extra_values)
+    return (yield from fly())
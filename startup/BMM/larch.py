@@ -16,19 +16,48 @@
 ##                           Ovid, Metamorphosis
 ##                           Book II:531-565
 
-import numpy
+import numpy, hashlib
+from collections import OrderedDict
 from larch import (Group, Parameter, isParameter, param_value, isNamedClass, Interpreter) 
-from larch.xafs import (find_e0, pre_edge, autobk, xftf, xftr)
+from larch.xafs import (find_e0, pre_edge, autobk, xftf, xftr, ftwindow)
 import larch.utils.show as lus
 import matplotlib.pyplot as plt
 
 from BMM.functions import etok, ktoe
+from BMM.runcache  import runcache
 
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
 
 LARCH = Interpreter()
 
+## Each processing stage (e0, pre, bkg, fft, bft) remembers the attributes
+## it set on the Larch group, keyed on a hash of its inputs: the arrays
+## and parameters it uses and the key of the stage upstream of it.  A
+## stage whose key has been seen is restored rather than recomputed, so
+## changing, say, self.fft reruns only the Fourier transforms.
+STAGES     = ('e0', 'pre', 'bkg', 'fft', 'bft')
+CACHE_SIZE = 32                 # most cached stage results per data set
+
+## Larch's Fourier transform conventions, used by the batch transforms
+KSTEP      = 0.05
+NFFT       = 2048
+RMAX_OUT   = 10
+QMAX_OUT   = 30
+
+def _key(*parts):
+    '''A hash of arrays, dicts, and other values.'''
+    h = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, numpy.ndarray):
+            h.update(str((p.dtype, p.shape)).encode())
+            h.update(numpy.ascontiguousarray(p).tobytes())
+        elif isinstance(p, dict):
+            h.update(repr(sorted(p.items())).encode())
+        else:
+            h.update(repr(p).encode())
+    return h.hexdigest()
+
 
 class Pandrosus():
     '''A thin wrapper around basic XAS data processing for individual
@@ -46,6 +75,8 @@ class Pandrosus():
       fft:   Dictionary of forward Fourier transform arguments
       bft:   Dictionary of backward Fourier transform arguments
       rmax:  upper bound of R-space plot
+      hits, misses: per stage, the number of times processing was
+             restored from the cache or recomputed
 
     See http://xraypy.github.io/xraylarch/xafs/preedge.html and
     http://xraypy.github.io/xraylarch/xafs/autobk.html for details
@@ -58,6 +89,7 @@ class Pandrosus():
       prep:       normalize, background subtract, and forward transform the data
       do_xftf:    perform the forward (k->R) transform
       do_xftr:    perform the reverse (R->q) transform
+      cache_info: report the processing cache hits and misses
 
     Plotting methods:
       plot_xmu:     plot data in energy (alias = pe)
@@ -84,6 +116,36 @@ class Pandrosus():
         self.rmax   = 6
 
         ## flow control parameters
+        self.clear_cache()
+
+    def clear_cache(self):
+        self.cache  = OrderedDict()
+        self.keys   = dict()
+        self.hits   = {s: 0 for s in STAGES}
+        self.misses = {s: 0 for s in STAGES}
+
+    def _stage(self, stage, key, compute):
+        '''Restore the attributes a stage sets on the group if its key has
+        been seen, otherwise compute and remember them.'''
+        self.keys[stage] = key
+        if key in self.cache:
+            self.hits[stage] += 1
+            self.cache.move_to_end(key)
+            for k,v in self.cache[key].items():
+                setattr(self.group, k, v)
+            return
+        self.misses[stage] += 1
+        before = dict(vars(self.group))
+        compute()
+        self.cache[key] = {k: v for k,v in vars(self.group).items() if k not in before or before[k] is not v}
+        while len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def cache_info(self, quiet=False):
+        '''Print and return the cache hits and misses for each stage.'''
+        if not quiet:
+            print('%s: %s' % (self.name, ',  '.join('%s %d/%d' % (s, self.hits[s], self.hits[s]+self.misses[s]) for s in STAGES)))
+        return {'hits': dict(self.hits), 'misses': dict(self.misses)}
         
     def make_xmu(self, uid, mode):
         '''Load energy and mu(E) arrays into Larch and into this wrapper object.
@@ -101,12 +163,12 @@ class Pandrosus():
           mode:  'transmission', 'fluorescence', or 'reference'
 
         '''
-        db = user_ns['db']
-        header = db[uid]
-        table  = header.table()
+        if mode == 'flourescence': mode = 'fluorescence'
+        columns = {'reference'    : ['dcm_energy', 'I0', 'It', 'Ir'],
+                   'fluorescence' : ['dcm_energy', 'I0', 'dtc1', 'dtc2', 'dtc3', 'dtc4'],}
+        table  = runcache.table(uid, columns=columns.get(mode, ['dcm_energy', 'I0', 'It']))
         self.group.energy = numpy.array(table['dcm_energy'])
         self.group.i0 = numpy.array(table['I0'])
-        if mode == 'flourescence': mode = 'fluorescence'
         if mode == 'reference':
             self.group.mu = numpy.array(numpy.log(table['It']/table['Ir']))
             self.group.i0 = numpy.array(table['It'])
@@ -127,50 +189,61 @@ class Pandrosus():
         else:
             self.name = uid[-6:]
         self.group = Group(__name__=self.name)
+        self.clear_cache()
         self.make_xmu(uid, mode=mode)
         self.prep()
         
-    def prep(self):
+    def prep(self, fft=True):
+        '''Find e0, normalize, remove the background, and (unless fft is
+        False, as for a batch transform) do the forward transform.'''
+        g = self.group
         ## the next several lines seem necessary because the version
         ## of Larch currently at BMM is not correctly resolving
         ## pre1=pre2=None or norm1=norm2=None.  The following
         ## approximates Larch's defaults
         if self.pre['e0'] is None:
-            find_e0(self.group.energy, mu=self.group.mu, group=self.group, _larch=LARCH)
-            ezero = self.group.e0
+            self._stage('e0', _key('e0', g.energy, g.mu),
+                        lambda: find_e0(g.energy, mu=g.mu, group=g, _larch=LARCH))
+            ezero = g.e0
         else:
+            self.keys['e0'] = _key('e0', g.energy, g.mu, self.pre['e0'])
             ezero = self.pre['e0']
         if self.pre['norm2'] is None:
-            self.pre['norm2'] = self.group.energy.max() - ezero
+            self.pre['norm2'] = g.energy.max() - ezero
         if self.pre['norm1'] is None:
             self.pre['norm1'] = self.pre['norm2'] / 5
         if self.pre['pre1'] is None:
-            self.pre['pre1'] = self.group.energy.min() - ezero
+            self.pre['pre1'] = g.energy.min() - ezero
         if self.pre['pre2'] is None:
             self.pre['pre2'] = self.pre['pre1'] / 3
-        pre_edge(self.group.energy, mu=self.group.mu, group=self.group,
-                 e0    = ezero,
-                 step  = None,
-                 pre1  = self.pre['pre1'],
-                 pre2  = self.pre['pre2'],
-                 norm1 = self.pre['norm1'],
-                 norm2 = self.pre['norm2'],
-                 nnorm = self.pre['nnorm'],
-                 nvict = self.pre['nvict'],
-                 _larch=LARCH)
-        autobk(self.group.energy, mu=self.group.mu, group=self.group,
-               rbkg    = self.bkg['rbkg'],
-               e0      = self.bkg['e0'],
-               kmin    = self.bkg['kmin'],
-               kmax    = self.bkg['kmax'],
-               kweight = self.bkg['kweight'],
-               _larch=LARCH)
-        xftf(self.group.k, chi=self.group.chi, group=self.group,
-             window = self.fft['window'],
-             kmin   = self.fft['kmin'],
-             kmax   = self.fft['kmax'],
-             dk     = self.fft['dk'],
-             _larch=LARCH)
+        self._stage('pre', _key('pre', self.keys['e0'], ezero, self.pre),
+                    lambda: pre_edge(g.energy, mu=g.mu, group=g,
+                                     e0    = ezero,
+                                     step  = None,
+                                     pre1  = self.pre['pre1'],
+                                     pre2  = self.pre['pre2'],
+                                     norm1 = self.pre['norm1'],
+                                     norm2 = self.pre['norm2'],
+                                     nnorm = self.pre['nnorm'],
+                                     nvict = self.pre['nvict'],
+                                     _larch=LARCH))
+        self._stage('bkg', _key('bkg', self.keys['pre'], self.bkg),
+                    lambda: autobk(g.energy, mu=g.mu, group=g,
+                                   rbkg    = self.bkg['rbkg'],
+                                   e0      = self.bkg['e0'],
+                                   kmin    = self.bkg['kmin'],
+                                   kmax    = self.bkg['kmax'],
+                                   kweight = self.bkg['kweight'],
+                                   _larch=LARCH))
+        if not fft:
+            return
+        self._stage('fft', _key('fft', self.keys['bkg'], self.fft),
+                    lambda: xftf(g.k, chi=g.chi, group=g,
+                                 window = self.fft['window'],
+                                 kmin   = self.fft['kmin'],
+                                 kmax   = self.fft['kmax'],
+                                 dk     = self.fft['dk'],
+                                 _larch=LARCH))
 
     def show(self, which=None):
         if 'pre' in which:
@@ -296,14 +369,23 @@ class Pandrosus():
         legend = plt.legend(loc='best', shadow=True)
     plot_chik = plot_chi
         
+    def fft_key(self, kw=2):
+        return _key('fft', self.keys['bkg'], self.fft, kw, 'with_phase')
+
+    def bft_key(self):
+        return _key('bft', self.keys['fft'], self.bft)
+
     def do_xftf(self, kw=2):
-        xftf(self.group.k, chi=self.group.chi, group=self.group,
-             window  = self.fft['window'],
-             kmin    = self.fft['kmin'],
-             kmax    = self.fft['kmax'],
-             dk      = self.fft['dk'],
-             kweight = kw,
-             with_phase=True, _larch=LARCH)
+        if 'bkg' not in self.keys:
+            self.prep()
+        self._stage('fft', self.fft_key(kw),
+                    lambda: xftf(self.group.k, chi=self.group.chi, group=self.group,
+                                 window  = self.fft['window'],
+                                 kmin    = self.fft['kmin'],
+                                 kmax    = self.fft['kmax'],
+                                 dk      = self.fft['dk'],
+                                 kweight = kw,
+                                 with_phase=True, _larch=LARCH))
     def plot_chir(self, kw=2, win=True, parts='m'):
         '''Make a plot in R-space of a single data set.
 
@@ -369,12 +451,15 @@ class Pandrosus():
         plt.legend(loc='best', shadow=True)
         
     def do_xftr(self):
-        xftr(self.group.r, chir=self.group.chir, group=self.group,
-             window = self.bft['window'],
-             rmin   = self.bft['rmin'],
-             rmax   = self.bft['rmax'],
-             dr     = self.bft['dr'],
-             with_phase=True, _larch=LARCH)
+        if 'fft' not in self.keys:
+            self.do_xftf()
+        self._stage('bft', self.bft_key(),
+                    lambda: xftr(self.group.r, chir=self.group.chir, group=self.group,
+                                 window = self.bft['window'],
+                                 rmin   = self.bft['rmin'],
+                                 rmax   = self.bft['rmax'],
+                                 dr     = self.bft['dr'],
+                                 with_phase=True, _larch=LARCH))
     def plot_chiq(self, kw=2, parts='r', win=True):
         '''Make a plot in back-transformed k-space of a single data set.
 
@@ -491,6 +576,9 @@ class Kekropidai():
       plot_chi:  (alias = pk) overplot all the groups in k-space
       plot_chir: (alias = pr) overplot all the groups in R-space
       plot_chiq: (alias = pq) overplot all the groups in q-space
+      cache_info: report the processing cache hits and misses of all the groups
+      batch_xftf: forward transform all the groups at once
+      batch_xftr: back transform all the groups at once
 
     Example:
 
@@ -515,6 +603,107 @@ class Kekropidai():
                 if 'Pandrosus' in str(type(item)):
                     self.groups.append(item)
 
+    def cache_info(self):
+        '''Print the processing cache hits and misses of each group and in
+        total.  Return the totals.'''
+        hits, misses = {s: 0 for s in STAGES}, {s: 0 for s in STAGES}
+        for g in self.groups:
+            info = g.cache_info()
+            for s in STAGES:
+                hits[s]   += info['hits'][s]
+                misses[s] += info['misses'][s]
+        print('total: %s' % ',  '.join('%s %d/%d' % (s, hits[s], hits[s]+misses[s]) for s in STAGES))
+        return {'hits': hits, 'misses': misses}
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## batch Fourier transforms
+    ## These reproduce Larch's xftf and xftr (kstep, nfft, rmax_out,
+    ## qmax_out, and normalization), but with one NumPy FFT over all
+    ## the groups rather than one Larch call for each.  Each distinct
+    ## window is computed once.  Results are written into each group
+    ## and into its processing cache, so a group whose transform is
+    ## cached is not transformed again.
+    def batch_xftf(self, kw=2):
+        '''Forward transform chi(k) of every group with k-weight kw.'''
+        todo = []
+        for g in self.groups:
+            g.prep(fft=False)
+            key = g.fft_key(kw)
+            if key in g.cache:
+                g._stage('fft', key, None)
+            else:
+                todo.append((g, key))
+        if len(todo) == 0:
+            return
+        kmax = max(max(g.group.k.max(), g.fft['kmax']+g.fft['dk']) for g, key in todo)
+        k_   = KSTEP * numpy.arange(int(1.01 + kmax/KSTEP), dtype='float64')
+        chi  = numpy.zeros((len(todo), len(k_)))
+        win  = numpy.zeros((len(todo), len(k_)))
+        windows = dict()
+        for i, (g, key) in enumerate(todo):
+            npts = int(1.01 + g.group.k.max()/KSTEP)
+            chi[i, :npts] = numpy.interp(k_[:npts], g.group.k, g.group.chi) * k_[:npts]**kw
+            params = (g.fft['window'], g.fft['kmin'], g.fft['kmax'], g.fft['dk'])
+            if params not in windows:
+                windows[params] = ftwindow(k_, xmin=params[1], xmax=params[2], dx=params[3], dx2=params[3], window=params[0])
+            win[i, :npts] = windows[params][:npts]
+        cchi = numpy.zeros((len(todo), NFFT), dtype='complex128')
+        cchi[:, :len(k_)] = (chi*win)[:, :NFFT]
+        out   = (KSTEP / numpy.sqrt(numpy.pi)) * numpy.fft.fft(cchi, axis=1)[:, :NFFT//2]
+        rstep = numpy.pi / (KSTEP*NFFT)
+        irmax = min(NFFT//2, int(1.01 + RMAX_OUT/rstep))
+        r     = rstep * numpy.arange(irmax)
+        for i, (g, key) in enumerate(todo):
+            def write(group=g.group, out=out[i, :irmax], kwin=win[i, :len(g.group.chi)]):
+                group.kwin     = kwin
+                group.r        = r
+                group.chir     = out
+                group.chir_mag = numpy.abs(out)
+                group.chir_re  = out.real
+                group.chir_im  = out.imag
+                group.chir_pha = numpy.unwrap(numpy.angle(out))
+            g._stage('fft', key, write)
+
+    def batch_xftr(self):
+        '''Back transform chi(R) of every group, as transformed most
+        recently.'''
+        todo = []
+        for g in self.groups:
+            if 'fft' not in g.keys:
+                g.do_xftf()
+            key = g.bft_key()
+            if key in g.cache:
+                g._stage('bft', key, None)
+            else:
+                todo.append((g, key))
+        if len(todo) == 0:
+            return
+        rstep = todo[0][0].group.r[1] - todo[0][0].group.r[0]
+        kstep = numpy.pi / (rstep*NFFT)
+        r_    = rstep * numpy.arange(NFFT, dtype='float64')
+        cchir = numpy.zeros((len(todo), NFFT), dtype='complex128')
+        win   = numpy.zeros((len(todo), NFFT))
+        windows = dict()
+        for i, (g, key) in enumerate(todo):
+            cchir[i, :len(g.group.chir)] = g.group.chir
+            params = (g.bft['window'], g.bft['rmin'], g.bft['rmax'], g.bft['dr'])
+            if params not in windows:
+                windows[params] = ftwindow(r_, xmin=params[1], xmax=params[2], dx=params[3], dx2=params[3], window=params[0])
+            win[i] = windows[params]
+        ## chi(R) is complex, for which Larch's xftr scales by 0.5
+        out = 0.5 * (4*numpy.sqrt(numpy.pi) / kstep) * numpy.fft.ifft(cchir*win, axis=1)[:, :NFFT//2]
+        q   = numpy.linspace(0, QMAX_OUT, int(1.05 + QMAX_OUT/kstep))
+        for i, (g, key) in enumerate(todo):
+            def write(group=g.group, out=out[i, :len(q)], rwin=win[i, :len(g.group.chir)]):
+                group.q        = q
+                group.rwin     = rwin
+                group.chiq     = out
+                group.chiq_mag = numpy.abs(out)
+                group.chiq_re  = out.real
+                group.chiq_im  = out.imag
+                group.chiq_pha = numpy.unwrap(numpy.angle(out))
+            g._stage('bft', key, write)
+
     def plot_xmu(self, norm=False, flat=False, deriv=False):
         '''Overplot multiple data sets in energy.
 
@@ -546,7 +735,7 @@ class Kekropidai():
         else:
             plt.title(f"{title}")
         for g in self.groups:
-            g.prep()
+            g.prep(fft=False)
             if deriv is True:
                 plt.plot(g.group.energy, g.group.dmude, label=g.name)
             elif flat is True:
@@ -589,7 +778,7 @@ class Kekropidai():
             title = self.name + ' in k-space'
         plt.title(f"{title}")
         for g in self.groups:
-            g.prep()
+            g.prep(fft=False)
             y = g.group.chi*g.group.k**kw
             plt.plot(g.group.k, y, label=g.name)
         plt.legend(loc='best', shadow=True)
@@ -625,9 +814,8 @@ class Kekropidai():
             plt.title(f"Magnitude of {title}")
             plt.ylabel(f"|$\chi$(R)|  ($\AA^{{-{kw+1}}}$)")
             
+        self.batch_xftf(kw=kw)
         for g in self.groups:
-            g.prep()
-            g.do_xftf(kw=kw)
             if part.lower() == 'r':
                 plt.plot(g.group.r, g.group.chir_re,  label=g.name)
             elif part.lower() == 'i':
@@ -671,10 +859,9 @@ class Kekropidai():
             plt.title(f"Magnitude of {title}")
             plt.ylabel(f"|$\chi$(q)|  ($\AA^{{-{kw}}}$)")
             
+        self.batch_xftf(kw=kw)
+        self.batch_xftr()
         for g in self.groups:
-            g.prep()
-            g.do_xftf(kw=kw)
-            g.do_xftr()
             maxk = max([maxk, g.group.k.max()])
             if part.lower() == 'r':
                 plt.plot(g.group.q, g.group.chiq_re,  label=g.name)
@@ -18,9 +18,13 @@ user_ns = get_ipython().user_ns
 from BMM.resting_state import resting_state_plan
 from BMM.suspenders    import BMM_clear_to_start
 from BMM.logging       import BMM_log_info, BMM_msg_hook
-from BMM.functions     import countdown
-from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
+from BMM.preflight     import preflight, dryrun
+from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, whisper
 from BMM.derivedplot   import DerivedPlot, interpret_click
+from BMM.flyscan       import fly_linescan
+from BMM.peaksearch    import PeakSearch, peak_search
+from BMM.pitchtable    import pitch_table
+from BMM.runcache      import runcache
 
 def move_after_scan(thismotor):
     '''
@@ -63,7 +67,7 @@ def peak(signal):
     center of rocking curve and slit height scans.'''
     return pandas.Series.idxmax(signal)
 
-def slit_height(start=-1.5, stop=1.5, nsteps=31, move=False, force=False, slp=1.0, choice='com'):
+def slit_height(start=-1.5, stop=1.5, nsteps=31, move=False, force=False, slp=1.0, choice='com', adaptive=True):
     '''Perform a relative scan of the DM3 BCT motor around the current
     position to find the optimal position for slits3. Optionally, the
     motor will moved to the center of mass of the peak at the end of
@@ -76,6 +80,11 @@ def slit_height(start=-1.5, stop=1.5, nsteps=31, move=False, force=False, slp=1.
       move:    (Boolean) True=move to position of max signal, False=pluck and move   [False]
       slp:     (float)   length of sleep before trying to move dm3_bct               [3.0]
       choice:  (string)  'peak' or 'com' (center of mass)                            ['com']
+      adaptive:(Boolean) True=coarse-to-fine search to the precision of nsteps       [True]
+
+    With adaptive=True, the scan measures a coarse grid and then refines
+    around the peak (see BMM/peaksearch.py), usually in about half the
+    points of the full grid.
     '''
 
     def main_plan(start, stop, nsteps, move, slp, force):
@@ -88,7 +97,7 @@ def slit_height(start=-1.5, stop=1.5, nsteps=31, move=False, force=False, slp=1.
         RE.msg_hook = None
         BMMuser.motor = user_ns['dm3_bct']
         func = lambda doc: (doc['data'][motor.name], doc['data']['I0'])
-        plot = DerivedPlot(func, xlabel=motor.name, ylabel='I0', title='I0 signal vs. slit height')
+        plot = DerivedPlot(func, xlabel=motor.name, ylabel='I0', title='I0 signal vs. slit height', sort=adaptive)
         line1 = '%s, %s, %.3f, %.3f, %d -- starting at %.3f\n' % \
                 (motor.name, 'i0', start, stop, nsteps, motor.user_readback.get())
         with open(dotfile, "w") as f:
@@ -105,19 +114,32 @@ def slit_height(start=-1.5, stop=1.5, nsteps=31, move=False, force=False, slp=1.
             yield from abs_set(motor.velocity, 0.4, wait=True)
             yield from abs_set(motor.kill_cmd, 1, wait=True)
 
-            uid = yield from rel_scan([quadem1], motor, start, stop, nsteps)
+            if adaptive:
+                search = PeakSearch(start, stop, nsteps)
+                uid = yield from peak_search([quadem1], motor, lambda r: r['I0'], search)
+            else:
+                uid = yield from rel_scan([quadem1], motor, start, stop, nsteps)
 
             RE.msg_hook = BMM_msg_hook
             BMM_log_info('slit height scan: %s\tuid = %s, scan_id = %d' %
-                         (line1, uid, user_ns['db'][-1].start['scan_id']))
-            if move:
-                t  = db[-1].table()
+                         (line1, uid, runcache.start_doc(uid)['scan_id']))
+            if move and adaptive:
+                top = search.best(choice)
+                pitch_table.scanned('slit', user_ns['dcm'].energy.position, search.positions(), top)
+
+                yield from sleep(slp)
+                yield from abs_set(motor.kill_cmd, 1, wait=True)
+                yield from mv(motor, top)
+
+            elif move:
+                t  = runcache.table(uid, columns=['I0', motor.name])
                 signal = t['I0']
                 if choice == 'peak':
                     position = peak(signal)
                 else:
                     position = com(signal)
                 top = t[motor.name][position]
+                pitch_table.scanned('slit', user_ns['dcm'].energy.position, t[motor.name], top)
                 
                 yield from sleep(slp)
                 yield from abs_set(motor.kill_cmd, 1, wait=True)
@@ -146,11 +168,9 @@ def slit_height(start=-1.5, stop=1.5, nsteps=31, move=False, force=False, slp=1.
     # this is a tool for verifying a macro.  this replaces this slit      #
     # height scan with a sleep, allowing the user to easily map out motor #
     # motions in a macro                                                  #
-    if BMMuser.macro_dryrun:
-        print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a slit height scan.\n' %
-                       BMMuser.macro_sleep))
-        countdown(BMMuser.macro_sleep)
-        return(yield from null())
+    if BMMuser.macro_dryrun or preflight.active:
+        return(yield from dryrun('slit_height', 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a slit height scan.' %
+                                 BMMuser.macro_sleep, start=start, stop=stop, nsteps=nsteps, move=move, slp=slp, adaptive=adaptive))
     #######################################################################
     motor = user_ns['dm3_bct']
     slit_height = slits3.vsize.readback.get()
@@ -160,7 +180,7 @@ def slit_height(start=-1.5, stop=1.5, nsteps=31, move=False, force=False, slp=1.
     RE.msg_hook = BMM_msg_hook
 
 
-def rocking_curve(start=-0.10, stop=0.10, nsteps=101, detector='I0', choice='peak'):
+def rocking_curve(start=-0.10, stop=0.10, nsteps=101, detector='I0', choice='peak', adaptive=True):
     '''Perform a relative scan of the DCM 2nd crystal pitch around the current
     position to find the peak of the crystal rocking curve.  Begin by opening
     the hutch slits to 3 mm. At the end, move to the position of maximum 
@@ -172,12 +192,18 @@ def rocking_curve(start=-0.10, stop=0.10, nsteps=101, detector='I0', choice='pea
       nsteps:   (int)    number of steps                        [101]
       detector: (string) 'I0' or 'Bicron'                       ['I0']
       choice:   (string) 'peak', fit' or 'com' (center of mass) ['peak']
+      adaptive: (Boolean) coarse-to-fine search                 [True]
 
     If choice is fit, the fit is performed using the
     SkewedGaussianModel from lmfit, which works pretty well for this
     measurement at BMM.  The line shape is a bit skewed due to the
     convolution with the slightly misaligned entrance slits.
 
+    With adaptive=True, the scan measures a coarse grid and then refines
+    around the peak (see BMM/peaksearch.py) to the precision of a grid
+    of nsteps, usually in 15 to 25 points rather than 101.  Set
+    adaptive=False for the full grid.
+
     '''
     def main_plan(start, stop, nsteps, detector):
         (ok, text) = BMM_clear_to_start()
@@ -200,7 +226,7 @@ def rocking_curve(start=-0.10, stop=0.10, nsteps=101, detector='I0', choice='pea
             sgnl = 'I0'
             titl = 'I0 signal vs. DCM 2nd crystal pitch'
 
-        plot = DerivedPlot(func, xlabel=motor.name, ylabel=sgnl, title=titl)
+        plot = DerivedPlot(func, xlabel=motor.name, ylabel=sgnl, title=titl, sort=adaptive)
 
         with open(dotfile, "w") as f:
             f.write("")
@@ -218,37 +244,37 @@ def rocking_curve(start=-0.10, stop=0.10, nsteps=101, detector='I0', choice='pea
             if sgnl == 'Bicron':
                 yield from mv(slitsg.vsize, 5)
                 
-            uid = yield from rel_scan(dets, motor, start, stop, nsteps)
-            #yield from rel_adaptive_scan(dets, 'I0', motor,
-            #                             start=start,
-            #                             stop=stop,
-            #                             min_step=0.002,
-            #                             max_step=0.03,
-            #                             target_delta=.15,
-            #                             backstep=True)
-            t  = db[-1].table()
-            signal = t[sgnl]
-            if choice.lower() == 'com':
-                position = com(signal)
-                top      = t[motor.name][position]
-            elif choice.lower() == 'fit':
-                pitch    = t['dcm_pitch']
-                mod      = SkewedGaussianModel()
-                pars     = mod.guess(signal, x=pitch)
-                out      = mod.fit(signal, pars, x=pitch)
-                print(whisper(out.fit_report(min_correl=0)))
-                out.plot()
-                top      = out.params['center'].value
+            if adaptive:
+                search = PeakSearch(start, stop, nsteps)
+                uid = yield from peak_search(dets, motor, lambda r: r[sgnl], search)
+                top = search.best(choice.lower())
+                pitch_table.scanned('pitch', dcm.energy.position, search.positions(), top)
             else:
-                position = peak(signal)
-                top      = t[motor.name][position]
+                uid = yield from rel_scan(dets, motor, start, stop, nsteps)
+                t  = runcache.table(uid, columns=[sgnl, motor.name])
+                signal = t[sgnl]
+                if choice.lower() == 'com':
+                    position = com(signal)
+                    top      = t[motor.name][position]
+                elif choice.lower() == 'fit':
+                    pitch    = t['dcm_pitch']
+                    mod      = SkewedGaussianModel()
+                    pars     = mod.guess(signal, x=pitch)
+                    out      = mod.fit(signal, pars, x=pitch)
+                    print(whisper(out.fit_report(min_correl=0)))
+                    out.plot()
+                    top      = out.params['center'].value
+                else:
+                    position = peak(signal)
+                    top      = t[motor.name][position]
+                pitch_table.scanned('pitch', dcm.energy.position, t[motor.name], top)
 
             yield from sleep(3.0)
             yield from abs_set(motor.kill_cmd, 1, wait=True)
             RE.msg_hook = BMM_msg_hook
 
             BMM_log_info('rocking curve scan: %s\tuid = %s, scan_id = %d' %
-                         (line1, uid, user_ns['db'][-1].start['scan_id']))
+                         (line1, uid, runcache.start_doc(uid)['scan_id']))
             yield from mv(motor, top)
             if sgnl == 'Bicron':
                 yield from mv(slitsg.vsize, gonio_slit_height)
@@ -265,17 +291,15 @@ def rocking_curve(start=-0.10, stop=0.10, nsteps=101, detector='I0', choice='pea
         if os.path.isfile(dotfile): os.remove(dotfile)
 
     
-    RE, BMMuser, db = user_ns['RE'], user_ns['BMMuser'], user_ns['db']
+    RE, BMMuser = user_ns['RE'], user_ns['BMMuser']
     dcm, slits3, slitsg, quadem1 = user_ns['dcm'], user_ns['slits3'], user_ns['slitsg'], user_ns['quadem1']
     ######################################################################
     # this is a tool for verifying a macro.  this replaces this rocking  #
     # curve scan with a sleep, allowing the user to easily map out motor #
     # motions in a macro                                                 #
-    if BMMuser.macro_dryrun:
-        print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a rocking curve scan.\n' %
-                       BMMuser.macro_sleep))
-        countdown(BMMuser.macro_sleep)
-        return(yield from null())
+    if BMMuser.macro_dryrun or preflight.active:
+        return(yield from dryrun('rocking_curve', 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a rocking curve scan.' %
+                                 BMMuser.macro_sleep, start=start, stop=stop, nsteps=nsteps, adaptive=adaptive))
     ######################################################################
     motor = user_ns['dcm_pitch']
     dotfile = '/home/xf06bm/Data/.line.scan.running'
@@ -313,7 +337,7 @@ def ls_backwards_compatibility(detin, axin):
 ####################################
 # generic linescan vs. It/If/Ir/I0 #
 ####################################
-def linescan(detector, axis, start, stop, nsteps, pluck=True, force=False, inttime=0.1, md={}): # integration time?
+def linescan(detector, axis, start, stop, nsteps, pluck=True, force=False, inttime=0.1, fly=False, md={}): # integration time?
     '''
     Generic linescan plan.  This is a RELATIVE scan, relative to the
     current position of the selected motor.
@@ -329,6 +353,7 @@ def linescan(detector, axis, start, stop, nsteps, pluck=True, force=False, intti
        pluck:    flag for whether to offer to pluck & move motor
        force:    flag for forcing a scan even if not clear to start
        inttime:  integration time in seconds (default: 0.1)
+       fly:      flag for flying the motor rather than stepping it
 
     The motor is either the BlueSky name for a motor (e.g. xafs_linx)
     or a nickname for an XAFS sample motor (e.g. 'x' for xafs_linx).
@@ -337,9 +362,17 @@ def linescan(detector, axis, start, stop, nsteps, pluck=True, force=False, intti
 
     Use the ls2dat() function to extract the linescan from the
     database and write it to a file.
+
+    With fly=True, the motor moves at constant velocity across the range
+    while the detectors are sampled on a time base, and the samples are
+    binned onto the nsteps points (see fly_linescan in BMM/flyscan.py).
+    Each bin is crossed in inttime seconds, so the scan takes about
+    nsteps*inttime plus the run-up, with none of the per-point overhead.
+    This works for the EpicsMotor stages and the ion chamber and
+    analog fluorescence measurements, not for 'xs'.
     '''
 
-    def main_plan(detector, axis, start, stop, nsteps, pluck, force):
+    def main_plan(detector, axis, start, stop, nsteps, pluck, force, fly):
         (ok, text) = BMM_clear_to_start()
         if force is False and ok is False:
             print(error_msg(text))
@@ -474,10 +507,17 @@ def linescan(detector, axis, start, stop, nsteps, pluck=True, force=False, intti
         with open(dotfile, "w") as f:
             f.write("")
 
+        if fly and (detector == 'Xs' or 'EpicsMotor' not in str(type(thismotor))):
+            print(warning_msg('\nCannot fly %s with %s, stepping instead.\n' % (thismotor.name, detector)))
+            fly = False
+
         @subs_decorator(plot)
         #@subs_decorator(src.callback)
         def scan_xafs_motor(dets, motor, start, stop, nsteps):
-            uid = yield from rel_scan(dets, motor, start, stop, nsteps, md={**thismd, **md})
+            if fly:
+                uid = yield from fly_linescan(dets, motor, start, stop, nsteps, inttime, md={**thismd, **md})
+            else:
+                uid = yield from rel_scan(dets, motor, start, stop, nsteps, md={**thismd, **md})
             return uid
             
         uid = yield from scan_xafs_motor(dets, thismotor, start, stop, nsteps)
@@ -485,7 +525,7 @@ def linescan(detector, axis, start, stop, nsteps, pluck=True, force=False, intti
         #run = src.retrieve()
         #mytable = run.primary.read().to_dataframe()
         BMM_log_info('linescan: %s\tuid = %s, scan_id = %d' %
-                     (line1, uid, user_ns['db'][-1].start['scan_id']))
+                     (line1, uid, runcache.start_doc(uid)['scan_id']))
         if pluck is True:
             action = input('\n' + bold_msg('Pluck motor position from the plot? [Y/n then Enter] '))
             if action.lower() == 'n' or action.lower() == 'q':
@@ -508,15 +548,13 @@ def linescan(detector, axis, start, stop, nsteps, pluck=True, force=False, intti
     # this is a tool for verifying a macro.  this replaces an xafs scan  #
     # with a sleep, allowing the user to easily map out motor motions in #
     # a macro                                                            #
-    if BMMuser.macro_dryrun:
-        print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a line scan.\n' %
-                       BMMuser.macro_sleep))
-        countdown(BMMuser.macro_sleep)
-        return(yield from null())
+    if BMMuser.macro_dryrun or preflight.active:
+        return(yield from dryrun('linescan', 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a line scan.' %
+                                 BMMuser.macro_sleep, axis=axis, start=start, stop=stop, nsteps=nsteps, inttime=inttime, fly=fly))
     ######################################################################
     dotfile = '/home/xf06bm/Data/.line.scan.running'
     RE.msg_hook = None
-    yield from finalize_wrapper(main_plan(detector, axis, start, stop, nsteps, pluck, force), cleanup_plan())
+    yield from finalize_wrapper(main_plan(detector, axis, start, stop, nsteps, pluck, force, fly), cleanup_plan())
     RE.msg_hook = BMM_msg_hook
 
 
@@ -543,7 +581,8 @@ def ls2dat(datafile, key):
     handle = open(datafile, 'w')
     dataframe = db[key]
     devices = dataframe.devices() # note: this is a _set_ (this is helpful: https://snakify.org/en/lessons/sets/)
-    if 'vor' in devices:
+    table = dataframe.table()
+    if 'vor' in devices or BMMuser.dtc1 in table.columns:   # a fly scan's detectors are all in the 'fly' device
         abscissa = dataframe['start']['motors'][0]
         column_list = [abscissa, 'I0', 'It', 'Ir',
                        BMMuser.dtc1, BMMuser.dtc2, BMMuser.dtc3, BMMuser.dtc4,
@@ -558,7 +597,6 @@ def ls2dat(datafile, key):
         column_list = [abscissa, 'I0', 'It', 'Ir']
 
     #print(column_list)
-    table = dataframe.table()
     this = table.loc[:,column_list]
 
     handle.write('# XDI/1.0 BlueSky/%s\n'    % bluesky_version)
@@ -581,20 +619,65 @@ def ls2dat(datafile, key):
     print(bold_msg('wrote linescan to %s' % datafile))
 
 
-## these should use src rather than db
+## these read the scan just measured from the run cache
     
-def center_sample_y():
-    yield from linescan('it', xafs_liny, -1.5, 1.5, 61, pluck=False)
-    table = db[-1].table()
-    diff = -1 * table['It'].diff()
-    inflection = table['xafs_liny'][diff.idxmax()]
+def adaptive_linescan(axis, start, stop, nsteps, target='peak', inttime=0.1):
+    '''Coarse-to-fine search on It for the sample alignment plans below.
+    Returns the PeakSearch, or None if the search did not run.'''
+    RE, BMMuser, quadem1 = user_ns['RE'], user_ns['BMMuser'], user_ns['quadem1']
+    if BMMuser.macro_dryrun or preflight.active:
+        yield from dryrun('linescan', 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a %s search on %s.' %
+                          (BMMuser.macro_sleep, target, axis.name), axis=axis, start=start, stop=stop, nsteps=nsteps,
+                          inttime=inttime, adaptive=True, target=target)
+        return None
+    (ok, text) = BMM_clear_to_start()
+    if ok is False:
+        print(error_msg(text))
+        yield from null()
+        return None
+    BMMuser.motor = axis
+    search = PeakSearch(start, stop, nsteps, target=target)
+    plot = DerivedPlot(lambda doc: (doc['data'][axis.name], doc['data']['It']),
+                       xlabel=axis.name, ylabel='It', title='It vs. %s' % axis.name, sort=True)
+
+    @subs_decorator(plot)
+    def scan_axis():
+        yield from abs_set(user_ns['_locked_dwell_time'], inttime, wait=True)
+        uid = yield from peak_search([quadem1], axis, lambda r: r['It'], search, md={'plan_name': 'peak_search %s' % target})
+        BMM_log_info('%s search on %s: %d points\tuid = %s, scan_id = %d' %
+                     (target, axis.name, len(search.x), uid, runcache.start_doc(uid)['scan_id']))
+
+    RE.msg_hook = None
+    yield from finalize_wrapper(scan_axis(), resting_state_plan())
+    RE.msg_hook = BMM_msg_hook
+    return search
+
+def center_sample_y(adaptive=True):
+    xafs_liny = user_ns['xafs_liny']
+    if adaptive:
+        search = yield from adaptive_linescan(xafs_liny, -1.5, 1.5, 61, target='inflection')
+        if search is None:
+            return
+        inflection = search.best()
+    else:
+        yield from linescan('it', xafs_liny, -1.5, 1.5, 61, pluck=False)
+        table = runcache.table(-1, columns=['It', 'xafs_liny'])
+        diff = -1 * table['It'].diff()
+        inflection = table['xafs_liny'][diff.idxmax()]
     yield from mv(xafs_liny, inflection)
     print(bold_msg('Optimal position in y at %.3f' % inflection))
 
-def center_sample_roll():
-    yield from linescan('it', xafs_roll, -3, 3, 61, pluck=False)
-    table = db[-1].table()
-    peak = table['xafs_roll'][table['It'].idxmax()]
+def center_sample_roll(adaptive=True):
+    xafs_roll = user_ns['xafs_roll']
+    if adaptive:
+        search = yield from adaptive_linescan(xafs_roll, -3, 3, 61, target='peak')
+        if search is None:
+            return
+        peak = search.best('peak')
+    else:
+        yield from linescan('it', xafs_roll, -3, 3, 61, pluck=False)
+        table = runcache.table(-1, columns=['It', 'xafs_roll'])
+        peak = table['xafs_roll'][table['It'].idxmax()]
     yield from mv(xafs_roll, peak)
     print(bold_msg('Optimal position in roll at %.3f' % peak))
 
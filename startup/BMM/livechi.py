@@ -0,0 +1,190 @@
+import numpy, threading
+import matplotlib.pyplot as plt
+
+from bluesky.callbacks.mpl_plotting import QtAwareCallback
+from larch.xafs import ftwindow
+
+from BMM.functions import etok
+from BMM.larch     import KSTEP, NFFT, RMAX_OUT
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# A live view of chi(k) and |chi(R)| during an EXAFS scan               #
+#                                                                       #
+# LiveChi takes the same event stream and the same function of an       #
+# event as the DerivedPlot of mu(E).  Once the scan is EDGE_MARGIN      #
+# past the edge, and then every EVERY points, it removes the background #
+# from the data measured so far and draws k^2 chi(k) and |chi(R)| in a  #
+# second window.  Then the data quality at high k can be judged while   #
+# the scan is still running.                                            #
+#                                                                       #
+# The update has to be cheap, so it is not Larch's pre_edge and autobk: #
+#   pre-edge:    a line fit to PRE_EDGE below the edge, computed once   #
+#                per scan (the pre-edge region is finished by the time  #
+#                the scan is past the edge) and then reused             #
+#   edge step:   a line fit above POST_EDGE, evaluated at e0            #
+#   background:  a least-squares cubic spline in k with as many knots   #
+#                as autobk would use for rbkg                           #
+#   transform:   one NumPy FFT with Larch's conventions (see            #
+#                BMM/larch.py)                                          #
+# An update takes a few milliseconds.  The Larch processing of the      #
+# finished data (Pandrosus, the dossier) is unchanged.                  #
+#                                                                       #
+#    plot.append(LiveChi(func, e0=7112, title='Fe foil'))               #
+#########################################################################
+
+EVERY       = 10                # points between updates
+EDGE_MARGIN = 30                # eV above e0 before the first update
+PRE_EDGE    = (-150, -30)       # eV, range of the pre-edge line
+POST_EDGE   = 50                # eV, the edge step line is fit above this
+
+
+class LiveChi(QtAwareCallback):
+    '''Live k^2 chi(k) and |chi(R)| for an XAFS scan.  See the comment above.
+
+      func:    function of an event returning (energy, mu), as for DerivedPlot
+      e0:      edge energy
+      every:   number of points between updates
+      kweight: k-weight of the plot and the transform
+      rbkg:    sets the number of terms of the background
+      kmin:    lower end of the transform window
+      dk:      width of the sills of the transform window
+      window:  transform window, as for Larch's xftf
+      title:   window title
+    '''
+    def __init__(self, func, e0, every=EVERY, kweight=2, rbkg=1.0, kmin=2, dk=1, window='hanning', title=None, stream_name='primary'):
+        super().__init__()
+        self.__setup_lock = threading.Lock()
+        self.__setup_event = threading.Event()
+        self.func        = func
+        self.e0          = e0
+        self.every       = every
+        self.kweight     = kweight
+        self.rbkg        = rbkg
+        self.kmin        = kmin
+        self.dk          = dk
+        self.window      = window
+        self.stream_name = stream_name
+        self.descriptors = {}
+        def setup():
+            with self.__setup_lock:
+                if self.__setup_event.is_set():
+                    return
+                self.__setup_event.set()
+            self.fig, (self.axk, self.axr) = plt.subplots(1, 2, figsize=(11, 4.5))
+            if title is not None:
+                self.fig.suptitle(title)
+            self.axk.set_xlabel('wavenumber ($\AA^{-1}$)')
+            self.axk.set_ylabel(f"$k^{kweight}\cdot\chi(k)$  ($\AA^{{-{kweight}}}$)")
+            self.axr.set_xlabel('radial distance ($\AA$)')
+            self.axr.set_ylabel(f"$|\chi(R)|$  ($\AA^{{-{kweight+1}}}$)")
+            for ax in (self.axk, self.axr):
+                ax.grid(which='major', axis='both')
+            self.axr.set_xlim(0, 6)
+            self.klines, self.rlines = [], []
+        self.__setup = setup
+
+    def start(self, doc):
+        self.__setup()
+        self.energy, self.mu = [], []
+        self.descriptors.clear()
+        self.pre = None
+        self.npost, self.updated = 0, 0
+        for line in self.klines + self.rlines:
+            line.set_alpha(0.3)
+        label = str(doc.get('scan_id', ''))
+        self.kline, = self.axk.plot([], [], label=label)
+        self.rline, = self.axr.plot([], [], label=label, color=self.kline.get_color())
+        self.klines.append(self.kline)
+        self.rlines.append(self.rline)
+        self.axr.legend(loc='upper right', title='scan_id')
+        super().start(doc)
+
+    def descriptor(self, doc):
+        if doc['name'] == self.stream_name:
+            self.descriptors[doc['uid']] = doc
+
+    def event(self, doc):
+        if not doc['descriptor'] in self.descriptors:
+            return
+        x, y = self.func(doc)
+        self.energy.append(float(x))
+        self.mu.append(float(y))
+        if x < self.e0 + EDGE_MARGIN:
+            return
+        self.npost += 1
+        if self.npost - self.updated >= self.every:
+            self.updated = self.npost
+            self.update()
+
+    def stop(self, doc):
+        if self.npost > self.updated:
+            self.update()
+        super().stop(doc)
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## the processing
+    def chi(self):
+        '''Return (k, chi) on a uniform k grid from the data so far, or
+        None if there is not enough data.'''
+        energy, mu = numpy.array(self.energy), numpy.array(self.mu)
+        if self.pre is None:
+            pre = (energy >= self.e0+PRE_EDGE[0]) & (energy <= self.e0+PRE_EDGE[1])
+            if pre.sum() < 2:
+                return None
+            self.pre = numpy.polyfit(energy[pre], mu[pre], 1)
+        mu = mu - numpy.polyval(self.pre, energy)
+        post = energy > self.e0 + EDGE_MARGIN
+        order = numpy.argsort(energy[post])
+        energy, mu = energy[post][order], mu[post][order]
+        k = etok(energy - self.e0)
+        if len(k) < 5 or k[-1] - k[0] < 1:
+            return None
+        above = energy > self.e0 + POST_EDGE
+        if above.sum() >= 3:
+            step = numpy.polyval(numpy.polyfit(energy[above], mu[above], 1), self.e0)
+        else:
+            step = mu.mean()
+        if step <= 0:
+            return None
+        nknots = min(int(2*self.rbkg*(k[-1]-k[0])/numpy.pi) + 1, len(k)-3)
+        basis = _bspline_basis(k, max(nknots, 2))
+        bkg = basis @ numpy.linalg.lstsq(basis, mu, rcond=None)[0]
+        grid = KSTEP * numpy.arange(int(k[-1]/KSTEP)+1)
+        chi = numpy.interp(grid, k, (mu - bkg)/step, left=0)
+        return grid, chi
+
+    def update(self):
+        result = self.chi()
+        if result is None:
+            return
+        k, chi = result
+        nonzero = numpy.flatnonzero(chi)
+        if len(nonzero) == 0:
+            return
+        y = chi * k**self.kweight
+        kmin = max(self.kmin, k[nonzero[0]] + self.dk/2)
+        win = ftwindow(k, xmin=kmin, xmax=k[-1], dx=self.dk, dx2=self.dk, window=self.window)
+        cchi = numpy.zeros(NFFT, dtype='complex128')
+        cchi[:min(len(k), NFFT)] = (y*win)[:NFFT]
+        out = (KSTEP / numpy.sqrt(numpy.pi)) * numpy.fft.fft(cchi)[:NFFT//2]
+        rstep = numpy.pi / (KSTEP*NFFT)
+        irmax = min(NFFT//2, int(1.01 + RMAX_OUT/rstep))
+        self.kline.set_data(k, y)
+        self.rline.set_data(rstep*numpy.arange(irmax), numpy.abs(out[:irmax]))
+        for ax in (self.axk, self.axr):
+            ax.relim(visible_only=True)
+            ax.autoscale_view(tight=True)
+        self.axr.set_xlim(0, 6)
+        self.fig.canvas.draw_idle()
+
+
+def _bspline_basis(x, nknots):
+    '''The uniform cubic B-splines with nknots knots spanning x, as
+    the columns of a matrix.'''
+    h = (x[-1] - x[0]) / (nknots - 1)
+    u = numpy.abs((x[:, None] - x[0]) / h - numpy.arange(-1, nknots+1)[None, :])
+    return numpy.where(u < 1, 2/3 - u**2 + u**3/2, numpy.where(u < 2, (2-u)**3/6, 0))
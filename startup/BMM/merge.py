@@ -0,0 +1,294 @@
+import numpy, os, time
+
+from BMM.functions import error_msg, warning_msg, bold_msg, whisper
+from BMM.logging   import BMM_log_info
+from BMM.runcache  import runcache
+from BMM.xdi       import xdi_kind, xdi_columns, xdi_header, xdi_time, xdi_format
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Merging the repetitions of an XAFS scan sequence                      #
+#                                                                       #
+# A sequence is given by its file stub (the XDI files stub.001,         #
+# stub.002, ...) or by a list of uids.  Then:                           #
+#                                                                       #
+#   align:    each repetition's reference, ln(It/Ir), is put on a fine  #
+#             uniform grid around the edge, differentiated, smoothed,   #
+#             and cross-correlated (one FFT for all of them) against    #
+#             the first repetition.  The lag of the correlation peak,   #
+#             refined by a parabola, is that repetition's energy shift. #
+#   stack:    every repetition, shifted, is interpolated onto the       #
+#             energy grid of the first in a single vectorized step.     #
+#   reject:   each repetition is fit to the median of the stack by an   #
+#             offset and a scale.  A repetition whose residual is more  #
+#             than NSIGMA robust deviations above the median residual   #
+#             is rejected (never more than half, and only when there    #
+#             are at least MIN_REJECT repetitions).                     #
+#   combine:  the rest are averaged with weights proportional to the    #
+#             inverse square of their residuals.                        #
+#                                                                       #
+# The merged XDI file has columns energy, xmu, reference, and stddev,   #
+# and lists the weight and shift of every repetition in its header.     #
+#                                                                       #
+#    m = merge('Fe-foil', 1, 50)      # files Fe-foil.001 to .050       #
+#    m = merge([uid1, uid2, uid3])    # runs, by uid                    #
+#    m.show()                                                           #
+#########################################################################
+
+ALIGN_STEP   = 0.05             # eV, grid of the cross-correlation
+ALIGN_RANGE  = (-50, 100)       # eV around the edge used for alignment
+ALIGN_SMOOTH = 0.5              # eV, width of the Gaussian smoothing the derivatives
+MAX_SHIFT    = 5                # eV, largest shift considered
+NSIGMA       = 4
+MIN_REJECT   = 4
+
+
+def sequence_files(folder, name, start, end):
+    '''The XDI files of a scan sequence which exist.'''
+    files = [os.path.join(folder, "%s.%3.3d" % (name, i)) for i in range(int(start), int(end)+1)]
+    return [f for f in files if os.path.isfile(f)]
+
+
+def read_xdi(filename):
+    '''Return (header, labels, data) from an XDI file written by BMM.
+    header is the list of header lines up to the user comment, labels
+    are the column labels (the last line of the header).'''
+    header, labels = [], []
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header.append(line.rstrip('\n'))
+    labels = header[-1][1:].split()
+    if '# ///////////' in header:
+        header = header[:header.index('# ///////////')]
+    data = numpy.loadtxt(filename, comments='#', ndmin=2)
+    return header, labels, data
+
+
+def _interp_rows(x, xp, fp):
+    '''numpy.interp for many rows at once: evaluate each row of fp
+    (sampled at the same row of xp, increasing) at the same row of x.
+    Beyond the ends of a row, its end values are used.'''
+    nrows, ncols = xp.shape
+    lo = min(xp.min(), x.min())
+    span = max(xp.max(), x.max()) - lo + 1
+    offset = 2 * span * numpy.arange(nrows)[:, None]
+    flat = (xp - lo + offset).ravel()
+    t = x - lo + offset
+    idx = numpy.searchsorted(flat, t.ravel()).reshape(x.shape)
+    first = ncols * numpy.arange(nrows)[:, None]
+    idx = numpy.clip(idx, first+1, first+ncols-1)
+    x0, x1 = flat[idx-1], flat[idx]
+    values = fp.ravel()
+    y0, y1 = values[idx-1], values[idx]
+    w = numpy.clip((t - x0) / (x1 - x0), 0, 1)
+    return y0 + w*(y1 - y0)
+
+
+def _pad(arrays, extend=False):
+    '''Stack arrays of different lengths into a 2D array by repeating the
+    last value of each (or, with extend, continuing it in tiny steps so
+    that each row stays increasing).'''
+    length = max(len(a) for a in arrays)
+    out = numpy.empty((len(arrays), length))
+    for i, a in enumerate(arrays):
+        out[i, :len(a)] = a
+        out[i, len(a):] = a[-1] + (1e-6 * numpy.arange(1, length-len(a)+1) if extend else 0)
+    return out
+
+
+class Merge():
+    '''The merge of a sequence of repetitions.  See the comment above.
+
+    attributes:
+      labels:     name of each repetition (file name or uid)
+      header:     XDI header lines of the first repetition, without
+                  Column lines
+      grid:       energy grid of the merge (that of the first repetition)
+      aligned:    2D array of every repetition, shifted and interpolated
+      shifts:     energy shift of each repetition, in eV
+      residuals:  RMS residual of each repetition against the median
+      kept:       boolean array, False for rejected repetitions
+      weights:    weight of each repetition in the merge, summing to 1
+      mu, reference, stddev:  the merged data
+    '''
+    def __init__(self, energy, mu, reference=None, labels=None, header=None, align=True):
+        self.labels    = labels or ['%d' % (i+1) for i in range(len(mu))]
+        self.header    = header or ['# XDI/1.0 BMM']
+        self.raw       = list(zip(energy, mu))
+        self.grid      = numpy.asarray(energy[0], dtype=float)
+        n = len(mu)
+        E = _pad(energy, extend=True)
+        M = _pad(mu)
+        R = None if reference is None or any(r is None for r in reference) else _pad(reference)
+        self.shifts = numpy.zeros(n)
+        if align and R is not None and n > 1:
+            self.shifts = self._align(E, R)
+        elif align and R is None:
+            print(warning_msg('not aligning, not every repetition has a reference'))
+        target = self.grid[None, :] + self.shifts[:, None]
+        self.aligned = _interp_rows(target, E, M)
+        refs = None if R is None else _interp_rows(target, E, R)
+        self._reject()
+        self.mu        = self.weights @ self.aligned
+        self.reference = None if refs is None else self.weights @ refs
+        self.stddev    = numpy.sqrt(self.weights @ (self.aligned - self.mu)**2)
+
+    def __repr__(self):
+        return '<Merge: %d of %d repetitions>' % (self.kept.sum(), len(self.kept))
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## alignment
+    def _align(self, E, R):
+        '''Energy shift of each repetition relative to the first, by
+        cross-correlating the derivatives of the references.'''
+        start, stop = E[:, 0].max(), E.max(axis=1).min()
+        fine = numpy.arange(start, stop, ALIGN_STEP)
+        D = numpy.gradient(_interp_rows(numpy.broadcast_to(fine, (len(E), len(fine))), E, R), axis=1)
+        edge = numpy.argmax(numpy.abs(D[0]))
+        window = (fine >= fine[edge]+ALIGN_RANGE[0]) & (fine <= fine[edge]+ALIGN_RANGE[1])
+        D = D[:, window]
+        D = (D - D.mean(axis=1)[:, None]) * numpy.hanning(D.shape[1])
+        size = 2*D.shape[1]
+        F = numpy.fft.rfft(D, size, axis=1)
+        ## smoothing by ALIGN_SMOOTH removes the kinks of the linear interpolation
+        F = F * numpy.exp(-0.5*(2*numpy.pi*numpy.fft.rfftfreq(size, ALIGN_STEP)*ALIGN_SMOOTH)**2)
+        C = numpy.fft.irfft(F * numpy.conj(F[0]), size, axis=1)
+        maxlag = min(int(MAX_SHIFT/ALIGN_STEP), D.shape[1]-1)
+        C = numpy.concatenate([C[:, -maxlag:], C[:, :maxlag+1]], axis=1)   # lags -maxlag ... maxlag
+        peak = numpy.clip(numpy.argmax(C, axis=1), 1, C.shape[1]-2)
+        rows = numpy.arange(len(C))
+        (a, b, c) = C[rows, peak-1], C[rows, peak], C[rows, peak+1]
+        denominator = a - 2*b + c
+        refine = numpy.where(denominator != 0, 0.5*(a - c)/numpy.where(denominator != 0, denominator, 1), 0)
+        return (peak - maxlag + refine) * ALIGN_STEP
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## outlier rejection and weights
+    def _reject(self):
+        A = self.aligned
+        n = len(A)
+        median = numpy.median(A, axis=0)
+        ## least squares fit of each row to offset + scale*median, all at once
+        mc = median - median.mean()
+        scale = ((A - A.mean(axis=1)[:, None]) @ mc) / (mc @ mc) if mc @ mc > 0 else numpy.ones(n)
+        offset = A.mean(axis=1) - scale*median.mean()
+        self.residuals = numpy.sqrt(((A - offset[:, None] - scale[:, None]*median)**2).mean(axis=1))
+        self.kept = numpy.ones(n, dtype=bool)
+        typical = numpy.median(self.residuals)
+        if n >= MIN_REJECT:
+            spread = 1.4826 * numpy.median(numpy.abs(self.residuals - typical))
+            limit = typical + NSIGMA * max(spread, 0.1*typical)
+            worst = numpy.argsort(self.residuals)[::-1][:n//2]
+            self.kept[worst[self.residuals[worst] > limit]] = False
+        floor = max(typical/2, 1e-12)
+        weights = numpy.where(self.kept, 1/numpy.maximum(self.residuals, floor)**2, 0)
+        self.weights = weights / weights.sum()
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## output
+    def show(self):
+        print(bold_msg('%-30s  %8s  %10s  %7s' % ('repetition', 'shift', 'residual', 'weight')))
+        for i, label in enumerate(self.labels):
+            text = '%-30s  %8.3f  %10.3g  %7.4f' % (label, self.shifts[i], self.residuals[i], self.weights[i])
+            print(text if self.kept[i] else whisper(text + '  (rejected)'))
+
+    def write(self, filename):
+        '''Write the merge to an XDI file.'''
+        columns = [self.grid, self.mu, self.reference if self.reference is not None else 0*self.grid, self.stddev]
+        labels  = ['energy', 'xmu', 'reference', 'stddev']
+        lines = [l for l in self.header if not l.startswith('# Column.')]
+        lines += ['# Column.%d: %s%s' % (i, l, ' eV' if l == 'energy' else '') for i, l in enumerate(labels, start=1)]
+        lines += ['# Merge.repetitions: %d' % len(self.labels), '# Merge.kept: %d' % self.kept.sum()]
+        lines += ['# Merge.%d: %s  shift=%.3f  weight=%.5f%s' % (i, l, self.shifts[i-1], self.weights[i-1], '' if self.kept[i-1] else '  rejected')
+                  for i, l in enumerate(self.labels, start=1)]
+        lines += ['# ///////////', '# merge of %d of %d repetitions' % (self.kept.sum(), len(self.labels)),
+                  '# -----------', '# ' + '  '.join(labels)]
+        with open(filename + '.part', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.write(xdi_format(numpy.column_stack(columns), "  %.3f  %.6f  %.6f  %.6f\n"))
+        os.replace(filename + '.part', filename)
+
+
+def merge_files(files, align=True):
+    '''Merge a list of XDI files.'''
+    energy, mu, reference = [], [], []
+    for f in files:
+        header, labels, data = read_xdi(f)
+        order = numpy.argsort(data[:, 0], kind='stable')
+        data = data[order]
+        energy.append(data[:, 0])
+        mu.append(data[:, labels.index('xmu')])
+        if 'It' in labels and 'Ir' in labels:
+            reference.append(numpy.log(data[:, labels.index('It')] / data[:, labels.index('Ir')]))
+        else:
+            reference.append(None)
+        if len(energy) == 1:
+            first = header
+    return Merge(energy, mu, reference, labels=[os.path.basename(f) for f in files], header=first, align=align)
+
+
+def merge_uids(uids, align=True):
+    '''Merge a list of runs from the run cache or the database.'''
+    energy, mu, reference, header = [], [], [], None
+    for uid in uids:
+        run = runcache[uid]
+        mode, comment, kind = xdi_kind(run.start)
+        table = run.table()
+        (column_list, template) = xdi_columns(table, mode, kind)
+        table = table.sort_values(column_list[0], kind='stable')
+        energy.append(numpy.array(table[column_list[0]], dtype=float))
+        mu.append(numpy.array(table['xmu'], dtype=float))
+        reference.append(numpy.array(numpy.log(table['It'] / table['Ir']), dtype=float))
+        if header is None:
+            baseline_table = run.table('baseline')
+            (header, labels) = xdi_header(run.start, lambda r: baseline_table[r][1],
+                                          xdi_time(run.start['time']), xdi_time(run.stop['time']))
+    return Merge(energy, mu, reference, labels=list(uids), header=header, align=align)
+
+
+def merge(source, start=None, end=None, folder=None, align=True, filename=None, quiet=False):
+    '''Merge the repetitions of a scan sequence, write the merge to an
+    XDI file, and return the Merge.  See the comment above.
+
+      source:    file stub (with start and end) or list of uids
+      start,end: first and last repetition of a file stub
+      folder:    folder of the data files and the merge [BMMuser.DATA]
+      align:     align the repetitions using the reference [True]
+      filename:  name of the merged XDI file [<stub>-merge.xdi in folder]
+    '''
+    t0 = time.time()
+    if folder is None:
+        folder = user_ns['BMMuser'].DATA
+    if isinstance(source, str):
+        if start is None or end is None:
+            print(error_msg('merging a file stub needs start and end'))
+            return None
+        files = sequence_files(folder, source, start, end)
+        if len(files) == 0:
+            print(error_msg('no data files found for %s' % source))
+            return None
+        m = merge_files(files, align=align)
+        stub = source
+    else:
+        if len(source) == 0:
+            print(error_msg('nothing to merge'))
+            return None
+        m = merge_uids(source, align=align)
+        try:
+            stub = os.path.splitext(runcache.start_doc(source[0])['XDI']['_filename'])[0]
+        except (KeyError, TypeError):
+            stub = source[0][:8]
+    if filename is None:
+        filename = os.path.join(folder, stub + '-merge.xdi')
+    m.write(filename)
+    text = 'merged %d of %d repetitions of %s into %s in %.2f seconds' % (m.kept.sum(), len(m.kept), stub, filename, time.time()-t0)
+    BMM_log_info(text)
+    if not quiet:
+        m.show()
+        print(bold_msg(text))
+    return m
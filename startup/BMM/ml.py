@@ -14,6 +14,8 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from joblib import dump, load
 
+from BMM.runcache import runcache
+
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
 
@@ -232,9 +234,9 @@ class BMMDataEvaluation():
 
         '''
         if mode == 'xs':
-            BMMuser, db = user_ns['BMMuser'], user_ns['db']
-            t = db[-1].table()
+            BMMuser = user_ns['BMMuser']
             el = BMMuser.element
+            t = runcache.table(uid, columns=['I0', 'dcm_energy', el+'1', el+'2', el+'3', el+'4'])
             i0 = numpy.array(t['I0'])
             en = numpy.array(t['dcm_energy'])
             dtc1 = numpy.array(t[el+'1'])
@@ -244,32 +246,42 @@ class BMMDataEvaluation():
             signal = dtc1+dtc2+dtc3+dtc4
             mu = signal/i0
         else:
-            db = user_ns['db']
-            this = db.v2[uid]
+            this = runcache[uid]
             if mode is None:
-                mode = this.metadata['start']['XDI']['_mode'][0]
-            element = this.metadata['start']['XDI']['Element']['symbol']
-            i0 = this.primary.read()['I0']
-            en = this.primary.read()['dcm_energy']
+                mode = this.start['XDI']['_mode'][0]
+            element = this.start['XDI']['Element']['symbol']
             if mode == 'transmission':
-                it = this.primary.read()['It']
-                mu = numpy.log(abs(i0/it))
+                t = this.table(columns=['I0', 'dcm_energy', 'It'])
+                mu = numpy.log(abs(t['I0']/t['It']))
             elif mode == 'reference':
-                it = this.primary.read()['It']
-                ir = this.primary.read()['Ir']
-                mu = numpy.log(abs(it/ir))
+                t = this.table(columns=['I0', 'dcm_energy', 'It', 'Ir'])
+                mu = numpy.log(abs(t['It']/t['Ir']))
             else:
-                if element in str(this.primary.read()['vor:vor_names_name3'][0].values):
-                    signal = this.primary.read()['DTC1'] + this.primary.read()['DTC2'] + this.primary.read()['DTC3'] + this.primary.read()['DTC4']
-                elif element in str(this.primary.read()['vor:vor_names_name15'][0].values):
-                    signal = this.primary.read()['DTC2_1'] + this.primary.read()['DTC2_2'] + this.primary.read()['DTC2_3'] + this.primary.read()['DTC2_4']
-                elif element in str(this.primary.read()['vor:vor_names_name19'][0].values):
-                    signal = this.primary.read()['DTC3_1'] + this.primary.read()['DTC3_2'] + this.primary.read()['DTC3_3'] + this.primary.read()['DTC3_4']
-                else:
+                choices = {'vor_names_name3'  : ['DTC1', 'DTC2', 'DTC3', 'DTC4'],
+                           'vor_names_name15' : ['DTC2_1', 'DTC2_2', 'DTC2_3', 'DTC2_4'],
+                           'vor_names_name19' : ['DTC3_1', 'DTC3_2', 'DTC3_3', 'DTC3_4'],}
+                channels = None
+                try:
+                    for key, these in choices.items():
+                        if element in str(this.config('vor', key)):
+                            channels = these
+                            break
+                except KeyError:
+                    ## no vor configuration in the descriptor, use the first set of channels the run has
+                    columns = this.table().columns
+                    for these in choices.values():
+                        if all(c in columns for c in these):
+                            channels = these
+                            break
+                if channels is None:
                     print('cannot figure out fluorescence signal')
                     #print(f'vor:vor_names_name3 {}')
                     return()
-                mu = signal/i0
+                t = this.table(columns=['I0', 'dcm_energy'] + channels)
+                signal = t[channels[0]] + t[channels[1]] + t[channels[2]] + t[channels[3]]
+                mu = signal/t['I0']
+            en = numpy.array(t['dcm_energy'])
+            mu = numpy.array(mu)
         e,m = self.rationalize_mu(en, mu)
         if len(m) > self.GRIDSIZE:
             m = m[:-1]
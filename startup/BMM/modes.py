@@ -7,6 +7,7 @@ from BMM.functions     import countdown
 from BMM.suspenders    import BMM_clear_to_start
 from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
 from BMM.motor_status  import motor_status
+from BMM.preflight     import preflight, dryrun
 from BMM.derivedplot   import close_all_plots, close_last_plot, interpret_click
 
 
@@ -58,23 +59,22 @@ def change_mode(mode=None, prompt=True, edge=None, reference=None, bender=True):
     if mode not in ('A', 'B', 'C', 'D', 'E', 'F', 'XRD'):
         print('%s is not a mode' % mode)
         return(yield from null())
-    current_mode = get_mode()
 
-    if pds_motors_ready() is False:
-        print(error_msg('\nOne or more motors are showing amplifier faults.\nToggle the correct kill switch, then re-enable the faulted motor.'))
-        return(yield from null())
-    
     ######################################################################
     # this is a tool for verifying a macro.  this replaces an xafs scan  #
     # with a sleep, allowing the user to easily map out motor motions in #
     # a macro                                                            #
-    if BMMuser.macro_dryrun:
-        print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than changing to mode %s.\n' %
-                       (BMMuser.macro_sleep, mode)))
-        countdown(BMMuser.macro_sleep)
-        return(yield from null())
+    if BMMuser.macro_dryrun or preflight.active:
+        return(yield from dryrun('change_mode', 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than changing to mode %s.' %
+                                 (BMMuser.macro_sleep, mode), mode=mode, edge=edge, reference=reference))
     ######################################################################
 
+    current_mode = get_mode()
+
+    if pds_motors_ready() is False:
+        print(error_msg('\nOne or more motors are showing amplifier faults.\nToggle the correct kill switch, then re-enable the faulted motor.'))
+        return(yield from null())
+
     if mode == 'B':
         action = input("You are entering Mode B -- focused beam below 6 keV is not properly configured at BMM. Continue? [y/N then Enter] ")
         if action.lower() != 'y':
@@ -0,0 +1,241 @@
+from bluesky.plan_stubs import mv, trigger_and_read
+from bluesky.preprocessors import run_wrapper, stage_wrapper
+
+import numpy
+
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+from BMM.logging       import BMM_log_info
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Coarse-to-fine peak search                                            #
+#                                                                       #
+# rocking_curve, slit_height, center_sample_roll, and center_sample_y   #
+# look for one feature -- a peak or an edge -- with a fine, fixed grid, #
+# most of which is spent far from the feature.  PeakSearch measures a   #
+# coarse grid over the same range, then refines around the best coarse  #
+# point until the bracket around the feature is narrower than the step  #
+# of the fixed grid:                                                    #
+#                                                                       #
+#   peak:        alternating parabolic and golden-section steps in the  #
+#                bracket around the highest point                       #
+#   inflection:  bisection of the interval where the signal crosses     #
+#                halfway between its lowest and highest values          #
+#                                                                       #
+# Typically 15 to 25 points rather than 31, 61, or 101.  All points go  #
+# into one run, so the run is in the database like any other line scan  #
+# (but not in position order).  The peak, com, and fit choices work as  #
+# for the fixed grid, using all of the measured points.                 #
+#                                                                       #
+#    search = PeakSearch(-0.1, 0.1, 101)                                #
+#    uid = yield from peak_search([quadem1], dcm_pitch,                 #
+#                                 lambda r: r['I0'], search)            #
+#    top = search.best('peak')         # absolute position              #
+#########################################################################
+
+GOLDEN = 0.381966
+
+
+class PeakSearch():
+    '''Choose the points of a coarse-to-fine search.  See the comment above.
+
+      start, stop: range of the search, relative to the current position
+      nsteps:      number of steps of the equivalent fixed grid, which
+                   sets the precision
+      coarse:      number of points of the first pass
+      target:      'peak' or 'inflection'
+      maxpoints:   most points measured
+    '''
+    def __init__(self, start, stop, nsteps, coarse=11, target='peak', maxpoints=25):
+        self.start     = min(start, stop)
+        self.stop      = max(start, stop)
+        self.nsteps    = nsteps
+        self.tolerance = (self.stop - self.start) / max(nsteps-1, 1)
+        self.ncoarse   = coarse
+        self.target    = target
+        self.maxpoints = max(maxpoints, coarse)
+        self.origin    = 0
+        self.x, self.y = [], []
+        self.bracket   = None
+        self.parabolic = True
+
+    def __repr__(self):
+        return '<PeakSearch: %s, %d points measured>' % (self.target, len(self.x))
+
+    def coarse(self):
+        return list(numpy.linspace(self.start, self.stop, self.ncoarse))
+
+    def add(self, x, y):
+        self.x.append(float(x))
+        self.y.append(float(y))
+
+    def positions(self):
+        '''Absolute positions of the points measured, in position order.'''
+        return sorted(self.origin + x for x in self.x)
+
+    def _value(self, x):
+        return self.y[self.x.index(x)]
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## refinement
+    def _start_bracket(self):
+        x, y = numpy.array(self.x), numpy.array(self.y)
+        order = numpy.argsort(x)
+        x, y = x[order], y[order]
+        if self.target == 'inflection':
+            mid = (y.max() + y.min()) / 2
+            above = y >= mid
+            crossings = numpy.flatnonzero(above[:-1] != above[1:])
+            if len(crossings) == 0:
+                return None
+            ## the crossing with the largest change, should there be several
+            i = crossings[numpy.argmax(numpy.abs(y[crossings+1] - y[crossings]))]
+            return [x[i], x[i+1]]
+        i = int(numpy.argmax(y))
+        if i == 0 or i == len(x)-1:
+            return None         # at the end of the range, nothing to bracket
+        return [x[i-1], x[i], x[i+1]]
+
+    def next(self):
+        '''The next position to measure, or None when done.'''
+        if len(self.x) >= self.maxpoints:
+            return None
+        if self.bracket is None:
+            self.bracket = self._start_bracket()
+            if self.bracket is None:
+                return None
+        else:
+            self._update()
+        if self.bracket[-1] - self.bracket[0] <= self.tolerance:
+            return None
+        if self.target == 'inflection':
+            return (self.bracket[0] + self.bracket[1]) / 2
+        (a, b, c) = self.bracket
+        u = None
+        if self.parabolic:
+            u = _vertex(a, b, c, self._value(a), self._value(b), self._value(c))
+            if u is not None and (u <= a or u >= c or min(abs(u-a), abs(u-b), abs(u-c)) < self.tolerance/4):
+                u = None
+        self.parabolic = not self.parabolic
+        if u is None:
+            u = b + GOLDEN*(c-b) if c-b > b-a else b - GOLDEN*(b-a)
+        return u
+
+    def _update(self):
+        '''Shrink the bracket with the most recent point.'''
+        u, fu = self.x[-1], self.y[-1]
+        if self.target == 'inflection':
+            (a, c) = self.bracket
+            mid = (max(self.y) + min(self.y)) / 2
+            if (self._value(a) >= mid) == (fu >= mid):
+                self.bracket = [u, c]
+            else:
+                self.bracket = [a, u]
+            return
+        (a, b, c) = self.bracket
+        if fu > self._value(b):
+            self.bracket = [b, u, c] if u > b else [a, u, b]
+        else:
+            self.bracket = [a, b, u] if u > b else [u, b, c]
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## the answer
+    def best(self, choice='peak'):
+        '''The absolute position of the feature, by the same choices as the
+        fixed-grid scans: peak, com (center of mass), or fit (a skewed
+        Gaussian).  For an inflection search, choice is ignored.'''
+        x, y = numpy.array(self.x), numpy.array(self.y)
+        order = numpy.argsort(x)
+        x, y = x[order], y[order]
+        if self.target == 'inflection':
+            if self.bracket is None:
+                return self.origin + x[numpy.argmax(numpy.abs(numpy.diff(y)))]
+            (a, c) = self.bracket
+            mid = (y.max() + y.min()) / 2
+            (fa, fc) = self._value(a), self._value(c)
+            return self.origin + (a if fa == fc else a + (mid-fa)*(c-a)/(fc-fa))
+        if choice == 'com':
+            weight = numpy.gradient(x) * y
+            return self.origin + float((x*weight).sum() / weight.sum())
+        elif choice == 'fit':
+            from lmfit.models import SkewedGaussianModel
+            mod  = SkewedGaussianModel()
+            pars = mod.guess(y, x=x)
+            out  = mod.fit(y, pars, x=x)
+            print(whisper(out.fit_report(min_correl=0)))
+            out.plot()
+            return self.origin + out.params['center'].value
+        if self.bracket is not None:
+            (a, b, c) = self.bracket
+            u = _vertex(a, b, c, self._value(a), self._value(b), self._value(c))
+            if u is not None and a < u < c:
+                return self.origin + u
+        return self.origin + x[numpy.argmax(y)]
+
+    def simulate(self, profile):
+        '''Run the search against a function of the relative position,
+        returning the relative positions measured.'''
+        for x in self.coarse():
+            self.add(x, profile(x))
+        while True:
+            x = self.next()
+            if x is None:
+                break
+            self.add(x, profile(x))
+        return list(self.x)
+
+
+def _vertex(a, b, c, fa, fb, fc):
+    '''The vertex of the parabola through three points, or None.'''
+    denominator = (b-a)*(fb-fc) - (b-c)*(fb-fa)
+    if denominator == 0:
+        return None
+    return b - 0.5*((b-a)**2*(fb-fc) - (b-c)**2*(fb-fa)) / denominator
+
+
+def peak_search(detectors, motor, func, search, md=None):
+    '''Measure a PeakSearch in one run.  See the comment above.
+
+      detectors: list of detectors
+      motor:     the positioner
+      func:      computes the signal from a dict of readings (data key -> value)
+      search:    a PeakSearch
+      md:        metadata
+
+    Return the uid of the run.
+    '''
+    search.origin = motor.position
+    ## no num_points, as for bluesky's adaptive_scan -- the number of
+    ## points is not known until the search is done, the stop document's
+    ## num_events has the number measured
+    _md = {'detectors':  [d.name for d in detectors],
+           'motors':     [motor.name],
+           'plan_name':  'peak_search',
+           'plan_args':  {'detectors': list(map(repr, detectors)), 'motor': repr(motor),
+                          'start': search.start, 'stop': search.stop, 'nsteps': search.nsteps, 'target': search.target},
+           'hints':      {'dimensions': [([motor.name], 'primary')]},
+    }
+    _md.update(md or {})
+
+    def measure(x):
+        yield from mv(motor, search.origin + x)
+        reading = yield from trigger_and_read(list(detectors) + [motor])
+        search.add(x, func({k: v['value'] for k,v in reading.items()}))
+
+    def inner():
+        for x in search.coarse():
+            yield from measure(x)
+        while True:
+            x = search.next()
+            if x is None:
+                break
+            yield from measure(x)
+
+    uid = yield from stage_wrapper(run_wrapper(inner(), md=_md), list(detectors) + [motor])
+    text = 'peak search on %s: %d points rather than %d' % (motor.name, len(search.x), search.nsteps)
+    print(whisper(text))
+    BMM_log_info(text)
+    return uid
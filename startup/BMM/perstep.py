@@ -0,0 +1,182 @@
+from bluesky.plan_stubs import checkpoint, trigger, wait, create, read, save, trigger_and_read
+from bluesky.preprocessors import plan_mutator
+from bluesky.utils import Msg, short_uid, separate_devices
+
+import numpy, time
+
+from BMM.flyscan       import BinnedReadings
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+from BMM.logging       import BMM_log_info
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# A fused per-step for XAFS step scans                                  #
+#                                                                       #
+# The stock one_nd_step moves, waits, triggers, waits, reads, and       #
+# saves, strictly in that order.  FusedStep does the same things, but   #
+#   1. the move to the next point is started as soon as the current     #
+#      point has been read -- the event is saved (and all the           #
+#      callbacks run: plots, XDI writer, run cache) while the mono is   #
+#      already moving,                                                  #
+#   2. a dwell time which is unchanged from the previous point (within  #
+#      a tolerance) is not written to the LockedDwellTimes positioners, #
+#   3. motion, integration, readout, and bookkeeping are timed at each  #
+#      point.                                                           #
+#                                                                       #
+# The timing summary is recorded as one event in a "timing" stream at   #
+# the end of the run.  The dead-time profiler (BMM/profiler.py) sorts   #
+# the time of other plans into the same phases and records it in the    #
+# same stream:                                                          #
+#                                                                       #
+#    fused = FusedStep(energy_trajectory + dwelltime_trajectory,        #
+#                      dwell=dwell_time)                                #
+#    uid = yield from with_step_timing(scan_nd(dets, trajectory,        #
+#                                              per_step=fused), fused)  #
+#########################################################################
+
+PHASES = ('motion', 'settle', 'integration', 'readout', 'bookkeeping')    # FusedStep does not settle
+
+
+class FusedStep():
+    '''A per_step for scan_nd.  See the comment above.
+
+      trajectory: the cycler given to scan_nd
+      dwell:      the dwell time axis (dwell_time), if any
+      tolerance:  dwell times closer than this are considered unchanged
+    '''
+    def __init__(self, trajectory, dwell=None, tolerance=1e-4):
+        self.points    = list(trajectory)
+        self.dwell     = dwell
+        self.tolerance = tolerance
+        self.index     = 0
+        self.pending   = None
+        self.t_end     = None
+        self.phases    = {p: [] for p in PHASES}
+        self.requested = []
+        self.total     = []
+        self.dwell_sets  = 0
+        self.dwell_skips = 0
+
+    def _unchanged(self, motor, previous, pos):
+        if previous is None:
+            return False
+        if motor is self.dwell:
+            return abs(previous - pos) < self.tolerance
+        return previous == pos
+
+    def _set(self, step, pos_cache, group):
+        for motor, pos in step.items():
+            if self._unchanged(motor, pos_cache[motor], pos):
+                if motor is self.dwell:
+                    self.dwell_skips += 1
+                continue
+            if motor is self.dwell:
+                self.dwell_sets += 1
+            yield Msg('set', motor, pos, group=group)
+            pos_cache[motor] = pos
+
+    def __call__(self, detectors, step, pos_cache):
+        t0 = time.monotonic()
+        yield from checkpoint()
+
+        ## motion: this point's move may already be underway
+        group = self.pending or short_uid('set')
+        yield from self._set(step, pos_cache, group)
+        yield Msg('wait', None, group=group)
+        self.pending = None
+        t1 = time.monotonic()
+
+        ## integration
+        devices = separate_devices(list(detectors) + list(step.keys()))
+        yield from self.integrate(detectors, devices)
+        t2 = time.monotonic()
+
+        ## readout
+        yield from self.readout(detectors, devices)
+        t3 = time.monotonic()
+
+        ## start toward the next point, then emit the event
+        self.index += 1
+        if self.index < len(self.points):
+            self.pending = short_uid('set')
+            yield from self._set(self.points[self.index], pos_cache, self.pending)
+        yield from save()
+        t4 = time.monotonic()
+
+        bookkeeping = t4 - t3
+        if self.t_end is not None:
+            bookkeeping += t0 - self.t_end
+        self.t_end = t4
+        self.phases['motion'].append(t1-t0)
+        self.phases['integration'].append(t2-t1)
+        self.phases['readout'].append(t3-t2)
+        self.phases['bookkeeping'].append(bookkeeping)
+        self.total.append(t1 - t0 + t2 - t1 + t3 - t2 + bookkeeping)
+        if self.dwell is not None and self.dwell in step:
+            self.requested.append(self.dwell_of(step))
+
+    def integrate(self, detectors, devices):
+        '''Trigger everything which can be triggered and wait.'''
+        group = short_uid('trigger')
+        for obj in devices:
+            if hasattr(obj, 'trigger'):
+                yield from trigger(obj, group=group)
+        yield from wait(group=group)
+
+    def readout(self, detectors, devices):
+        '''Read everything into one event of the primary stream.'''
+        yield from create('primary')
+        for obj in devices:
+            yield from read(obj)
+
+    def dwell_of(self, step):
+        '''The dwell time of the point just measured.'''
+        return step[self.dwell]
+
+    def summary(self):
+        '''Return a dict of mean phase times, the mean time per point, and
+        the mean overhead per point (time per point minus dwell time).'''
+        n = len(self.total)
+        result = {'points': n, 'dwell_sets': self.dwell_sets, 'dwell_skips': self.dwell_skips}
+        for p in PHASES:
+            result[p] = float(numpy.mean(self.phases[p])) if len(self.phases[p]) else 0.0
+        result['per_point'] = float(numpy.mean(self.total)) if n else 0.0
+        dwell = float(numpy.mean(self.requested)) if len(self.requested) else result['integration']
+        result['overhead'] = result['per_point'] - dwell
+        return result
+
+    def report(self):
+        s = self.summary()
+        text = '  %d points, %.3f s/point, overhead %.3f s/point (motion %.3f, integration %.3f, readout %.3f, bookkeeping %.3f), dwell time written %d times, skipped %d times' % \
+            (s['points'], s['per_point'], s['overhead'], s['motion'], s['integration'], s['readout'], s['bookkeeping'], s['dwell_sets'], s['dwell_skips'])
+        print(whisper(text))
+        return text
+
+
+def record_timing(values):
+    '''Plan: record a dict of timing values as one event in the
+    "timing" stream of the open run.'''
+    timing = BinnedReadings(name='timing')
+    timing.describe_from([], extra=list(values.keys()))
+    timing.load(values)
+    return (yield from trigger_and_read([timing], name='timing'))
+
+
+def with_step_timing(plan, fused):
+    '''Run plan (a scan_nd using fused as its per_step), inserting an
+    event with the FusedStep timing summary into a "timing" stream just
+    before the run is closed.  A run which failed or was aborted gets
+    no timing event.'''
+    def insert_summary(msg):
+        if msg.command != 'close_run':
+            return None, None
+        def summary_then_close():
+            if len(fused.total) > 0 and (msg.kwargs.get('exit_status') or 'success') == 'success':
+                yield from record_timing(fused.summary())
+                BMM_log_info(fused.report())
+            return (yield msg)
+        return summary_then_close(), None
+    return (yield from plan_mutator(plan, insert_summary))
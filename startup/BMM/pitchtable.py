@@ -0,0 +1,178 @@
+import numpy, os, json, time
+
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+from BMM.logging       import BMM_log_info
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# A table of optimized DCM pitch and slit height positions              #
+#                                                                       #
+# Every rocking curve finds the best dcm_pitch at a known energy,       #
+# crystal, and photon delivery mode and every slit height scan finds    #
+# the best dm3_bct.  Those results are kept here, in a JSON file, and   #
+# used by change_edge to predict the optimum at a new energy.  For      #
+# each kind of measurement, crystal, and mode,                          #
+#                                                                       #
+#     position = a * energy + b                                         #
+#                                                                       #
+# is fit to the recent results, more recent ones weighted more.  With   #
+# only one recent result, the slope of the fallback (for the pitch,     #
+# approximate_pitch) is used through that point.                        #
+#                                                                       #
+# Drift: a new result farther than TOLERANCE from the prediction        #
+# retires the older results for its crystal and mode, since the         #
+# optimum has moved (a thermal change, a realignment, ...).             #
+#                                                                       #
+# The prediction is "fresh" when the newest result is less than FRESH   #
+# old and was measured within NEAR eV of the new energy.  In that case, #
+# change_edge does a short verification scan rather than a full one.    #
+#                                                                       #
+#    pitch_table.predict('pitch', 8979)  -->  (position, fresh)         #
+#    pitch_table.show()                                                 #
+#########################################################################
+
+TABLE_FILE = '/home/xf06bm/Data/.pitch_table.json'
+HISTORY    = 30*86400        # results older than this are not used
+TAU        = 3*86400         # weight of a result is exp(-age/TAU)
+FRESH      = 2*86400
+NEAR       = 3000
+TOLERANCE  = {'pitch': 0.004, 'slit': 0.15}   # degrees of dcm_pitch, mm of dm3_bct
+MOTORS     = {'pitch': 'dcm_pitch', 'slit': 'dm3_bct'}
+VERIFY     = {'pitch': (-0.025, 0.025, 21), 'slit': (-0.5, 0.5, 11)}   # (start, stop, nsteps) of a verification scan
+
+
+class PitchTable():
+    '''See the comment above.
+
+    attributes:
+      filename: the JSON file holding the results
+      rows:     list of results, each a dict with time, kind, crystal,
+                mode, energy, position, and stale
+      boundary: True if the most recent scan found its optimum at the
+                end of its range (so it was not recorded)
+    '''
+    def __init__(self, filename=TABLE_FILE):
+        self.filename = filename
+        self.rows     = list()
+        self.boundary = False
+        self.load()
+
+    def __repr__(self):
+        return '<PitchTable: %d results>' % len(self.rows)
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                self.rows = json.load(f)
+        except Exception as e:
+            print(warning_msg('could not read pitch table %s: %s' % (self.filename, e)))
+
+    def save(self):
+        try:
+            with open(self.filename + '.part', 'w') as f:
+                json.dump(self.rows, f)
+            os.replace(self.filename + '.part', self.filename)
+        except Exception as e:
+            print(warning_msg('could not write pitch table %s: %s' % (self.filename, e)))
+
+    def _configuration(self, crystal=None, mode=None):
+        if crystal is None:
+            crystal = user_ns['dcm']._crystal
+        if mode is None:
+            mode = user_ns['BMMuser'].pds_mode
+        return crystal, mode
+
+    def _rows(self, kind, crystal, mode):
+        now = time.time()
+        return [r for r in self.rows if r['kind'] == kind and r['crystal'] == crystal and r['mode'] == mode
+                and not r['stale'] and now - r['time'] < HISTORY]
+
+    def _predict(self, rows, energy, fallback=None):
+        if len(rows) == 0:
+            return None
+        now = time.time()
+        e = numpy.array([r['energy'] for r in rows])
+        y = numpy.array([r['position'] for r in rows])
+        w = numpy.exp(-(now - numpy.array([r['time'] for r in rows])) / TAU)
+        if numpy.ptp(e) > 100:
+            (a, b) = numpy.polyfit(e, y, 1, w=numpy.sqrt(w))
+            return a*energy + b
+        newest = rows[int(numpy.argmax([r['time'] for r in rows]))]
+        if fallback is not None:
+            return newest['position'] + fallback(energy) - fallback(newest['energy'])
+        return newest['position']
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## filling the table
+    def record(self, kind, energy, position, crystal=None, mode=None):
+        '''Add the result of a rocking curve (kind='pitch') or a slit height
+        scan (kind='slit'), checking it against the current prediction.'''
+        crystal, mode = self._configuration(crystal, mode)
+        if mode is None:
+            return
+        rows = self._rows(kind, crystal, mode)
+        ## without a slope, only a result at nearly the same energy is a fair comparison
+        if len(rows) == 0 or numpy.ptp([r['energy'] for r in rows]) <= 100:
+            expected = self._predict([r for r in rows if abs(r['energy'] - energy) < 200], energy)
+        else:
+            expected = self._predict(rows, energy)
+        if expected is not None and abs(position - expected) > TOLERANCE[kind]:
+            text = '%s at %.1f eV (Si(%s), mode %s) is %.4f, the table expected %.4f: retiring %d older results' % \
+                (MOTORS[kind], energy, crystal, mode, position, expected, len(rows))
+            print(warning_msg(text))
+            BMM_log_info('pitch table drift: ' + text)
+            for r in rows:
+                r['stale'] = True
+        self.rows.append({'time': time.time(), 'kind': kind, 'crystal': crystal, 'mode': mode,
+                          'energy': float(energy), 'position': float(position), 'stale': False})
+        self.save()
+
+    def scanned(self, kind, energy, positions, top):
+        '''Record the optimum from a scan over positions, unless it is at
+        either end of the scan, in which case it is probably not the
+        optimum at all.'''
+        positions = numpy.asarray(positions, dtype=float)
+        step = abs(numpy.median(numpy.diff(positions))) if len(positions) > 1 else 0
+        self.boundary = bool(top <= positions.min() + step/2 or top >= positions.max() - step/2)
+        if self.boundary:
+            print(warning_msg('the optimum %s is at the end of the scan, not recording it in the pitch table' % MOTORS[kind]))
+            return
+        self.record(kind, energy, top)
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## using the table
+    def predict(self, kind, energy, fallback=None, crystal=None, mode=None):
+        '''Return (position, fresh) for a kind of optimization at an
+        energy.  position is from fallback (a function of energy) or is
+        None when the table has nothing to offer.'''
+        crystal, mode = self._configuration(crystal, mode)
+        rows = self._rows(kind, crystal, mode)
+        position = self._predict(rows, energy, fallback)
+        if position is None:
+            return (fallback(energy) if fallback is not None else None), False
+        newest = max(rows, key=lambda r: r['time'])
+        fresh = time.time() - newest['time'] < FRESH and min(abs(r['energy'] - energy) for r in rows) < NEAR
+        return float(position), bool(fresh)
+
+    def show(self):
+        now = time.time()
+        groups = dict()
+        for r in self.rows:
+            if not r['stale'] and now - r['time'] < HISTORY:
+                groups.setdefault((r['kind'], r['crystal'], r['mode']), []).append(r)
+        if len(groups) == 0:
+            print(warning_msg('The pitch table has no recent results.'))
+            return
+        for (kind, crystal, mode), rows in sorted(groups.items()):
+            newest = max(r['time'] for r in rows)
+            print(bold_msg('%-5s Si(%s) mode %s: %d results, newest %.1f hours old' % (kind, crystal, mode, len(rows), (now-newest)/3600)))
+            for r in sorted(rows, key=lambda r: r['energy']):
+                print('    %8.1f eV   %9.4f' % (r['energy'], r['position']))
+
+
+pitch_table = PitchTable()
@@ -0,0 +1,147 @@
+from bluesky.plan_stubs import sleep, null
+
+import threading, traceback, time, os
+from concurrent.futures import ThreadPoolExecutor
+
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+from BMM.logging       import BMM_log_info, report
+from BMM.merge         import merge
+from BMM.quadplot      import quadplot
+from BMM.runcache      import runcache
+from BMM.xdi           import write_XDI, xdi_complete
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+class PostScanPipeline():
+    '''A small pool of worker threads for the bookkeeping which follows
+    a scan -- logging, data evaluation, Slack notifications, and the
+    like -- so that the next scan in a sequence can start right away.
+
+    Work is handed to the pool from within a plan:
+
+       yield from postscan.queue_plan('evaluation of %s' % datafile, xafs_postscan, uid, datafile, mode)
+
+    queue_plan waits (without blocking the RunEngine) if the queue is
+    already depth jobs deep.  Errors raised by jobs are collected and
+    reported the next time a job is queued and when the pipeline is
+    flushed:
+
+       yield from postscan.flush_plan()
+
+    flush_plan waits for every outstanding job to finish.  It belongs
+    in the cleanup plan of any plan which queues jobs.
+
+    attributes:
+      workers:  number of worker threads
+      depth:    maximum number of jobs queued or running at once
+      jobs:     list of (description, future) for outstanding jobs
+      errors:   list of (description, traceback text) not yet reported
+    '''
+    def __init__(self, workers=2, depth=4):
+        self.workers  = workers
+        self.depth    = depth
+        self.jobs     = []
+        self.errors   = []
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='BMM-postscan')
+        self.lock     = threading.Lock()
+
+    def __repr__(self):
+        return '<PostScanPipeline: %d workers, %d of %d jobs outstanding>' % (self.workers, len(self.outstanding()), self.depth)
+
+    def _done(self, description, future):
+        error = future.exception()
+        if error is not None:
+            text = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+            with self.lock:
+                self.errors.append((description, text))
+
+    def outstanding(self):
+        with self.lock:
+            self.jobs = [(d,f) for (d,f) in self.jobs if not f.done()]
+            return list(self.jobs)
+
+    def submit(self, description, func, *args, **kwargs):
+        '''Hand a job to the pool immediately, regardless of queue depth.
+        Return the Future.'''
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda f: self._done(description, f))
+        with self.lock:
+            self.jobs.append((description, future))
+        return future
+
+    def report_errors(self):
+        '''Report and forget any errors from finished jobs.  Return the
+        number of errors reported.'''
+        with self.lock:
+            errors, self.errors = self.errors, []
+        for (description, text) in errors:
+            report(f'post-scan job failed: {description}', level='error', slack=True)
+            print(error_msg(text))
+            BMM_log_info(f'post-scan job failed: {description}\n{text}')
+        return len(errors)
+
+    def queue_plan(self, description, func, *args, **kwargs):
+        '''Plan: wait for room in the queue, then submit a job.'''
+        self.report_errors()
+        waited = False
+        while len(self.outstanding()) >= self.depth:
+            if not waited:
+                print(whisper('  waiting for post-scan jobs to catch up'))
+                waited = True
+            yield from sleep(0.1)
+        self.submit(description, func, *args, **kwargs)
+        yield from null()
+
+    def flush_plan(self, timeout=None):
+        '''Plan: wait for all outstanding jobs to finish, then report any errors.'''
+        start = time.time()
+        if len(self.outstanding()) > 0:
+            print(whisper('  finishing %d post-scan job(s)' % len(self.outstanding())))
+        while len(self.outstanding()) > 0:
+            if timeout is not None and time.time() - start > timeout:
+                print(warning_msg('post-scan jobs still running after %.0f seconds: %s' %
+                                  (timeout, ', '.join(d for (d,f) in self.outstanding()))))
+                break
+            yield from sleep(0.1)
+        self.report_errors()
+
+    def flush(self):
+        '''Command line version of flush_plan.'''
+        for (d,f) in self.outstanding():
+            try:
+                f.result()
+            except Exception:
+                pass
+        self.report_errors()
+
+
+postscan = PostScanPipeline()
+
+
+def xafs_postscan(uid, datafile, mode):
+    '''The work which follows each repetition of an XAFS scan sequence:
+    log the XDI file (which was written by an XDIFileWriter during the
+    scan, or is written here from the run cache if that failed),
+    evaluate the data, and post the result to Slack.  This is run by a
+    PostScanPipeline worker.'''
+    header = runcache[uid]
+    if not xdi_complete(datafile, header):
+        print(warning_msg(f'{datafile} is missing or incomplete, writing it from the run cache'))
+        write_XDI(datafile, header)
+    BMM_log_info(f'energy scan finished, uid = {uid}, scan_id = {header.start["scan_id"]}\ndata file written to {datafile}')
+
+    if any(md in mode for md in ('trans', 'fluo', 'flou', 'both', 'ref', 'xs')):
+        score, emoji = user_ns['clf'].evaluate(uid, mode=mode)
+        report(f"Data evaluation: {score} {emoji}", level='bold', slack=True)
+
+
+def sequence_postscan(folder, name, base, start, end, bounds, mode):
+    '''The work which follows an XAFS scan sequence: merge the
+    repetitions, writing base-merge.xdi, and make the dossier quad plot
+    from the merge.  This is run by a PostScanPipeline worker.'''
+    merged = merge(name, start, end, folder=folder, filename=os.path.join(folder, base+'-merge.xdi'), quiet=True)
+    if merged is None:
+        return
+    quadplot(folder=folder, name=name, base=base, start=start, end=end, bounds=bounds, mode=mode, merged=merged)
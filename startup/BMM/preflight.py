@@ -0,0 +1,751 @@
+from bluesky.plan_stubs import null, sleep, mv, abs_set
+from bluesky.utils import Msg, short_uid
+from ophyd.sim import SynAxis, SynSignal, NullStatus
+
+import numpy, os, json, time, datetime
+from math import asin, pi, sqrt
+
+from BMM.functions     import HBARC, countdown, error_msg, warning_msg, info_msg, bold_msg, whisper
+from BMM.peaksearch    import PeakSearch
+from BMM.periodictable import edge_energy
+from BMM.pitchtable    import pitch_table, VERIFY
+from BMM.profiler      import CATEGORIES
+from BMM.wheel         import WheelMotor
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Macro preflight on a simulated beamline                               #
+#                                                                       #
+# BMMuser.macro_dryrun replaces each scan and each configuration        #
+# change with a fixed countdown, which shows that a macro runs, but not #
+# how long it will take.  preflight runs a macro against simulated      #
+# stand-ins for the mono, the mirrors and table, the sample and         #
+# reference wheels, the sample stages, slits3, and the detectors, on a  #
+# virtual clock.  Nothing is sent to EPICS.                             #
+#                                                                       #
+#    preflight(mymacro_macro())                                         #
+#                                                                       #
+# The plan is executed message by message, as the RunEngine would:      #
+#   set:     a trapezoidal move using the motor's velocity and          #
+#            acceleration time, from the position the simulated motor   #
+#            was left in (all moves in a group run concurrently)        #
+#   trigger: the current dwell time                                     #
+#   sleep:   the requested time                                         #
+#   read, save: small fixed readout and bookkeeping times               #
+# xafs() is replaced by the scan time estimator's prediction for its    #
+# INI file.  change_edge(), change_mode(), rocking_curve(),             #
+# slit_height(), linescan(), and areascan() are replaced by the         #
+# motions and scans they would do on the simulated devices.             #
+#                                                                       #
+# The report gives the predicted wall time, the time of each step of    #
+# the macro sorted into the dead-time profiler's categories, and the    #
+# travel of each motor.                                                 #
+#                                                                       #
+# Velocities and acceleration times come from a JSON file written by    #
+# preflight.calibrate(), which reads them from the real motors (this    #
+# does use EPICS, so do it at the beamline once in a while), or from    #
+# DEFAULT_MOTION.  A motor starts where it was left by the most recent  #
+# change_mode, or, for the sample wheel, at slot 1 (where every macro   #
+# leaves it).  Others start from preflight.start (a dict of name ->     #
+# position), or at their first target, in which case the first move is #
+# free and is flagged in the report.                                    #
+#########################################################################
+
+MOTION_FILE = '/home/xf06bm/Data/.preflight_motion.json'
+
+## name -> (velocity in units/s, acceleration time in s), used when not calibrated
+DEFAULT_MOTION = {'dcm_bragg':   (0.5,  0.5),
+                  'dcm_pitch':   (0.05, 0.5),
+                  'dm3_bct':     (0.4,  0.5),
+                  'm2_yu':       (0.4,  1.0),  'm2_ydo':     (0.4,  1.0),  'm2_ydi':     (0.4,  1.0),
+                  'm2_bender':   (5000, 1.0),
+                  'm3_yu':       (0.4,  1.0),  'm3_ydo':     (0.4,  1.0),  'm3_ydi':     (0.4,  1.0),
+                  'm3_xu':       (0.4,  1.0),  'm3_xd':      (0.4,  1.0),
+                  'xafs_yu':     (2.0,  0.5),  'xafs_ydo':   (2.0,  0.5),  'xafs_ydi':   (2.0,  0.5),
+                  'xafs_wheel':  (10.0, 0.5),
+                  'xafs_ref':    (10.0, 0.5),
+                  'xafs_linx':   (5.0,  0.2),  'xafs_liny':  (5.0,  0.2),
+                  'slits3_hsize': (0.5, 0.2),  'slits3_vsize': (0.5, 0.2),
+}
+DEFAULT_VELOCITY = (1.0, 0.5)
+
+MOVE_OVERHEAD    = 0.5    # motor record start up and done callback, per move
+TRIGGER_OVERHEAD = 0.05   # beyond the dwell time, per trigger
+READOUT          = 0.02   # per device read
+EVENT            = 0.1    # per event: callbacks, plots, files
+RUN              = 2.0    # per run: start and stop documents, plot windows
+SHUTTER          = 3.0    # to open or close the photon shutter
+
+## user_ns paths of the motors replaced by simulated motors
+MOTORS = ('dcm_pitch', 'dm3_bct', 'm2_bender',
+          'm2_yu', 'm2_ydo', 'm2_ydi',
+          'm3_yu', 'm3_ydo', 'm3_ydi', 'm3_xu', 'm3_xd',
+          'xafs_yu', 'xafs_ydo', 'xafs_ydi',
+          'xafs_x', 'xafs_y', 'slits3.hsize', 'slits3.vsize')
+DETECTORS = ('quadem1', 'vor', 'xs')
+
+
+def travel_time(distance, velocity, acceleration):
+    '''Time of a trapezoidal move (a triangular one if the motor never
+    reaches full speed), plus the per-move overhead.'''
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    if distance >= velocity*acceleration:
+        return distance/velocity + acceleration + MOVE_OVERHEAD
+    return 2*sqrt(distance*acceleration/velocity) + MOVE_OVERHEAD
+
+
+def hms(seconds):
+    (h, rest) = divmod(int(round(seconds)), 3600)
+    (m, s)    = divmod(rest, 60)
+    return '%02d:%02d:%02d' % (h, m, s)
+
+
+def _resolve(path):
+    '''The object at a dotted path in user_ns, or None.'''
+    parts = path.split('.')
+    obj = user_ns.get(parts[0])
+    for p in parts[1:]:
+        if obj is None:
+            return None
+        obj = getattr(obj, p, None)
+    return obj
+
+
+## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+## simulated devices
+class SimMotor(SynAxis):
+    '''A simulated motor which knows how long its moves take.  position
+    is None when the starting position is unknown.'''
+    def __init__(self, name, position=None, velocity=1.0, acceleration=0.5, **kwargs):
+        super().__init__(name=name, value=0 if position is None else position, delay=0, **kwargs)
+        self.known  = position is not None
+        self.motion = (velocity, acceleration)
+
+    @property
+    def user_readback(self):
+        return self.readback
+
+    def move_time(self, target):
+        if not self.known:
+            return 0.0
+        return travel_time(target - self.readback.get(), *self.motion)
+
+
+class SimEnergy(SimMotor):
+    '''The mono energy, which moves at the speed of the Bragg axis.'''
+    def __init__(self, name, twod, **kwargs):
+        super().__init__(name, **kwargs)
+        self.twod = twod
+
+    def bragg(self, energy):
+        return 180 * asin(2*pi*HBARC / (energy*self.twod)) / pi
+
+    def move_time(self, target):
+        if not self.known:
+            return 0.0
+        return travel_time(self.bragg(target) - self.bragg(self.readback.get()), *self.motion)
+
+
+class SimWheel(SimMotor):
+    '''A sample wheel, with the slot arithmetic of WheelMotor.'''
+    current_slot       = WheelMotor.current_slot
+    angle_from_current = WheelMotor.angle_from_current
+    slot_number        = WheelMotor.slot_number
+    position_of_slot   = WheelMotor.position_of_slot
+
+    def __init__(self, name, slotone=0, content=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.slotone = slotone
+        self.content = content or [None]*24
+
+    def angle_of_slot(self, n):
+        return self.slotone - 15*(n-1)
+
+    def set_slot(self, n):
+        if type(n) is not int or n < 1 or n > 24:
+            print(error_msg('Slots are numbered from 1 to 24 (argument was %s)' % n))
+            return(yield from null())
+        yield from mv(self, self.readback.get() + self.angle_from_current(n))
+
+    def reset(self):
+        yield from mv(self, self.slotone)
+
+
+class SimDwell(SynAxis):
+    '''The dwell time.  The executor counts integration at this value.'''
+    is_dwell = True
+    def __init__(self, name='dwti_dwell_time', value=0.5):
+        super().__init__(name=name, value=value, delay=0)
+
+
+class SimDetector(SynSignal):
+    '''A detector which reads a constant.'''
+    def __init__(self, name):
+        super().__init__(func=lambda: 1.0, name=name)
+
+    def on_plan(self):
+        yield from null()
+
+    def off_plan(self):
+        yield from null()
+
+
+class SimGroup():
+    '''A mirror, the table, or slits3: a bundle of simulated motors.'''
+    def __init__(self, name, **motors):
+        self.name = name
+        for k, v in motors.items():
+            setattr(self, k, v)
+
+    def kill_jacks(self):
+        yield from null()
+
+
+class SimDCM():
+    def __init__(self, energy, crystal):
+        self.energy   = energy
+        self._crystal = crystal
+        self.mode     = 'fixed'
+        self.name     = 'dcm'
+
+    def kill_plan(self):
+        yield from null()
+
+
+class SimShutter():
+    def __init__(self, name):
+        self.name = name
+
+    def open_plan(self):
+        yield from sleep(SHUTTER)
+
+    def close_plan(self):
+        yield from sleep(SHUTTER)
+
+
+## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+## standing in for the real things when BMMuser.macro_dryrun is True
+def dryrun(kind, text, **kwargs):
+    '''Replace a plan when BMMuser.macro_dryrun is True or a preflight is
+    running.  In a preflight, simulate what the plan would do.
+    Otherwise print text and sleep for BMMuser.macro_sleep seconds.'''
+    if preflight.active:
+        return (yield from preflight.stand_in(kind, **kwargs))
+    print(info_msg('\n' + text + '\n'))
+    countdown(user_ns['BMMuser'].macro_sleep)
+    return (yield from null())
+
+
+class Preflight():
+    '''Run a macro on a simulated beamline with a virtual clock.  See the
+    comment above.
+
+      preflight(mymacro_macro())       # simulate and report
+      preflight.calibrate()            # read velocities from the real motors
+      preflight.start = {'xafs_linx': 12.5}
+
+    attributes:
+      active:  True while a preflight is running
+      motion:  motor name -> (velocity, acceleration time)
+      start:   motor name -> starting position
+      summary: the dict returned by the most recent preflight
+    '''
+    def __init__(self, filename=MOTION_FILE):
+        self.filename = filename
+        self.active   = False
+        self.motion   = dict(DEFAULT_MOTION)
+        self.start    = dict()
+        self.summary  = None
+        self.load()
+        self._reset()
+
+    def __repr__(self):
+        return '<Preflight: %d motion models>' % len(self.motion)
+
+    def _reset(self):
+        self.clock     = 0.0
+        self.groups    = dict()   # group -> (category, completion time)
+        self.steps     = list()
+        self.step      = None
+        self.depth     = 0
+        self.last      = None
+        self.dwell     = 0.5
+        self.travel    = dict()
+        self.unknown   = set()
+        self.ignored   = set()
+        self.standins  = dict()
+        self.simulated = dict()   # id of a real object -> its stand-in
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                self.motion.update({k: tuple(v) for k,v in json.load(f).items()})
+        except Exception as e:
+            print(warning_msg('could not read motion models %s: %s' % (self.filename, e)))
+
+    def calibrate(self):
+        '''Read velocity and acceleration time from the real motors and
+        save them for the next preflight.  This uses EPICS.'''
+        found = dict()
+        for path in MOTORS + ('dcm_bragg', 'xafs_wheel', 'xafs_ref'):
+            m = _resolve(path)
+            if m is None or not hasattr(m, 'velocity'):
+                continue
+            try:
+                found[m.name] = (float(m.velocity.get()), float(m.acceleration.get()))
+            except Exception as e:
+                print(warning_msg('could not read the velocity of %s: %s' % (path, e)))
+        self.motion.update(found)
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump(self.motion, f, indent=2)
+        except Exception as e:
+            print(warning_msg('could not write motion models %s: %s' % (self.filename, e)))
+        for k in sorted(found):
+            print('  %-14s velocity %9.4f   acceleration %6.3f s' % (k, *found[k]))
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## building the simulated beamline
+    def _motor(self, path, cls=SimMotor, **kwargs):
+        real = _resolve(path)
+        name = getattr(real, 'name', path.replace('.', '_'))
+        position = self.start.get(name, kwargs.pop('position', None))
+        sim = cls(name, position=position, velocity=self.motion.get(name, DEFAULT_VELOCITY)[0],
+                  acceleration=self.motion.get(name, DEFAULT_VELOCITY)[1], **kwargs)
+        if real is not None:
+            self.simulated[id(real)] = sim
+        return sim
+
+    def _build(self):
+        BMMuser, dcm = user_ns['BMMuser'], user_ns['dcm']
+        modedata = _modedata()
+        mode = BMMuser.pds_mode
+        def at_mode(key):
+            try:
+                return float(modedata[key][mode])
+            except (KeyError, TypeError):
+                return None
+
+        motors = dict()
+        for path in MOTORS:
+            motors[path] = self._motor(path, position=at_mode(path))
+        bragg = self.motion.get(getattr(user_ns.get('dcm_bragg'), 'name', 'dcm_bragg'), DEFAULT_VELOCITY)
+        energy = SimEnergy('dcm_energy', dcm._twod, position=getattr(BMMuser, 'edge_energy', None),
+                           velocity=bragg[0], acceleration=bragg[1])
+        self.simulated[id(dcm.energy)] = energy
+        ns = {'dcm': SimDCM(energy, dcm._crystal)}
+        self.simulated[id(dcm)] = ns['dcm']
+        for w in ('xafs_wheel', 'xafs_ref'):
+            real = _resolve(w)
+            slotone, content = getattr(real, 'slotone', 0), getattr(real, 'content', None)
+            position = slotone if w == 'xafs_wheel' else None
+            if w == 'xafs_ref' and content is not None and BMMuser.element in content:
+                position = slotone - 15*content.index(BMMuser.element)
+            ns[w] = self._motor(w, cls=SimWheel, slotone=slotone, content=content, position=position)
+        for path in MOTORS:
+            if '.' not in path:
+                ns[path] = motors[path]
+        for group, prefix, axes in (('m2',         'm2_',     ('yu', 'ydo', 'ydi')),
+                                    ('m3',         'm3_',     ('yu', 'ydo', 'ydi', 'xu', 'xd')),
+                                    ('xafs_table', 'xafs_',   ('yu', 'ydo', 'ydi')),
+                                    ('slits3',     'slits3.', ('hsize', 'vsize'))):
+            ns[group] = SimGroup(group, **{a: motors[prefix + a] for a in axes})
+            if group in user_ns:
+                self.simulated[id(user_ns[group])] = ns[group]
+                for a in axes:
+                    real = getattr(user_ns[group], a, None)
+                    if real is not None:
+                        self.simulated[id(real)] = motors[prefix + a]
+        dwell = SimDwell()
+        ns['dwell_time'] = ns['_locked_dwell_time'] = dwell
+        for d in DETECTORS:
+            ns[d] = SimDetector(d)
+            if d in user_ns:
+                self.simulated[id(user_ns[d])] = ns[d]
+        for name in ('dwell_time', '_locked_dwell_time'):
+            if name in user_ns:
+                self.simulated[id(user_ns[name])] = dwell
+        ns['shb']                = SimShutter('shb')
+        ns['slot']               = lambda n: self.stand_in('slot', n=n)
+        ns['end_of_macro']       = lambda: self.stand_in('end_of_macro')
+        ns['BMM_clear_to_start'] = lambda: (True, '')
+        ns['BMM_log_info']       = lambda message: None
+
+        ## any other names for the replaced objects (xt, sl, xafs_linx, ...)
+        for k, v in list(user_ns.items()):
+            if k not in ns and not k.startswith('_') and id(v) in self.simulated:
+                ns[k] = self.simulated[id(v)]
+        self.standins = ns
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## the virtual clock
+    def _open(self, label):
+        self.step = {'label': label, 'start': self.clock, 'times': {c: 0.0 for c in CATEGORIES}}
+        self.steps.append(self.step)
+
+    def _advance(self, category, seconds):
+        if self.step is None:
+            self._open('macro')
+        self.clock += seconds
+        self.step['times'][category] += seconds
+
+    def _set(self, obj, value, group):
+        if getattr(obj, 'is_dwell', False):
+            self.dwell = float(value)
+            obj.set(value)
+            return
+        if not hasattr(obj, 'move_time'):
+            self.ignored.add(getattr(obj, 'name', repr(obj)))
+            return
+        seconds = obj.move_time(value)
+        if obj.known:
+            self.travel[obj.name] = self.travel.get(obj.name, 0) + abs(value - obj.readback.get())
+        else:
+            self.unknown.add(obj.name)
+            obj.known = True
+        obj.set(value)
+        (category, done) = self.groups.get(group, ('motion', self.clock))
+        self.groups[group] = (category, max(done, self.clock + seconds))
+
+    def _wait(self, group):
+        (category, done) = self.groups.pop(group, ('motion', self.clock))
+        self._advance(category, max(done - self.clock, 0))
+
+    def _handle(self, msg):
+        command, obj = msg.command, msg.obj
+        group = msg.kwargs.get('group') if msg.kwargs else None
+        if command == 'set':
+            if self.depth == 0 and self.last != 'set':
+                self._open('mv %s' % getattr(obj, 'name', obj))
+            elif self.depth == 0 and self.step['label'].startswith('mv '):
+                self.step['label'] += ', %s' % getattr(obj, 'name', obj)
+            self._set(obj, msg.args[0], group)
+            return NullStatus()
+        elif command == 'wait':
+            self._wait(group)
+        elif command == 'trigger':
+            (category, done) = self.groups.get(group, ('integration', self.clock))
+            self.groups[group] = ('integration', max(done, self.clock + self.dwell + TRIGGER_OVERHEAD))
+            return NullStatus()
+        elif command == 'sleep':
+            self._advance('settle', msg.args[0])
+        elif command == 'read':
+            self._advance('readout', READOUT)
+            if hasattr(obj, 'move_time') or isinstance(obj, (SynSignal, SimDwell)):
+                return obj.read()
+            self.ignored.add(getattr(obj, 'name', repr(obj)))
+            return dict()
+        elif command == 'locate':
+            found = [{'setpoint': o.readback.get(), 'readback': o.readback.get()} for o in msg.args]
+            return found[0] if msg.kwargs.get('squeeze', True) and len(found) == 1 else found
+        elif command == 'save':
+            self._advance('bookkeeping', EVENT)
+        elif command == 'open_run':
+            self._advance('bookkeeping', RUN)
+            return short_uid('preflight')
+        return None
+
+    def execute(self, plan):
+        reply, error = None, None
+        while True:
+            try:
+                msg = plan.throw(error) if error is not None else plan.send(reply)
+            except StopIteration:
+                return
+            reply, error = None, None
+            try:
+                reply = self._handle(msg)
+            except Exception as e:
+                error = e
+            self.last = msg.command
+
+    def stand_in(self, kind, **kwargs):
+        '''The simulated version of a plan, as one step of the macro.'''
+        self._open(_label(kind, kwargs))
+        self.depth += 1
+        try:
+            return (yield from getattr(self, '_' + kind)(**kwargs))
+        finally:
+            self.depth -= 1
+            self.step  = None
+            self.last  = None
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## the stand-ins
+    def _scan(self, motor, positions, detectors=('quadem1',), dwell=0.1, rewind=True):
+        '''A relative step scan on the simulated devices.'''
+        ns = self.standins
+        yield from abs_set(ns['dwell_time'], dwell, wait=True)
+        self._advance('bookkeeping', RUN)
+        origin = motor.readback.get()
+        for x in positions:
+            yield from mv(motor, origin+x)
+            group = short_uid('trigger')
+            for d in detectors:
+                yield Msg('trigger', ns[d], group=group)
+            yield Msg('wait', None, group=group)
+            for d in detectors:
+                yield Msg('read', ns[d])
+            yield Msg('read', motor)
+            yield Msg('save')
+        if rewind:
+            yield from mv(motor, origin)
+
+    def _fly(self, motor, start, stop, nsteps, dwell=0.1, rewind=True):
+        '''A relative fly scan on the simulated devices: the run-up, one
+        bin crossed per dwell time, and the return.'''
+        self._advance('bookkeeping', RUN)
+        origin = motor.readback.get()
+        half = (stop-start) / max(nsteps-1, 1) / 2
+        yield from mv(motor, origin+start-half)
+        motor.set(origin+stop+half)
+        self._advance('integration', nsteps*dwell)
+        if rewind:
+            yield from mv(motor, origin)
+
+    def _xanes_map(self, energies=(), slow=None, slow_positions=(), fast=None, fast_positions=(), dwell=0.1,
+                   order=None, snake=True):
+        from BMM.xanesmap import traverse, loop_times        # BMM.xanesmap imports this module
+        ns = self.standins
+        slow, fast, energy = self._lookup(slow), self._lookup(fast), ns['dcm'].energy
+        slow_positions = slow.readback.get() + numpy.array(slow_positions)
+        fast_positions = fast.readback.get() + numpy.array(fast_positions)
+        if order is None:
+            times = loop_times(energies, slow, slow_positions, fast, fast_positions, dwell, twod=ns['dcm'].energy.twod, snake=snake)
+            order = min(times, key=lambda k: times[k][0])
+        origin = (slow.readback.get(), fast.readback.get())
+        yield from abs_set(ns['dwell_time'], dwell, wait=True)
+        self._advance('bookkeeping', RUN)
+        for (k, i, j) in traverse(order, energies, slow_positions, fast_positions, snake):
+            yield from mv(energy, energies[k], slow, slow_positions[i], fast, fast_positions[j])
+            group = short_uid('trigger')
+            yield Msg('trigger', ns['quadem1'], group=group)
+            yield Msg('wait', None, group=group)
+            yield Msg('read', ns['quadem1'])
+            yield Msg('save')
+        yield from mv(slow, origin[0], fast, origin[1])
+
+    def _xafs(self, seconds=0, dwell=0, energy=None, label=None):
+        dwell = min(dwell, seconds)
+        self._advance('integration', dwell)
+        self._advance('bookkeeping', seconds - dwell)   # everything the estimator does not separate
+        if energy is not None:
+            self.standins['dcm'].energy.set(energy)
+        yield from null()
+
+    def _slot(self, n):
+        yield from self.standins['xafs_wheel'].set_slot(n)
+
+    def _end_of_macro(self):
+        yield from abs_set(self.standins['dwell_time'], 0.5, wait=True)
+
+    def _change_mode(self, mode, edge=None, reference=None):
+        ns, modedata = self.standins, _modedata()
+        if modedata is None:
+            print(warning_msg('no Modes.json, the photon delivery system is not simulated'))
+            return (yield from null())
+        base = []
+        for key, motor in (('dm3_bct', ns['dm3_bct']),
+                           ('xafs_yu', ns['xafs_table'].yu), ('xafs_ydo', ns['xafs_table'].ydo), ('xafs_ydi', ns['xafs_table'].ydi),
+                           ('m3_yu', ns['m3'].yu), ('m3_ydo', ns['m3'].ydo), ('m3_ydi', ns['m3'].ydi),
+                           ('m3_xu', ns['m3'].xu), ('m3_xd', ns['m3'].xd)):
+            base.extend([motor, float(modedata[key][mode])])
+        current = user_ns['BMMuser'].pds_mode
+        if not (mode in ('D', 'E', 'F') and current in ('D', 'E', 'F')):
+            for key, motor in (('m2_yu', ns['m2'].yu), ('m2_ydo', ns['m2'].ydo), ('m2_ydi', ns['m2'].ydi)):
+                base.extend([motor, float(modedata[key][mode])])
+        if reference is not None and reference in ns['xafs_ref'].content:
+            base.extend([ns['xafs_ref'], ns['xafs_ref'].angle_of_slot(ns['xafs_ref'].content.index(reference)+1)])
+        if edge is not None:
+            base.extend([ns['dcm'].energy, edge])
+        yield from mv(*base)
+        yield from sleep(2.0)
+        user_ns['BMMuser'].pds_mode = mode
+
+    def _change_edge(self, el, edge='K', focus=False, energy=None, slits=True, target=300., xrd=False, verify=True):
+        if energy is None:
+            energy = edge_energy(el, edge)
+        if energy is None:
+            print(warning_msg('preflight: %s %s is not an edge, change_edge is not simulated' % (el, edge)))
+            return (yield from null())
+        if energy > 23500:
+            energy = edge_energy(el, 'L3')
+        if energy > 8000:
+            mode = 'A' if focus else 'D'
+        elif energy < 6000:
+            mode = 'C' if focus else 'F'
+        else:
+            mode = 'C' if focus else 'E'
+        if xrd:
+            mode, target = 'XRD', 0.0
+        yield from self._change_mode(mode, edge=energy+target, reference=el)
+        yield from sleep(1)
+        for kind, scan in (('pitch', self._rocking_curve), ('slit', self._slit_height)):
+            if kind == 'slit' and not slits:
+                continue
+            (position, fresh) = pitch_table.predict(kind, energy+target)
+            if not fresh:
+                yield from scan()
+            elif verify:
+                yield from scan(*VERIFY[kind])
+        BMMuser = user_ns['BMMuser']
+        BMMuser.element, BMMuser.edge = el.capitalize(), edge
+
+    def _rocking_curve(self, start=-0.10, stop=0.10, nsteps=101, adaptive=True):
+        ns = self.standins
+        yield from mv(ns['slits3'].vsize, 3)
+        yield from self._scan(ns['dcm_pitch'], _positions(start, stop, nsteps, adaptive))
+        yield from sleep(3.0)
+        yield from sleep(2.0)       # cleanup_plan
+
+    def _slit_height(self, start=-1.5, stop=1.5, nsteps=31, move=False, slp=1.0, adaptive=True):
+        yield from self._scan(self.standins['dm3_bct'], _positions(start, stop, nsteps, adaptive))
+        yield from sleep(2*slp)
+
+    def _linescan(self, axis=None, start=0, stop=0, nsteps=1, inttime=0.1, adaptive=False, target='peak', fly=False):
+        motor = self._lookup(axis)
+        if fly:
+            return (yield from self._fly(motor, start, stop, nsteps, dwell=inttime))
+        yield from self._scan(motor, _positions(start, stop, nsteps, adaptive, target), dwell=inttime)
+
+    def _areascan(self, slow=None, startslow=0, stopslow=0, nslow=1, fast=None, startfast=0, stopfast=0, nfast=1, dwell=0.1,
+                  snake=False, fly=False):
+        slow, fast = self._lookup(slow), self._lookup(fast)
+        origin, fastorigin = slow.readback.get(), fast.readback.get()
+        snake = snake or fly
+        for i, y in enumerate(numpy.linspace(startslow, stopslow, nslow)):
+            yield from mv(slow, origin+y)
+            (a, b) = (stopfast, startfast) if snake and i % 2 else (startfast, stopfast)
+            where = fast.readback.get() - fastorigin
+            if fly:
+                yield from self._fly(fast, a-where, b-where, nfast, dwell=dwell, rewind=False)
+            else:
+                yield from self._scan(fast, numpy.linspace(a, b, nfast) - where, dwell=dwell, rewind=not snake)
+        yield from mv(slow, origin, fast, fastorigin)
+
+    def _lookup(self, axis):
+        '''The simulated motor for a motor, a linescan nickname, a user_ns
+        name, or a motor name.'''
+        from BMM.linescans import motor_nicknames      # BMM.linescans imports this module
+        if isinstance(axis, str) and axis.lower() in motor_nicknames:
+            axis = motor_nicknames[axis.lower()]
+        if id(axis) in self.simulated:
+            return self.simulated[id(axis)]
+        if isinstance(axis, str):
+            if axis in self.standins and hasattr(self.standins[axis], 'move_time'):
+                return self.standins[axis]
+            for sim in self.simulated.values():
+                if getattr(sim, 'name', None) == axis and hasattr(sim, 'move_time'):
+                    return sim
+        name = getattr(axis, 'name', str(axis))
+        sim = SimMotor(name, position=self.start.get(name), velocity=self.motion.get(name, DEFAULT_VELOCITY)[0],
+                       acceleration=self.motion.get(name, DEFAULT_VELOCITY)[1])
+        self.simulated[id(axis)] = sim
+        return sim
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## running and reporting
+    def __call__(self, plan, start=None):
+        '''Run plan on the simulated beamline and report.  start is a dict
+        of motor name -> starting position, added to self.start.'''
+        if start is not None:
+            self.start.update(start)
+        BMMuser = user_ns['BMMuser']
+        flags = (BMMuser.macro_dryrun, BMMuser.prompt, BMMuser.pds_mode, BMMuser.element, BMMuser.edge)
+        self._reset()
+        self._build()
+        saved = {k: user_ns[k] for k in self.standins if k in user_ns}
+        t0 = time.monotonic()
+        self.active = True
+        user_ns.update(self.standins)
+        try:
+            self.execute(plan)
+        except Exception as e:
+            print(error_msg('preflight stopped at %s: %s' % (hms(self.clock), e)))
+        finally:
+            self.active = False
+            for k in self.standins:
+                if k in saved:
+                    user_ns[k] = saved[k]
+                else:
+                    del user_ns[k]
+            (BMMuser.macro_dryrun, BMMuser.prompt, BMMuser.pds_mode, BMMuser.element, BMMuser.edge) = flags
+        self.summary = {'total':   self.clock,
+                        'steps':   [{'label': s['label'], 'start': s['start'], 'seconds': sum(s['times'].values()), **s['times']}
+                                    for s in self.steps],
+                        'travel':  dict(self.travel),
+                        'unknown': sorted(self.unknown),
+                        'ignored': sorted(self.ignored),
+                        'elapsed': time.monotonic() - t0}
+        for c in CATEGORIES:
+            self.summary[c] = sum(s['times'][c] for s in self.steps)
+        self.report()
+        return self.summary
+
+    def report(self):
+        s = self.summary
+        if s is None:
+            print(warning_msg('No preflight has been run yet.'))
+            return
+        finish = datetime.datetime.now() + datetime.timedelta(seconds=s['total'])
+        print(bold_msg('\nPredicted time: %s (would finish around %s if started now)' % (hms(s['total']), finish.strftime('%a %H:%M'))))
+        print('   start     %-40s %9s   %s' % ('step', 'time', 'mostly'))
+        for step in s['steps']:
+            if step['seconds'] == 0:
+                continue
+            mostly = max(CATEGORIES, key=lambda c: step[c])
+            print('   %s  %-40.40s %9s   %s' % (hms(step['start']), step['label'], hms(step['seconds']), mostly))
+        print(bold_msg('\nTime by category:'))
+        for c in sorted(CATEGORIES, key=lambda c: -s[c]):
+            print('   %-12s %9s  %5.1f%%' % (c, hms(s[c]), 100*s[c]/s['total'] if s['total'] else 0))
+        if s['travel']:
+            print(bold_msg('\nMotor travel:'))
+            for k in sorted(s['travel'], key=lambda k: -s['travel'][k]):
+                print('   %-14s %12.3f' % (k, s['travel'][k]))
+        if s['unknown']:
+            print(warning_msg('\nStarting position unknown, first move not counted: %s' % ', '.join(s['unknown'])))
+        if s['ignored']:
+            print(warning_msg('Not simulated, counted as instantaneous: %s' % ', '.join(s['ignored'])))
+        print(whisper('(simulated in %.1f seconds)' % s['elapsed']))
+
+
+def _modedata():
+    from BMM.modes import MODEDATA      # BMM.modes imports this module
+    return MODEDATA
+
+
+def _positions(start, stop, nsteps, adaptive=False, target='peak'):
+    '''The positions of a fixed grid or of a coarse-to-fine search.  The
+    search is run against a made-up feature a bit off center.'''
+    if not adaptive:
+        return numpy.linspace(start, stop, nsteps)
+    center, width = start + 0.45*(stop-start), abs(stop-start)/10
+    if target == 'inflection':
+        profile = lambda x: 1 / (1 + numpy.exp((x-center)/(width/4)))
+    else:
+        profile = lambda x: numpy.exp(-((x-center)/width)**2/2)
+    return PeakSearch(start, stop, nsteps, target=target).simulate(profile)
+
+
+def _label(kind, kwargs):
+    if kind == 'xafs':
+        return 'xafs %s' % (kwargs.get('label') or '')
+    elif kind == 'slot':
+        return 'slot %s' % kwargs.get('n')
+    elif kind == 'change_edge':
+        return 'change_edge %s %s' % (kwargs.get('el'), kwargs.get('edge', 'K'))
+    elif kind == 'xanes_map':
+        return 'xanes_map %s order' % (kwargs.get('order') or 'best')
+    elif kind == 'change_mode':
+        return 'change_mode %s' % kwargs.get('mode')
+    return kind
+
+
+preflight = Preflight()
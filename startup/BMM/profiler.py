@@ -0,0 +1,198 @@
+import time
+from collections import OrderedDict
+
+from BMM.functions     import error_msg, warning_msg, bold_msg, whisper
+from BMM.logging       import BMM_log_info
+from BMM.perstep       import PHASES, record_timing
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Dead-time profiler                                                    #
+#                                                                       #
+# A RunEngine preprocessor which times every message of every run: the  #
+# time the RunEngine spends on each message and the time the plan       #
+# spends computing its next message.  That time is sorted into          #
+#                                                                       #
+#   motion:      set messages and waits on groups of sets               #
+#   settle:      sleep messages                                         #
+#   integration: trigger messages and waits on groups of triggers       #
+#   readout:     create, describe, and read messages                    #
+#   bookkeeping: save (i.e. the callbacks), checkpoints, and all the    #
+#                time spent in the plan itself                          #
+#                                                                       #
+# These are the phases of the fused per-step (see BMM/perstep.py).  At  #
+# the end of each successful run, the summary -- the time per point in  #
+# each phase -- is recorded as one event in the "timing" stream, just   #
+# before the stop document, unless the run already has one from         #
+# with_step_timing.  A flame-graph style report is written to the       #
+# experiment log:                                                       #
+#                                                                       #
+#   scan_nd            412.3 s  100.0% |#################################|
+#     integration      301.7 s   73.2% |########################         |
+#       wait           301.2 s   73.1% |########################         |
+#     motion            70.2 s   17.0% |######                           |
+#   ...                                                                 #
+#                                                                       #
+# It is enabled in 90-bmm.py.  profiler.enabled = False turns it off,   #
+# profiler.verbose = True prints the report at the end of every run,    #
+# and profiler.show() prints the report for the most recent run.        #
+#########################################################################
+
+CATEGORIES = PHASES
+
+def _category(command):
+    if command == 'set':
+        return 'motion'
+    elif command == 'sleep':
+        return 'settle'
+    elif command in ('trigger', 'kickoff', 'complete', 'collect'):
+        return 'integration'
+    elif command in ('create', 'describe', 'read'):
+        return 'readout'
+    return 'bookkeeping'
+
+
+class RunProfile():
+    '''Accumulated message times for one run.'''
+    def __init__(self, plan_name):
+        self.plan_name = plan_name
+        self.times     = OrderedDict((c, OrderedDict()) for c in CATEGORIES)
+        self.groups    = dict()
+        self.last      = 'motion'
+        self.stream    = None
+        self.timed     = False
+        self.points    = 0
+        self.started   = time.monotonic()
+
+    def add(self, category, command, seconds):
+        self.times[category][command] = self.times[category].get(command, 0) + seconds
+
+    def message(self, msg, seconds):
+        command = msg.command
+        category = _category(command)
+        group = msg.kwargs.get('group') if msg.kwargs else None
+        if command in ('set', 'trigger'):
+            self.last = category
+            if group is not None:
+                self.groups[group] = category
+        elif command == 'wait':
+            category = self.groups.pop(group, None) or self.last
+        elif command == 'create':
+            self.stream = msg.kwargs.get('name', 'primary')
+            self.timed  = self.timed or self.stream == 'timing'
+        elif command == 'save' and self.stream == 'primary':
+            self.points += 1
+        self.add(category, command, seconds)
+
+    def total(self, category=None):
+        if category is None:
+            return sum(self.total(c) for c in CATEGORIES)
+        return sum(self.times[category].values())
+
+    def summary(self):
+        '''The time per point in each phase, as in FusedStep.summary.'''
+        n = max(self.points, 1)
+        result = {'points': self.points, 'elapsed': time.monotonic() - self.started}
+        for c in CATEGORIES:
+            result[c] = self.total(c) / n
+        result['per_point'] = self.total() / n
+        result['overhead']  = result['per_point'] - result['integration']
+        return result
+
+    def report(self, width=40):
+        '''Return a flame-graph-style text report.'''
+        total = self.total()
+        if total == 0:
+            return ''
+        def line(indent, label, seconds):
+            n = int(round(width * seconds / total))
+            return '%-20s %9.2f s %6.1f%% |%s%s|' % (' '*indent + label, seconds, 100*seconds/total, '#'*n, ' '*(width-n))
+        text = [line(0, self.plan_name, total)]
+        for c in sorted(CATEGORIES, key=lambda c: -self.total(c)):
+            if self.total(c) == 0:
+                continue
+            text.append(line(2, c, self.total(c)))
+            for command, seconds in sorted(self.times[c].items(), key=lambda x: -x[1]):
+                text.append(line(4, command, seconds))
+        if self.points:
+            text.append('%d points, %.3f s/point, %.3f s/point beyond integration' %
+                        (self.points, total/self.points, (total - self.total('integration'))/self.points))
+        return '\n'.join(text)
+
+
+class DeadTimeProfiler():
+    '''RunEngine preprocessor, see the comment above.
+
+       RE.preprocessors.append(profiler)
+    '''
+    def __init__(self):
+        self.enabled = True
+        self.verbose = False
+        self.stream  = True
+        self.runs    = dict()
+        self.recent  = None
+
+    def __repr__(self):
+        return '<DeadTimeProfiler: %s>' % ('enabled' if self.enabled else 'disabled')
+
+    def __call__(self, plan):
+        return (yield from self.profile(plan))
+
+    def show(self):
+        if self.recent is None:
+            print(warning_msg('No run has been profiled yet.'))
+            return
+        print(self.recent.report())
+
+    def _finish(self, profile):
+        self.recent = profile
+        text = profile.report()
+        if text:
+            BMM_log_info('dead-time profile\n' + text)
+            if self.verbose:
+                print(whisper(text))
+
+    def profile(self, plan):
+        if not self.enabled:
+            return (yield from plan)
+        reply, error = None, None
+        current = None
+        while True:
+            t0 = time.monotonic()
+            try:
+                if error is not None:
+                    msg = plan.throw(error)
+                else:
+                    msg = plan.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            t1 = time.monotonic()
+            if current is not None:
+                current.add('bookkeeping', 'plan', t1 - t0)
+
+            if msg.command == 'open_run':
+                current = RunProfile(msg.kwargs.get('plan_name', 'run'))
+                self.runs[msg.run] = current
+            elif msg.command == 'close_run' and msg.run in self.runs:
+                profile = self.runs.pop(msg.run)
+                success = (msg.kwargs.get('exit_status') or 'success') == 'success'
+                if self.stream and success and not profile.timed and profile.total() > 0:
+                    yield from record_timing(profile.summary())
+                self._finish(profile)
+                current = next(iter(self.runs.values()), None)
+
+            try:
+                reply, error = (yield msg), None
+            except GeneratorExit:
+                plan.close()
+                raise
+            except BaseException as e:
+                reply, error = None, e
+            if current is not None and msg.command not in ('open_run', 'close_run'):
+                current.message(msg, time.monotonic() - t1)
+
+
+profiler = DeadTimeProfiler()
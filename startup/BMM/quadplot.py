@@ -0,0 +1,158 @@
+import numpy, os, time
+
+from larch import Group
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from BMM.functions import error_msg, warning_msg, bold_msg, whisper, ktoe
+from BMM.larch     import Pandrosus
+from BMM.logging   import BMM_log_info
+from BMM.merge     import merge_files, sequence_files
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# The dossier image of an XAFS scan sequence                            #
+#                                                                       #
+# This replaces toprj (see BMM/demeter.py), which runs a Perl/Demeter   #
+# script for every scan sequence.  Here, the sequence's XDI files are   #
+# merged (see BMM/merge.py), the merge is processed by a Pandrosus, and #
+# the four panels are drawn on an Agg canvas -- no pyplot, so this is   #
+# safe to run in a post-scan worker thread:                             #
+#                                                                       #
+#   EXAFS:  mu(E) of each scan      normalized merge                    #
+#           k^2 chi(k) of merge     |chi(R)| of merge                   #
+#   XANES:  mu(E) of each scan      normalized merge                    #
+#           derivative of merge     normalized merge near the edge      #
+#                                                                       #
+# Repetitions rejected by the merge are drawn as grey dashed lines.     #
+#                                                                       #
+# The sequence is EXAFS when the last scan boundary is more than        #
+# EXAFS_BOUNDARY above the edge.  Making an Athena project of the       #
+# sequence is a separate step, see athena_project.                      #
+#                                                                       #
+#    pngfile = quadplot(name='Fe-foil', base='Fe-foil', start=1,        #
+#                       end=3, bounds='-200 -30 15.3 14k')              #
+#########################################################################
+
+EXAFS_BOUNDARY = 150            # eV above the edge
+
+
+def is_exafs(bounds):
+    '''True if a bounds string ends more than EXAFS_BOUNDARY above the edge.'''
+    try:
+        last = str(bounds).split()[-1]
+        if last[-1].lower() == 'k':
+            return ktoe(float(last[:-1])) > EXAFS_BOUNDARY
+        return float(last) > EXAFS_BOUNDARY
+    except (IndexError, ValueError):
+        return False
+
+
+def quadplot(folder=None, name=None, base=None, start=None, end=None, bounds=None, mode=None, merged=None):
+    '''Make the dossier quad plot of a scan sequence, writing it to
+    folder/snapshots/base.png.  The arguments are those of toprj, plus
+    merged, a Merge of the sequence if one has already been made.
+    Return the name of the PNG file or None.'''
+    t0 = time.time()
+    if folder is None:
+        folder = user_ns['BMMuser'].DATA
+    if name is None or start is None or end is None:
+        print(error_msg('cannot make quad plot, missing name, start, or end argument'))
+        return None
+    if base is None:
+        base = name
+    if mode is None:
+        mode = 'transmission'
+    files = sequence_files(folder, name, start, end)
+    if len(files) == 0:
+        print(error_msg('cannot make quad plot, no data files found for %s' % name))
+        return None
+    if merged is None:
+        merged = merge_files(files)
+
+    data = Pandrosus(name=base)
+    data.group = Group(__name__=base)
+    data.group.energy, data.group.mu = merged.grid, merged.mu
+    data.prep()
+    g = data.group
+    exafs = is_exafs(bounds)
+
+    fig = Figure(figsize=(8, 6), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots(2, 2)
+    fig.suptitle('%s  (%s, %d of %d scans)' % (base, mode, merged.kept.sum(), len(merged.kept)))
+
+    for label, (e, m), kept in zip(merged.labels, merged.raw, merged.kept):
+        if kept:
+            ax[0,0].plot(e, m, label=label)
+        else:
+            ax[0,0].plot(e, m, color='grey', linestyle='--', linewidth=0.5)
+    ax[0,0].set_xlabel(data.xe)
+    ax[0,0].set_ylabel('$\mu(E)$')
+    if len(files) <= 8:
+        ax[0,0].legend(loc='best', fontsize='x-small')
+
+    ax[0,1].plot(g.energy, g.flat if exafs else g.norm, label='merge')
+    ax[0,1].axvline(g.e0, color='orchid', linewidth=0.5)
+    ax[0,1].set_xlabel(data.xe)
+    ax[0,1].set_ylabel('normalized $\mu(E)$')
+
+    if exafs:
+        data.do_xftf(kw=2)
+        ax[1,0].plot(g.k, g.chi*g.k**2)
+        ax[1,0].plot(g.k, g.kwin*numpy.abs(g.chi*g.k**2).max()*1.1, color='C8')
+        ax[1,0].set_xlabel(data.xk)
+        ax[1,0].set_ylabel('$k^2\cdot\chi(k)$  ($\AA^{-2}$)')
+        ax[1,1].plot(g.r, g.chir_mag)
+        ax[1,1].set_xlim(0, data.rmax)
+        ax[1,1].set_xlabel(data.xr)
+        ax[1,1].set_ylabel('$|\chi(R)|$  ($\AA^{-3}$)')
+    else:
+        near = (g.energy > g.e0-30) & (g.energy < g.e0+70)
+        ax[1,0].plot(g.energy[near], g.dmude[near])
+        ax[1,0].set_xlabel(data.xe)
+        ax[1,0].set_ylabel('derivative of $\mu(E)$')
+        ax[1,1].plot(g.energy[near], g.norm[near])
+        ax[1,1].set_xlabel(data.xe)
+        ax[1,1].set_ylabel('normalized $\mu(E)$')
+    for a in ax.flat:
+        a.grid(which='major', axis='both')
+    fig.tight_layout()
+
+    pngfile = os.path.join(folder, 'snapshots', base+'.png')
+    fig.savefig(pngfile + '.part', format='png')
+    os.replace(pngfile + '.part', pngfile)
+    BMM_log_info('wrote dossier quad plot %s in %.2f seconds' % (pngfile, time.time()-t0))
+    return pngfile
+
+
+def athena_project(folder=None, name=None, base=None, start=None, end=None, prjfile=None):
+    '''Write the scans of a sequence and their merge to an Athena project
+    file, by default folder/prj/base.prj.  Return the name of the
+    project file or None.'''
+    from larch.io import create_athena
+    if folder is None:
+        folder = user_ns['BMMuser'].DATA
+    if name is None or start is None or end is None:
+        print(error_msg('cannot make Athena project, missing name, start, or end argument'))
+        return None
+    if base is None:
+        base = name
+    files = sequence_files(folder, name, start, end)
+    if len(files) == 0:
+        print(error_msg('cannot make Athena project, no data files found for %s' % name))
+        return None
+    if prjfile is None:
+        os.makedirs(os.path.join(folder, 'prj'), exist_ok=True)
+        prjfile = os.path.join(folder, 'prj', base+'.prj')
+    merged = merge_files(files)
+    prj = create_athena(prjfile)
+    for f, (e, m) in zip(files, merged.raw):
+        prj.add_group(Group(__name__=os.path.basename(f), energy=e, mu=m, filename=f))
+    prj.add_group(Group(__name__=base+' merge', energy=merged.grid, mu=merged.mu, filename=base+' merge'))
+    prj.save()
+    print(bold_msg('wrote Athena project %s' % prjfile))
+    return prjfile
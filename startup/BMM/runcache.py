@@ -0,0 +1,282 @@
+from bluesky.callbacks import CallbackBase
+
+import numpy, pandas, threading
+from collections import OrderedDict
+
+from BMM.functions import error_msg, warning_msg, bold_msg, whisper
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# A process-local cache of recent runs                                  #
+#                                                                       #
+# The RunCache is subscribed to the RunEngine, so every run measured in #
+# this session is captured as its documents go by.  The things which    #
+# look at a run right after it finishes -- write_XDI, data evaluation,  #
+# Pandrosus, rocking_curve, center_sample_y, the cleanup plan of xafs   #
+# -- can then get the columns they need without asking MongoDB.  A run  #
+# which is not in the cache is fetched from databroker once and kept.   #
+#                                                                       #
+#    t = runcache.table(uid, columns=['dcm_energy', 'I0', 'It'])        #
+#    t = runcache.table(-1)                    # most recent run        #
+#    b = runcache.table(uid, stream='baseline')                         #
+#    runcache.start_doc(uid), .stop_doc(uid)   # start & stop documents #
+#    runcache[uid]                             # a databroker-like run  #
+#########################################################################
+
+
+def _localize(stamps):
+    '''Turn epoch seconds into the naive local datetimes databroker
+    puts in the time column of a table.'''
+    import tzlocal
+    tz = tzlocal.get_localzone()
+    t = pandas.to_datetime(numpy.asarray(stamps, dtype=float), unit='s')
+    return t.tz_localize('UTC').tz_convert(tz).tz_localize(None)
+
+
+class CachedStream():
+    '''The columns of one stream of one run.  While a run is live,
+    values are accumulated in lists.  When the run stops, or when the
+    stream is read from databroker, the lists become numpy arrays.'''
+    def __init__(self):
+        self.columns = OrderedDict()
+        self.columns['time'] = []
+        self.npoints = 0
+        self.final   = False
+        self.configuration = dict()
+
+    def append(self, stamp, data):
+        self.columns['time'].append(stamp)
+        for k,v in data.items():
+            if isinstance(v, (list, tuple, numpy.ndarray, dict)):
+                continue        # images, spectra, and the like are not cached
+            if k not in self.columns:
+                self.columns[k] = [None] * self.npoints
+            self.columns[k].append(v)
+        self.npoints += 1
+        for k in self.columns.keys():        # a key missing from this event
+            if len(self.columns[k]) < self.npoints:
+                self.columns[k].append(None)
+
+    def finalize(self):
+        if self.final:
+            return
+        for k in self.columns.keys():
+            self.columns[k] = numpy.asarray(self.columns[k])
+        self.final = True
+
+    def nbytes(self):
+        if self.final:
+            return sum(c.nbytes for c in self.columns.values())
+        return 8 * self.npoints * len(self.columns)
+
+    def table(self, columns=None):
+        if columns is None:
+            columns = [k for k in self.columns.keys() if k != 'time']
+        index = numpy.arange(1, self.npoints+1)
+        frame = pandas.DataFrame(index=index)
+        frame['time'] = _localize(self.columns['time'][:self.npoints])
+        for k in columns:
+            frame[k] = numpy.asarray(self.columns[k][:self.npoints])
+        return frame
+
+
+class CachedRun():
+    '''Enough of a databroker Header for write_XDI and friends:
+    start, stop, and table(stream).'''
+    def __init__(self, cache, start=None, stop=None, header=None):
+        self.cache   = cache
+        self.start   = start
+        self.stop    = stop
+        self.header  = header
+        self.streams = dict()
+        self.live    = start is not None and stop is None and header is None
+
+    @property
+    def uid(self):
+        return self.start['uid']
+
+    def stream(self, name='primary'):
+        if name not in self.streams:
+            if self.live:
+                raise KeyError('no "%s" stream (yet) in run %s' % (name, self.uid))
+            if self.header is None:
+                self.header = user_ns['db'][self.uid]
+            frame = self.header.table(name, convert_times=False)
+            s = CachedStream()
+            s.columns = OrderedDict((k, frame[k].values) for k in frame.columns)
+            s.npoints = len(frame)
+            s.final   = True
+            self.streams[name] = s
+            self.cache.trim()
+        return self.streams[name]
+
+    def table(self, stream='primary', columns=None):
+        with self.cache.lock:
+            return self.stream(stream).table(columns)
+
+    def config(self, device, key, stream='primary'):
+        '''Return a configuration value of a device from the descriptor
+        of a stream, e.g. config('vor', 'vor_names_name3').  If device
+        is not in the descriptor, look for the key in the configuration
+        of the other devices, as for the stand-in detector of a fly scan
+        or of count-until-statistics, which carries the configuration of
+        the detectors it read.'''
+        with self.cache.lock:
+            s = self.stream(stream)
+            if len(s.configuration) == 0 and self.header is not None:
+                for d in self.header.descriptors:
+                    if d['name'] == stream:
+                        s.configuration = {k: v['data'] for k,v in d['configuration'].items()}
+                        break
+            if device in s.configuration:
+                return s.configuration[device][key]
+            for v in s.configuration.values():
+                if key in v:
+                    return v[key]
+            raise KeyError('%s: %s' % (device, key))
+
+    def nbytes(self):
+        return sum(s.nbytes() for s in self.streams.values())
+
+
+class RunCache(CallbackBase):
+    '''An LRU cache of recent runs, filled from the document stream.
+
+    attributes:
+      max_bytes:  memory limit (estimated) for the data held in the cache
+      max_runs:   most runs held at once
+      hits:       number of lookups satisfied by the cache
+      misses:     number of lookups which went to databroker
+
+    The run being measured is never evicted.  Only scalar data are
+    kept; array-valued data keys (spectra, images) are skipped.
+    '''
+    def __init__(self, max_bytes=512*2**20, max_runs=50):
+        super().__init__()
+        self.max_bytes   = max_bytes
+        self.max_runs    = max_runs
+        self.runs        = OrderedDict()      # uid -> CachedRun, least recently used first
+        self.sequence    = []                 # uids in the order they were started
+        self.descriptors = dict()             # descriptor uid -> (run uid, stream name)
+        self.hits        = 0
+        self.misses      = 0
+        self.lock        = threading.RLock()
+
+    def __repr__(self):
+        return '<RunCache: %d runs, %.1f of %.1f MB, %d hits, %d misses>' % \
+            (len(self.runs), self.nbytes()/2**20, self.max_bytes/2**20, self.hits, self.misses)
+
+    def nbytes(self):
+        with self.lock:
+            return sum(r.nbytes() for r in self.runs.values())
+
+    def trim(self):
+        '''Evict least recently used, finished runs until within the memory limit.'''
+        with self.lock:
+            for uid in list(self.runs.keys()):
+                if len(self.runs) <= self.max_runs and self.nbytes() <= self.max_bytes:
+                    break
+                if self.runs[uid].live:
+                    continue
+                del self.runs[uid]
+
+    def clear(self):
+        with self.lock:
+            self.runs.clear()
+            self.sequence = []
+            self.descriptors.clear()
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## document stream
+    def start(self, doc):
+        with self.lock:
+            self.runs[doc['uid']] = CachedRun(self, start=doc)
+            self.sequence.append(doc['uid'])
+            self.sequence = self.sequence[-self.max_runs:]
+            self.trim()
+
+    def descriptor(self, doc):
+        with self.lock:
+            if doc['run_start'] not in self.runs:
+                return
+            self.descriptors[doc['uid']] = (doc['run_start'], doc['name'])
+            stream = self.runs[doc['run_start']].streams.setdefault(doc['name'], CachedStream())
+            stream.configuration = {k: v['data'] for k,v in doc.get('configuration', {}).items()}
+
+    def event(self, doc):
+        with self.lock:
+            if doc['descriptor'] not in self.descriptors:
+                return
+            uid, name = self.descriptors[doc['descriptor']]
+            if uid not in self.runs:
+                return
+            self.runs[uid].streams[name].append(doc['time'], doc['data'])
+
+    def stop(self, doc):
+        with self.lock:
+            uid = doc['run_start']
+            self.descriptors = {k:v for k,v in self.descriptors.items() if v[0] != uid}
+            if uid not in self.runs:
+                return
+            run = self.runs[uid]
+            run.stop = doc
+            run.live = False
+            for s in run.streams.values():
+                s.finalize()
+            self.trim()
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## lookups
+    def _resolve(self, key):
+        '''Turn a uid, a (partial) uid, or a negative index into a full uid.'''
+        if type(key) is int and key < 0:
+            if -key <= len(self.sequence):
+                return self.sequence[key]
+            return None
+        if type(key) is str:
+            if key in self.runs:
+                return key
+            matches = [u for u in self.runs.keys() if u.startswith(key)]
+            if len(matches) == 1:
+                return matches[0]
+        return None
+
+    def __getitem__(self, key):
+        '''Return the CachedRun for key, fetching it from databroker if
+        it is not in the cache.'''
+        with self.lock:
+            uid = self._resolve(key)
+            if uid is not None and uid in self.runs:
+                self.hits += 1
+                self.runs.move_to_end(uid)
+                return self.runs[uid]
+        self.misses += 1
+        header = user_ns['db'][key]
+        with self.lock:
+            uid = header.start['uid']
+            if uid not in self.runs:
+                self.runs[uid] = CachedRun(self, start=header.start, stop=header.stop, header=header)
+            self.runs.move_to_end(uid)
+            self.trim()
+            return self.runs[uid]
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._resolve(key) in self.runs
+
+    def table(self, key=-1, stream='primary', columns=None):
+        '''Return a DataFrame like databroker's Header.table(), with only
+        the requested columns (plus time).'''
+        return self[key].table(stream, columns)
+
+    def start_doc(self, key=-1):
+        return self[key].start
+
+    def stop_doc(self, key=-1):
+        return self[key].stop
+
+
+runcache = RunCache()
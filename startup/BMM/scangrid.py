@@ -0,0 +1,115 @@
+import numpy
+from functools import lru_cache
+
+from BMM.functions      import etok, ktoe, HBARC
+from BMM.dcm_parameters import dcm_parameters
+BMM_dcm = dcm_parameters()
+
+
+CS_MULTIPLIER = 0.72   # crude estimate of per-point overhead, in seconds
+
+class ScanGrid():
+    '''An immutable energy/dwell-time grid for an XAFS step scan.
+
+    Do not make one of these directly, use scan_grid(), which
+    returns a cached ScanGrid for any parameter set which has been seen
+    recently:
+
+       grid = scan_grid(bounds=[-200, -30, 15.3, '14k'],
+                        steps=[10, 0.5, '0.05k'],
+                        times=[0.5, 0.5, '0.25k'], e0=7112)
+
+    Attributes (all arrays are read-only):
+       energy:   absolute energy values
+       dwell:    integration times
+       bragg:    Bragg angle at each energy
+       para:     fixed-exit parallel position at each energy
+       perp:     fixed-exit perpendicular position at each energy
+       bounds:   region boundaries, converted to relative energy and sorted
+       npoints:  number of points in the grid
+       approximate_time: crude estimate of scan length in minutes
+
+    The arguments are recorded as given in given_bounds, given_steps,
+    and given_times.  The arguments themselves are never modified.
+
+    See conventional_grid() in BMM/xafs.py for an explanation of
+    boundary, step, and time values.
+    '''
+    def __init__(self, bounds, steps, times, e0, ththth, crystal, offset=30):
+        self.given_bounds, self.given_steps, self.given_times = bounds, steps, times
+        self.e0, self.ththth, self.crystal = e0, ththth, crystal
+        self.valid = (len(bounds) - len(steps)) == 1 and (len(bounds) - len(times)) == 1
+        if not self.valid:
+            return
+
+        converted = numpy.sort(numpy.array([ktoe(float(b[:-1])) if type(b) is str else float(b) for b in bounds]))
+        enot      = e0
+        edges     = converted
+        if ththth:
+            enot  = e0/3.0
+            edges = converted/3.0
+
+        energy, dwell = [], []
+        for i,s in enumerate(steps):
+            if type(s) is str:
+                step = float(s[:-1])
+                if ththth: step = step/3.
+                ar = enot + ktoe(numpy.arange(etok(edges[i]), etok(edges[i+1]), step))
+            else:
+                step = s
+                if ththth: step = step/3.
+                ar = numpy.arange(enot+edges[i], enot+edges[i+1], step)
+            energy.append(ar)
+            if type(times[i]) is str:
+                dwell.append(etok(ar-enot)*float(times[i][:-1]))
+            else:
+                dwell.append(times[i]*numpy.ones(len(ar)))
+        self.bounds  = tuple(float(b) for b in converted)
+        self.energy  = numpy.round(numpy.concatenate(energy), decimals=2)
+        self.dwell   = numpy.round(numpy.concatenate(dwell),  decimals=2)
+        self.npoints = len(self.energy)
+
+        twod = 2*BMM_dcm.dspacing_311 if crystal == '311' else 2*BMM_dcm.dspacing_111
+        with numpy.errstate(invalid='ignore'):
+            angle = numpy.arcsin(2*numpy.pi*HBARC / self.energy / twod)
+        self.bragg = numpy.degrees(angle)
+        self.para  = offset / (2*numpy.sin(angle))
+        self.perp  = offset / (2*numpy.cos(angle))
+        self.approximate_time = round((self.dwell.sum() + self.npoints*CS_MULTIPLIER) / 60.0, 1)
+        for a in ('energy', 'dwell', 'bragg', 'para', 'perp'):
+            getattr(self, a).flags.writeable = False
+
+    def __setattr__(self, attr, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('ScanGrid objects are immutable')
+        super().__setattr__(attr, value)
+
+    def __repr__(self):
+        if not self.valid:
+            return '<ScanGrid (invalid)>'
+        return '<ScanGrid %d points, %.1f to %.1f eV, Si(%s)>' % (self.npoints, self.energy[0], self.energy[-1], self.crystal)
+
+    def lists(self):
+        '''Return (grid, timegrid, approximate_time) as conventional_grid() always has.'''
+        if not self.valid:
+            return (None, None, None)
+        return (list(self.energy), list(self.dwell), self.approximate_time)
+
+
+def _hashable(values):
+    return tuple(values)
+
+@lru_cache(maxsize=64)
+def _cached_grid(bounds, steps, times, e0, ththth, crystal):
+    grid = ScanGrid(bounds, steps, times, e0, ththth, crystal)
+    object.__setattr__(grid, '_frozen', True)
+    return grid
+
+def scan_grid(bounds, steps, times, e0=7112, ththth=False, crystal='111'):
+    '''Return the ScanGrid for these parameters, computing it only if it
+    is not already in the cache.  The cache is keyed on (bounds, steps,
+    times, e0, ththth, crystal).  scan_grid.cache_info() and
+    scan_grid.cache_clear() work as for functools.lru_cache.'''
+    return _cached_grid(_hashable(bounds), _hashable(steps), _hashable(times), float(e0), bool(ththth), str(crystal))
+scan_grid.cache_info  = _cached_grid.cache_info
+scan_grid.cache_clear = _cached_grid.cache_clear
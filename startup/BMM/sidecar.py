@@ -0,0 +1,167 @@
+import h5py, numpy, os, glob
+from collections import OrderedDict
+
+from BMM.functions import error_msg, warning_msg, bold_msg, whisper
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Columnar HDF5 sidecar files                                           #
+#                                                                       #
+# An XDI file is easy to read by eye and by Athena, but slow to load    #
+# in bulk.  When BMMuser.sidecar is set, the same columns are also      #
+# written to <datafile>.h5, one 1D float64 dataset per column, along    #
+# with the XDI header lines and some of the start document.             #
+#                                                                       #
+#   BMMuser.sidecar = 'compressed'  -->  gzip-compressed, chunked       #
+#   BMMuser.sidecar = 'mappable'    -->  uncompressed and contiguous,   #
+#                                        so the columns can be mapped   #
+#                                        straight from the disk         #
+#   BMMuser.sidecar = False         -->  no sidecar                     #
+#                                                                       #
+# To read one or all of them:                                           #
+#    s = read_sidecar('/path/to/Fe-foil.001')                           #
+#    exp = load_experiment('/path/to/folder')                           #
+#    exp['Fe-foil.001']['xmu']                                          #
+#########################################################################
+
+SIDECAR_EXTENSION = '.h5'
+
+
+def sidecar_name(datafile):
+    if datafile.endswith(SIDECAR_EXTENSION):
+        return datafile
+    return datafile + SIDECAR_EXTENSION
+
+
+def write_sidecar(datafile, names, data, header=(), start=None, style=None, final=None):
+    '''Write the columnar sidecar for an XDI (or other column data) file.
+
+      datafile: the name of the text file this accompanies
+      names:    list of column names
+      data:     2D array (or list of rows), one column per name
+      header:   list of header lines of the text file
+      start:    start document, for the uid, scan_id, and plan name
+      style:    'compressed' or 'mappable', default is BMMuser.sidecar
+      final:    the name the text file will have, if datafile is a
+                temporary name -- the caller moves the sidecar along
+                with the text file, see move_sidecar
+
+    Return the name of the sidecar file.
+    '''
+    if style is None:
+        style = user_ns['BMMuser'].sidecar
+    if style not in ('compressed', 'mappable'):
+        print(error_msg('sidecar style must be "compressed" or "mappable"'))
+        return None
+    data = numpy.asarray(data, dtype=float).reshape(-1, len(names))
+    filename = sidecar_name(datafile)
+    with h5py.File(filename, 'w') as f:
+        f.attrs['datafile'] = os.path.basename(final or datafile)
+        f.attrs['header']   = '\n'.join(header)
+        f.attrs['columns']  = numpy.array(names, dtype=h5py.string_dtype())
+        f.attrs['npoints']  = data.shape[0]
+        if start is not None:
+            for k in ('uid', 'scan_id', 'plan_name', 'time'):
+                if k in start:
+                    f.attrs[k] = start[k]
+        group = f.create_group('columns')
+        for i, name in enumerate(names):
+            if style == 'compressed' and data.shape[0] > 0:
+                group.create_dataset(name, data=data[:,i], compression='gzip', compression_opts=4, shuffle=True)
+            else:
+                group.create_dataset(name, data=data[:,i])
+    return filename
+
+
+def move_sidecar(datafile, final):
+    '''Move the sidecar of datafile, if there is one, to go with final.'''
+    if os.path.isfile(sidecar_name(datafile)):
+        os.replace(sidecar_name(datafile), sidecar_name(final))
+
+
+class Sidecar():
+    '''The contents of one sidecar file.
+
+      s.datafile  name of the accompanying text file
+      s.header    XDI header lines
+      s.names     column names, in order
+      s.attrs     uid, scan_id, plan_name, time
+      s['xmu']    one column as a numpy array (a memmap if possible)
+      s.array()   all the columns as a 2D array
+    '''
+    def __init__(self, filename, columns=None, mmap=True):
+        self.filename = filename
+        self.columns  = OrderedDict()
+        self.mapped   = 0
+        with h5py.File(filename, 'r') as f:
+            self.datafile = f.attrs['datafile']
+            self.header   = f.attrs['header'].split('\n') if len(f.attrs['header']) > 0 else []
+            self.names    = [str(n) for n in f.attrs['columns']]
+            self.attrs    = {k: f.attrs[k] for k in ('uid', 'scan_id', 'plan_name', 'time') if k in f.attrs}
+            for name in self.names:
+                if columns is not None and name not in columns:
+                    continue
+                ds = f['columns'][name]
+                offset = None
+                if mmap and ds.chunks is None and ds.compression is None:
+                    offset = ds.id.get_offset()
+                if offset is not None:
+                    self.columns[name] = numpy.memmap(filename, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+                    self.mapped += 1
+                else:
+                    self.columns[name] = ds[()]
+
+    def __repr__(self):
+        return '<Sidecar %s: %d columns, %d points>' % (self.datafile, len(self.columns), len(self))
+
+    def __len__(self):
+        for c in self.columns.values():
+            return len(c)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def keys(self):
+        return self.columns.keys()
+
+    def array(self):
+        return numpy.column_stack(list(self.columns.values()))
+
+
+def read_sidecar(filename, columns=None, mmap=True):
+    '''Read the sidecar of a data file (or a sidecar file by name).'''
+    filename = sidecar_name(filename)
+    if not os.path.isfile(filename):
+        print(error_msg('%s does not exist' % filename))
+        return None
+    return Sidecar(filename, columns=columns, mmap=mmap)
+
+
+def load_experiment(folder=None, pattern='*', columns=None, mmap=True):
+    '''Load every sidecar in a folder without parsing any text.
+
+      folder:  data folder, default is BMMuser.folder
+      pattern: glob pattern of the data files, e.g. 'Fe-foil.*'
+      columns: list of column names to load, default is all
+      mmap:    memory-map columns from uncompressed sidecars
+
+    Return an ordered dict of Sidecar objects keyed by data file name.
+    '''
+    if folder is None:
+        folder = user_ns['BMMuser'].folder
+    experiment = OrderedDict()
+    mapped = 0
+    for filename in sorted(glob.glob(os.path.join(folder, pattern + SIDECAR_EXTENSION))):
+        try:
+            s = Sidecar(filename, columns=columns, mmap=mmap)
+        except Exception as e:
+            print(warning_msg('could not read %s: %s' % (filename, e)))
+            continue
+        experiment[s.datafile] = s
+        mapped += s.mapped
+    print(whisper('loaded %d sidecars from %s (%d columns memory-mapped)' % (len(experiment), folder, mapped)))
+    return experiment
@@ -19,6 +19,8 @@ from BMM.functions     import countdown
 from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
 from BMM.derivedplot   import DerivedPlot, interpret_click
 from BMM.metadata      import bmm_metadata
+from BMM.runcache      import runcache
+from BMM.xdi           import XDIFileWriter, write_XDI, xdi_complete
 
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
@@ -129,6 +131,12 @@ def timescan(detector, readings, dwell, delay, force=False, md={}):
     thismd['XDI']['Scan']['dwell_time'] = dwell
     thismd['XDI']['Scan']['delay']      = delay
     
+    ## a time scan with an XDI _filename in its metadata (i.e. sead)
+    ## is written to disk as it is measured
+    if type(plot) is not list:
+        plot = [plot]
+    plot.append(XDIFileWriter())
+
     @subs_decorator(plot)
     #@subs_decorator(src.callback)
     def count_scan(dets, readings, delay):
@@ -319,6 +327,7 @@ def sead(inifile, force=False, **kwargs):
         md['XDI']['Column']['04'] = md['XDI']['Column']['05']
         del(md['XDI']['Column']['05'])
         md['_kind'] = 'sead'
+        md['_filename'] = outfile
 
         rightnow = metadata_at_this_moment() # see 62-metadata.py
         for family in rightnow.keys():       # transfer rightnow to md
@@ -357,9 +366,11 @@ def sead(inifile, force=False, **kwargs):
         uid = yield from timescan(detector, p['npoints'], p['dwell'], p['delay'], force=force, md={**xdi})
         
         ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
-        ## write the output file
-        header = db[uid]
-        write_XDI(outfile, header) # yield from ?
+        ## the output file was written by the XDIFileWriter in timescan(),
+        ## write it from the run cache if that went wrong
+        if not xdi_complete(outfile, runcache[uid]):
+            print(warning_msg('%s is missing or incomplete, writing it from the run cache' % outfile))
+            write_XDI(outfile, runcache[uid])
         report('wrote time scan to %s' % outfile)
         #BMM_log_info('wrote time scan to %s' % outfile)
         #print(bold_msg('wrote %s' % outfile))
@@ -33,6 +33,7 @@ class BMM_User(Borg):
       * macro_sleep:      float, the length of that sleep
       * motor_fault:      normally None, set to a string when motors are found in a fault state
       * detector:         4=4-element detector, 1=1-element detector
+      * sidecar:          False, 'compressed', or 'mappable' -- write an HDF5 sidecar with each XDI file
       * use_pilatus:      flas, True make a folder for Pilatus images
       * echem:            flag, True is doing electrochemistry with the BioLogic
       * echem_remote:     mounted path to cifs share on ws3
@@ -70,6 +71,13 @@ class BMM_User(Borg):
       * channelcut:       flag for measuring in pseudo-channel-cut mode
       * ththth:           flag for measuring with the Si(333) reflection
       * mode:             in-scan plotting mode
+      * scantype:         step or slew (continuous motion of the mono)
+      * adaptive:         flag for refining the XANES grid from the data as it is measured
+      * budget:           fraction of the edge-region points measured by an adaptive scan
+      * livechi:          flag for showing chi(k) and |chi(R)| during an EXAFS scan
+      * precision:        count each point until mu has this relative uncertainty, 0 = use the times grid
+      * maxdwell:         most seconds spent at one point when counting to a precision
+      * subframe:         length of one sub-frame when counting to a precision
 
     Single energy time scan attributes, default values
       * npoints:          number of time points
@@ -103,6 +111,7 @@ class BMM_User(Borg):
         self.use_slack       = True
         self.slack_channel   = None
         self.trigger         = False
+        self.sidecar         = False
         
         self.macro_dryrun    = False  ############################################################################
         self.macro_sleep     = 2      # These are used to help macro writers test motor motions in their macros. #
@@ -167,6 +176,13 @@ class BMM_User(Borg):
         self.channelcut    = True
         self.ththth        = False
         self.mode          = 'transmission'
+        self.scantype      = 'step'
+        self.adaptive      = False
+        self.budget        = 0.5
+        self.livechi       = True
+        self.precision     = 0
+        self.maxdwell      = 10
+        self.subframe      = 0.25
         self.npoints       = 0     ###########################################################################
         self.dwell         = 1.0   ## parameters for single energy absorption detection, see 72-timescans.py #
         self.delay         = 0.1   ###########################################################################
@@ -213,7 +229,7 @@ class BMM_User(Borg):
         print('Experiment attributes:')
         for att in ('DATA', 'prompt', 'final_log_entry', 'date', 'gup', 'saf', 'name', 'staff', 
                     'read_rois', 'user_is_defined', 'pds_mode', 'macro_dryrun', 'macro_sleep', 'motor_fault',
-                    'detector', 'use_pilatus', 'echem', 'echem_remote'):
+                    'detector', 'use_pilatus', 'echem', 'echem_remote', 'sidecar'):
             print('\t%-15s = %s' % (att, str(getattr(self, att))))
 
         print('\nROI control attributes:')
@@ -232,7 +248,7 @@ class BMM_User(Borg):
             print('\nScan control attributes:')
             for att in ('pds_mode', 'bounds', 'steps', 'times', 'folder', 'filename',
                         'experimenters', 'e0', 'element', 'edge', 'sample', 'prep', 'comment', 'nscans', 'start', 'inttime',
-                        'snapshots', 'usbstick', 'rockingcurve', 'htmlpage', 'bothways', 'channelcut', 'ththth', 'mode', 'npoints',
+                        'snapshots', 'usbstick', 'rockingcurve', 'htmlpage', 'bothways', 'channelcut', 'ththth', 'mode', 'scantype', 'adaptive', 'budget', 'livechi', 'precision', 'maxdwell', 'subframe', 'npoints',
                         'dwell', 'delay'):
                 print('\t%-15s = %s' % (att, str(getattr(self, att))))
         
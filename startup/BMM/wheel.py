@@ -8,7 +8,9 @@ from bluesky.plan_stubs import null, abs_set, sleep, mv, mvr
 
 from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
 from BMM.motors        import EndStationEpicsMotor
-from BMM.periodictable import PERIODIC_TABLE
+from BMM.periodictable import PERIODIC_TABLE, edge_energy
+from BMM.estimator     import estimator
+from BMM.scangrid      import scan_grid
 from BMM.logging       import report
 
 from IPython import get_ipython
@@ -143,6 +145,12 @@ def show_reference_wheel():
 
 
 
+## rough overheads, in seconds, used to compare sample orders
+CHANGE_EDGE_TIME = 420    # change_edge, including the rocking curve and slit height scans
+SLOT_TIME        = 2      # per slot of wheel rotation
+SLIT_TIME        = 3      # a change of slits3 width
+STAGE_TIME       = 5      # a move of xafs_x or xafs_y
+
 class WheelMacroBuilder():
     '''A class for parsing specially constructed spreadsheets and
     generating macros for measuring XAS on the BMM wheel.
@@ -168,8 +176,10 @@ class WheelMacroBuilder():
         self.do_first_change = False
         self.has_e0_column   = False
         self.verbose         = False
+        self.optimize        = False
+        self.pinned          = ()
 
-    def spreadsheet(self, spreadsheet, energy=False):
+    def spreadsheet(self, spreadsheet, energy=False, optimize=False, pinned=()):
         '''Convert a wheel macro spreadsheet to a BlueSky plan.
 
         To create a macro from a spreadsheet called "MySamples.xlsx"
@@ -180,7 +190,18 @@ class WheelMacroBuilder():
 
             xlsx('MySamples', energy=True)
 
+        To reorder the samples to save time (see optimize_order):
+
+            xlsx('MySamples', optimize=True)
+
+        To keep the samples in slots 1 and 12 where they are in the
+        spreadsheet, reordering only the samples between them:
+
+            xlsx('MySamples', optimize=True, pinned=(1,12))
+
         '''
+        self.optimize = optimize
+        self.pinned   = pinned
         if spreadsheet[-5:] != '.xlsx':
             spreadsheet = spreadsheet+'.xlsx'
         self.source   = os.path.join(self.folder, spreadsheet)
@@ -282,6 +303,141 @@ class WheelMacroBuilder():
         return default
 
         
+    def estimate_time(self, m):
+        '''Estimate the time in minutes of the scan sequence in one row of
+        the spreadsheet, using the default row for empty cells.  Return
+        the estimator's dict, or None if the scan grid cannot be
+        interpreted.'''
+        p = dict()
+        for k in ('bounds', 'steps', 'times', 'nscans', 'mode', 'bothways', 'element', 'edge', 'ththth'):
+            p[k] = m[k]
+            if p[k] is None or (type(p[k]) is str and len(p[k].strip()) == 0):
+                p[k] = self.measurements[0][k]
+        for k in ('bounds', 'steps', 'times'):
+            values = []
+            for f in re.split('[ \t,]+', str(p[k]).strip()):
+                try:
+                    values.append(float(f))
+                except:
+                    values.append(f)
+            p[k] = values
+        p['nscans'] = p['nscans'] or 1
+        p['mode']   = p['mode'] or 'transmission'
+        e0 = edge_energy(p['element'], p['edge']) or 7112
+        try:
+            grid = scan_grid(p['bounds'], p['steps'], p['times'], e0=e0, ththth=p['ththth'], crystal=user_ns['dcm']._crystal)
+        except Exception:
+            return None
+        if not grid.valid:
+            return None
+        return estimator.estimate(grid, p)
+
+    def measurable(self, m):
+        '''All the reasons to skip a line in the spreadsheet.'''
+        if m['default'] is True:
+            return False
+        if type(m['slot']) is not int:
+            return False
+        if m['filename'] is None or re.search('^\s*$', m['filename']) is not None:
+            return False
+        if  self.truefalse(m['measure']) is False:
+            return False
+        if m['nscans'] is not None and m['nscans'] < 1:
+            return False
+        return True
+
+    ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+    ## sample order optimization
+    def _edge(self, m):
+        return (m['element'] or self.measurements[0]['element'], m['edge'] or self.measurements[0]['edge'])
+
+    def transition_time(self, a, b):
+        '''Estimated overhead, in seconds, of going from measuring row a
+        to measuring row b: an edge change, the wheel rotation, and slit
+        and sample stage moves.  a is None at the start of the macro.'''
+        if a is None:
+            edge = (self.measurements[0]['element'], self.measurements[0]['edge'])
+            cost = CHANGE_EDGE_TIME if self.do_first_change or self._edge(b) != edge else 0
+            return cost
+        cost = 0
+        if self._edge(a) != self._edge(b):
+            cost += CHANGE_EDGE_TIME
+        distance = abs(a['slot'] - b['slot']) % 24
+        cost += SLOT_TIME * min(distance, 24-distance)
+        if b['slitwidth'] is not None and b['slitwidth'] != a['slitwidth']:
+            cost += SLIT_TIME
+        if b['samplex'] is not None or b['sampley'] is not None:
+            cost += STAGE_TIME
+        return cost
+
+    def order_time(self, rows, previous=None):
+        '''Estimated overhead, in seconds, of measuring rows in order.'''
+        total = 0
+        for m in rows:
+            total += self.transition_time(previous, m)
+            previous = m
+        return total
+
+    def _sweep(self, rows, start):
+        '''Order rows on the same edge for the least wheel rotation,
+        starting from a slot: go one way around the wheel, perhaps
+        turning back once.'''
+        ahead = sorted(rows, key=lambda m: (m['slot'] - start) % 24)
+        d = [(m['slot'] - start) % 24 for m in ahead]
+        best, order = None, ahead
+        for i in range(len(ahead)+1):
+            cw  = d[i-1] if i > 0 else 0                    # farthest point reached going forward
+            ccw = 24 - d[i] if i < len(ahead) else 0        # farthest point reached going backward
+            for (cost, these) in ((2*cw + ccw, ahead[:i] + ahead[i:][::-1]),
+                                  (2*ccw + cw, ahead[i:][::-1] + ahead[:i])):
+                if best is None or cost < best:
+                    best, order = cost, these
+        return order
+
+    def _polish(self, rows, previous):
+        '''Improve an order by reversing stretches of it (2-opt).'''
+        improved = True
+        while improved:
+            improved = False
+            for i in range(len(rows)-1):
+                for j in range(i+2, len(rows)+1):
+                    candidate = rows[:i] + rows[i:j][::-1] + rows[j:]
+                    if self.order_time(candidate, previous) < self.order_time(rows, previous) - 1e-6:
+                        rows, improved = candidate, True
+        return rows
+
+    def optimize_order(self, rows):
+        '''Reorder the rows to be measured to save time.  Samples on the
+        same edge are measured together, edges in the order they first
+        appear in the spreadsheet, and the samples on an edge in the
+        order which needs the least wheel rotation.  Rows in pinned
+        slots stay where they are and only the rows between them are
+        reordered.'''
+        result, segment, previous = [], [], None
+
+        def reorder(segment, previous):
+            groups = dict()
+            for m in segment:
+                groups.setdefault(self._edge(m), []).append(m)
+            current = self._edge(previous) if previous is not None else self._edge(self.measurements[0])
+            if current in groups:                       # stay on the present edge first
+                groups = {current: groups.pop(current), **groups}
+            ordered = []
+            for these in groups.values():
+                start = (ordered or [previous])[-1]['slot'] if (ordered or previous) else these[0]['slot']
+                ordered.extend(self._sweep(these, start))
+            return self._polish(ordered, previous)
+
+        for m in rows:
+            if m['slot'] in self.pinned:
+                result.extend(reorder(segment, previous))
+                result.append(m)
+                segment, previous = [], m
+            else:
+                segment.append(m)
+        result.extend(reorder(segment, previous))
+        return result
+
     def write_macro(self):
         '''Write a macro paragraph for each sample described in the
         spreadsheet.  A paragraph consists of line to move to the
@@ -290,27 +446,25 @@ class WheelMacroBuilder():
         control parameters, and a line to close plot windows after the
         scan.  
 
+        With self.optimize set, the samples are reordered first (see
+        optimize_order).
+
         Finally, write out the master INI and macro python files.
         '''
-        element, edge, focus = (None, None, None)
+        element, edge, focus = (self.measurements[0]['element'], self.measurements[0]['edge'], None)
         self.content = ''
-        for m in self.measurements:
-
-            #####################################################
-            # all the reasons to skip a line in the spreadsheet #
-            #####################################################
-            if m['default'] is True:
-                element = m['element']
-                edge    = m['edge']
-                continue
-            if type(m['slot']) is not int:
-                continue
-            if m['filename'] is None or re.search('^\s*$', m['filename']) is not None:
-                continue
-            if  self.truefalse(m['measure']) is False:
-                continue
-            if m['nscans'] is not None and m['nscans'] < 1:
-                continue
+        total, variance, measured = 0, 0, True
+        rows = [m for m in self.measurements if self.measurable(m)]
+        if self.optimize:
+            ordered = self.optimize_order(rows)
+            before, after = self.order_time(rows), self.order_time(ordered)
+            changes = lambda these: sum(1 for a,b in zip([None]+these[:-1], these) if a is not None and self._edge(a) != self._edge(b))
+            print(bold_msg('Reordered samples: about %.1f minutes of edge changes and motor moves, rather than %.1f in spreadsheet order (%d edge changes rather than %d)' %
+                           (after/60, before/60, changes(ordered), changes(rows))))
+            print(whisper('Estimated time saved: %.1f minutes' % ((before-after)/60)))
+            rows = ordered
+        overhead = self.order_time(rows)/60   # before the loop resets do_first_change
+        for m in rows:
 
             #######################################
             # default element/edge(/focus) values #
@@ -379,6 +533,16 @@ class WheelMacroBuilder():
                     else:
                         command += ', %s=\'%s\'' % (k, m[k])
             command += ')\n'
+            est = self.estimate_time(m)
+            if est is None:
+                measured = False
+            else:
+                total += est['total']
+                if est['halfwidth'] is None:
+                    measured = False
+                else:
+                    variance += (est['halfwidth']/1.96)**2
+                self.content += self.tab + '## estimated time: %.1f minutes\n' % est['total']
             self.content += command
             self.content += self.tab + 'close_last_plot()\n\n'
 
@@ -427,6 +591,11 @@ class WheelMacroBuilder():
         print('\nVerify: ' + bold_msg('%s_macro??' % self.basename))
         print('Dryrun: '   + bold_msg('RE(%s_macro(dryrun=True))' % self.basename))
         print('Run:    '   + bold_msg('RE(%s_macro())' % self.basename))
+        if measured and variance > 0:
+            print('\nThis macro will take about %.1f hours, give or take %.1f minutes (95%% interval), including about %.0f minutes of edge changes and motor moves' %
+                  ((total+overhead)/60, 1.96*variance**0.5, overhead))
+        else:
+            print('\nThis macro will take about %.1f hours, including about %.0f minutes of edge changes and motor moves' % ((total+overhead)/60, overhead))
 
             
     def read_spreadsheet(self):
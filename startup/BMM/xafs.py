@@ -10,19 +10,29 @@ import matplotlib
 import matplotlib.pyplot as plt
 
 from BMM.camera_device import snap
-from BMM.demeter       import toprj
+from BMM.countuntil    import CountUntil
+from BMM.adaptive      import absorption, adaptive_xanes
 from BMM.derivedplot   import DerivedPlot, interpret_click, close_all_plots, close_last_plot
-from BMM.functions     import countdown, boxedtext, now, isfloat, inflect, e2l, etok, ktoe
-from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
+from BMM.estimator     import estimator
+from BMM.flyscan       import fly_energy_scan, fly_segments, velocity_ok
+from BMM.functions     import boxedtext, now, isfloat, inflect, e2l, ktoe
+from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, whisper
 from BMM.linescans     import rocking_curve
+from BMM.livechi       import LiveChi
 from BMM.logging       import BMM_log_info, BMM_msg_hook, report
 from BMM.metadata      import bmm_metadata, display_XDI_metadata, metadata_at_this_moment
 from BMM.modes         import get_mode, describe_mode
 from BMM.motor_status  import motor_sidebar, motor_status
 from BMM.periodictable import edge_energy, Z_number, element_name
+from BMM.postscan      import postscan, xafs_postscan, sequence_postscan
+from BMM.preflight     import preflight, dryrun
+from BMM.quadplot      import is_exafs
+from BMM.runcache      import runcache
+from BMM.perstep       import FusedStep, with_step_timing
 from BMM.resting_state import resting_state_plan
+from BMM.scangrid      import scan_grid, CS_MULTIPLIER
 from BMM.suspenders    import BMM_suspenders, BMM_clear_to_start
-from BMM.xdi           import write_XDI
+from BMM.xdi           import write_XDI, XDIFileWriter
 
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
@@ -35,7 +45,6 @@ user_ns = get_ipython().user_ns
 CS_BOUNDS     = [-200, -30, 15.3, '14k']
 CS_STEPS      = [10, 0.5, '0.05k']
 CS_TIMES      = [0.5, 0.5, '0.25k']
-CS_MULTIPLIER = 0.72
 
 
 def next_index(folder, stub):
@@ -178,6 +187,13 @@ def scan_metadata(inifile=None, **kwargs):
       channelcut:   [bool]  True = measure in pseudo-channel-cut mode
       ththth:       [bool]  True = measure using the Si(333) reflection
       mode:         [str]   transmission, fluorescence, or reference -- how to display the data
+      scantype:     [str]   step = conventional step scan, slew (or fly) = continuous motion of the mono
+      adaptive:     [bool]  True = refine the XANES grid from the data as it is measured (see BMM/adaptive.py)
+      budget:       [float] fraction of the edge-region points measured by an adaptive scan
+      livechi:      [bool]  True = show chi(k) and |chi(R)| as an EXAFS scan is measured (see BMM/livechi.py)
+      precision:    [float] count each point until mu has this relative uncertainty, 0 = use the times grid (see BMM/countuntil.py)
+      maxdwell:     [float] most seconds spent at one point when counting to a precision
+      subframe:     [float] length in seconds of one sub-frame when counting to a precision
       bounds:       [list]  scan grid boundaries (not kwarg-able at this time)
       steps:        [list]  scan grid step sizes (not kwarg-able at this time)
       times:        [list]  scan grid dwell times (not kwarg-able at this time)
@@ -238,7 +254,7 @@ def scan_metadata(inifile=None, **kwargs):
 
     ## ----- strings
     for a in ('folder', 'experimenters', 'element', 'edge', 'filename', 'comment',
-              'mode', 'sample', 'prep'):
+              'mode', 'sample', 'prep', 'scantype'):
         found[a] = False
         if a not in kwargs:
             try:
@@ -254,6 +270,12 @@ def scan_metadata(inifile=None, **kwargs):
         print(error_msg('\nfolder %s does not exist\n' % parameters['folder']))
         return {}, {}
     parameters['mode'] = parameters['mode'].lower()
+    parameters['scantype'] = parameters['scantype'].lower()
+    if parameters['scantype'] == 'fly':
+        parameters['scantype'] = 'slew'
+    if parameters['scantype'] not in ('step', 'slew'):
+        print(error_msg('\nscantype must be "step" or "slew" (or "fly")\n'))
+        return {}, {}
     
     ## ----- start value
     if 'start' not in kwargs:
@@ -289,7 +311,7 @@ def scan_metadata(inifile=None, **kwargs):
             found[a] = True
 
     ## ----- floats
-    for a in ('e0', 'inttime', 'dwell', 'delay'):
+    for a in ('e0', 'inttime', 'dwell', 'delay', 'budget', 'precision', 'maxdwell', 'subframe'):
         found[a] = False
         if a not in kwargs:
             try:
@@ -302,7 +324,7 @@ def scan_metadata(inifile=None, **kwargs):
             found[a] = True
 
     ## ----- booleans
-    for a in ('snapshots', 'htmlpage', 'bothways', 'channelcut', 'usbstick', 'rockingcurve', 'ththth'):
+    for a in ('snapshots', 'htmlpage', 'bothways', 'channelcut', 'usbstick', 'rockingcurve', 'ththth', 'adaptive', 'livechi'):
         found[a] = False
         if a not in kwargs:
             try:
@@ -370,6 +392,10 @@ def conventional_grid(bounds=CS_BOUNDS, steps=CS_STEPS, times=CS_TIMES, e0=7112,
     So at 5 invAng, integrate for 2.5 seconds.  At 10 invAng,
     integrate for 5 seconds.
 
+    The grid itself is computed by (and cached in) BMM.scangrid.scan_grid,
+    which returns an immutable ScanGrid object.  The bounds list is
+    not modified.
+
     Examples:
        -- this is the default (same as (g,it,at) = conventional_grid()):
        (grid, inttime, time) = conventional_grid(bounds=[-200, -30, 15.3, '14k'],
@@ -391,41 +417,10 @@ def conventional_grid(bounds=CS_BOUNDS, steps=CS_STEPS, times=CS_TIMES, e0=7112,
                                                  steps=[0.25,],
                                                  times=[0.5,], e0=7112)
     '''
-    if (len(bounds) - len(steps)) != 1:
-        return (None, None, None)
-    if (len(bounds) - len(times)) != 1:
-        return (None, None, None)
-    for i,s in enumerate(bounds):
-        if type(s) is str:
-            this = float(s[:-1])
-            bounds[i] = ktoe(this)
-    bounds.sort()
-
-    enot = e0
-    if ththth:
-        enot = e0/3.0
-        bounds = list(array(bounds)/3)
-    grid = list()
-    timegrid = list()
-    for i,s in enumerate(steps):
-        if type(s) is str:
-            step = float(s[:-1])
-            if ththth: step = step/3.
-            ar = enot + ktoe(numpy.arange(etok(bounds[i]), etok(bounds[i+1]), step))
-        else:
-            step = steps[i]
-            if ththth: step = step/3.
-            ar = numpy.arange(enot+bounds[i], enot+bounds[i+1], step)
-        grid = grid + list(ar)
-        grid = list(numpy.round(grid, decimals=2))
-        if type(times[i]) is str:
-            tar = etok(ar-enot)*float(times[i][:-1])
-        else:
-            tar = times[i]*numpy.ones(len(ar))
-        timegrid = timegrid + list(tar)
-        timegrid = list(numpy.round(timegrid, decimals=2))
-    approximate_time = (sum(timegrid) + float(len(timegrid))*CS_MULTIPLIER) / 60.0
-    return (grid, timegrid, round(approximate_time, 1))
+    crystal = '111'
+    if 'dcm' in user_ns:
+        crystal = user_ns['dcm']._crystal
+    return scan_grid(bounds, steps, times, e0=e0, ththth=ththth, crystal=crystal).lists()
 
 ## -----------------------
 ##  energy step scan plan concept
@@ -451,10 +446,7 @@ def conventional_grid(bounds=CS_BOUNDS, steps=CS_STEPS, times=CS_TIMES, e0=7112,
 def channelcut_energy(e0, bounds, ththth):
     '''From the scan parameters, find the energy at the center of the angular range of the scan.'''
     dcm = user_ns['dcm']
-    for i,s in enumerate(bounds):
-        if type(s) is str:
-            this = float(s[:-1])
-            bounds[i] = ktoe(this)
+    bounds = sorted(ktoe(float(s[:-1])) if type(s) is str else s for s in bounds)
     amin = dcm.e2a(e0+bounds[0])
     amax = dcm.e2a(e0+bounds[-1])
     if ththth:
@@ -494,7 +486,7 @@ def db2xdi(datafile, key):
     The arguments are the resolved path to the output XDI file and
     a database key.
     '''
-    BMMuser, db = user_ns['BMMuser'], user_ns['db']
+    BMMuser = user_ns['BMMuser']
     dfile = datafile
     if BMMuser.DATA not in dfile:
         if 'bucket' not in BMMuser.DATA:
@@ -502,7 +494,7 @@ def db2xdi(datafile, key):
     if os.path.isfile(dfile):
         print(error_msg('%s already exists!  Bailing out....' % dfile))
         return
-    header = db[key]
+    header = runcache[key]
     ## sanity check, make sure that db returned a header AND that the header was an xafs scan
     write_XDI(dfile, header)
     print(bold_msg('wrote %s' % dfile))
@@ -541,6 +533,7 @@ def scan_sequence_static_html(inifile       = None,
                               htmlpage      = None,
                               ththth        = None,
                               initext       = None,
+                              grid          = None,
                               ):
     '''
     Gather information from various places, including html_dict, a temporary dictionary 
@@ -550,6 +543,8 @@ def scan_sequence_static_html(inifile       = None,
     BMMuser, dcm = user_ns['BMMuser'], user_ns['dcm']
     if filename is None or start is None:
         return None
+    if bounds is None and grid is not None:
+        bounds = ' '.join(map(str, grid.given_bounds))
     firstfile = "%s.%3.3d" % (filename, start)
     if not os.path.isfile(os.path.join(BMMuser.DATA, firstfile)):
         return None
@@ -567,11 +562,10 @@ def scan_sequence_static_html(inifile       = None,
         htmlfilename = os.path.join(BMMuser.DATA, 'dossier', "%s-%2.2d.html" % (filename,seqnumber))
 
 
-    ## generate a png image, preferably of a quadplot of the data, using Demeter
-    try:
-        pngfile = toprj(folder=BMMuser.DATA, name=filename, base=basename, start=start, end=end, bounds=bounds, mode=mode)
-    except Exception as e:
-        print(e)
+    ## merge the sequence and make a png image of a quadplot of the merge in
+    ## a post-scan worker, the html page refers to the image by name
+    postscan.submit(f'merge and dossier quad plot of {basename}', sequence_postscan,
+                    BMMuser.DATA, filename, basename, start, end, bounds, mode)
 
     if initext is None:
         with open(os.path.join(BMMuser.DATA, inifile)) as f:
@@ -759,11 +753,12 @@ def xafs(inifile, **kwargs):
         ## user verification (disabled by BMMuser.prompt)
         if verbose: print(verbosebold_msg('computing pseudo-channelcut energy')) 
         eave = channelcut_energy(p['e0'], p['bounds'], p['ththth'])
+        grid = scan_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], ththth=p['ththth'], crystal=dcm._crystal)
         length = 0
         if BMMuser.prompt:
             text = '\n'
             for k in ('bounds', 'bounds_given', 'steps', 'times'):
-                addition = '      %-13s : %-50s\n' % (k,p[k])
+                addition = '      %-13s : %-50s\n' % (k, list(grid.bounds) if k == 'bounds' else p[k])
                 text = text + addition.rstrip() + '\n'
                 if len(addition) > length: length = len(addition)
             for (k,v) in p.items():
@@ -847,42 +842,20 @@ def xafs(inifile, **kwargs):
         
         ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
         ## set up a plotting subscription, anonymous functions for plotting various forms of XAFS
-        test  = lambda doc: (doc['data']['dcm_energy'], doc['data']['I0'])
-        trans = lambda doc: (doc['data']['dcm_energy'], numpy.log(doc['data']['I0'] / doc['data']['It']))
-        ref   = lambda doc: (doc['data']['dcm_energy'], numpy.log(doc['data']['It'] / doc['data']['Ir']))
-        Yield = lambda doc: (doc['data']['dcm_energy'], 1000*doc['data']['Iy'] / doc['data']['I0'])
-        if BMMuser.detector == 1:
-            fluo  = lambda doc: (doc['data']['dcm_energy'], doc['data'][BMMuser.dtc1] / doc['data']['I0'])
-        else:
-            fluo  = lambda doc: (doc['data']['dcm_energy'], (doc['data'][BMMuser.dtc1] +
-                                                             doc['data'][BMMuser.dtc2] + # removed doc['data'][BMMuser.dtc3] +
-                                                             doc['data'][BMMuser.dtc4]) / doc['data']['I0'])
-        if 'fluo'    in p['mode'] or 'flou' in p['mode']:
-            plot =  DerivedPlot(fluo,  xlabel='energy (eV)', ylabel='absorption (fluorescence)',    title=p['filename'])
-        elif 'trans' in p['mode']:
-            plot =  DerivedPlot(trans, xlabel='energy (eV)', ylabel='absorption (transmission)',    title=p['filename'])
-        elif 'ref'   in p['mode']:
-            plot =  DerivedPlot(ref,   xlabel='energy (eV)', ylabel='absorption (reference)',       title=p['filename'])
+        ## (the functions of the data are in BMM/adaptive.py, where they are also used to refine an adaptive scan)
+        functions = absorption(p['mode'])
+        if functions is None:
+            print(error_msg('Plotting mode not specified, falling back to a transmission plot'))
+            functions = absorption('transmission')
         elif 'yield' in p['mode']:
             quadem1.Iy.kind = 'hinted'
-            plot = [DerivedPlot(Yield, xlabel='energy (eV)', ylabel='absorption (electron yield)',  title=p['filename']),
-                    DerivedPlot(trans, xlabel='energy (eV)', ylabel='absorption (transmission)',    title=p['filename'])]
-        elif 'test'  in p['mode']:
-            plot =  DerivedPlot(test,  xlabel='energy (eV)', ylabel='I0 (test)',                    title=p['filename'])
-        elif 'both'  in p['mode']:
-            plot = [DerivedPlot(trans, xlabel='energy (eV)', ylabel='absorption (transmission)',    title=p['filename']),
-                    DerivedPlot(fluo,  xlabel='energy (eV)', ylabel='absorption (fluorescence)',    title=p['filename'])]
         elif 'xs'    in p['mode']:
             yield from mv(xs.settings.acquire_time, 0.5)
-            xspress3 = lambda doc: (doc['data']['dcm_energy'], (doc['data'][BMMuser.xs1] +
-                                                                doc['data'][BMMuser.xs2] +
-                                                                doc['data'][BMMuser.xs3] +
-                                                                doc['data'][BMMuser.xs4] ) / doc['data']['I0'])
             #yield from mv(xs.total_points, len(energy_grid))
-            plot =  DerivedPlot(xspress3, xlabel='energy (eV)', ylabel='If / I0 (Xspress3)',        title=p['filename'])
-        else:
-            print(error_msg('Plotting mode not specified, falling back to a transmission plot'))
-            plot =  DerivedPlot(trans, xlabel='energy (eV)', ylabel='absorption (transmission)',    title=p['filename'])
+        plot = [DerivedPlot(f, xlabel='energy (eV)', ylabel=ylabel, title=p['filename'], sort=p['adaptive']) for (f, ylabel) in functions]
+        ## a second window with chi(k) and |chi(R)| of the data so far, for an EXAFS scan
+        if p['livechi'] and 'test' not in p['mode'] and is_exafs(' '.join(map(str, p['bounds']))):
+            plot.append(LiveChi(functions[0][0], p['e0'], title=p['filename']))
 
 
         ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
@@ -897,16 +870,38 @@ def xafs(inifile, **kwargs):
             BMM_suspenders()
             
         ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
-        ## begin the scan sequence with the plotting subscription
+        ## each data file is written row by row as the scan happens
+        if type(plot) is not list:
+            plot = [plot]
+        plot.append(XDIFileWriter(folder=p['folder']))
+
+        ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+        ## begin the scan sequence with the plotting and XDI writing subscriptions
         @subs_decorator(plot)
         #@subs_decorator(src.callback)
         def scan_sequence(clargs):
             ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
             ## compute energy and dwell grids
             print(bold_msg('computing energy and dwell time grids'))
-            (energy_grid, time_grid, approx_time) = conventional_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], ththth=p['ththth'])
+            (energy_grid, time_grid, approx_time) = grid.lists()
             if 'xs' in p['mode']:
                 yield from mv(xs.total_points, len(energy_grid))
+                if p['scantype'] == 'slew':
+                    print(warning_msg('The Xspress3 cannot be read on the fly, measuring as a step scan'))
+                    p['scantype'] = 'step'
+            if p['adaptive'] and p['scantype'] == 'slew':
+                print(warning_msg('An adaptive scan cannot be measured on the fly, measuring as a step scan'))
+                p['scantype'] = 'step'
+            if p['precision'] > 0 and p['scantype'] == 'slew':
+                print(warning_msg('Counting until a precision is reached requires a step scan, measuring as a step scan'))
+                p['scantype'] = 'step'
+            if p['precision'] > 0 and p['adaptive']:
+                print(warning_msg('An adaptive scan is measured with the dwell times of the scan grid, ignoring precision'))
+            if p['precision'] > 0 and (p['subframe'] <= 0 or p['maxdwell'] < p['subframe']):
+                print(error_msg('subframe must be positive and no larger than maxdwell.  Bailing out....'))
+                BMMuser.final_log_entry = False
+                yield from null()
+                return
             if energy_grid is None or time_grid is None or approx_time is None:
                 print(error_msg('Cannot interpret scan grid parameters!  Bailing out....'))
                 BMMuser.final_log_entry = False
@@ -932,6 +927,11 @@ def xafs(inifile, **kwargs):
                 BMMuser.final_log_entry = False
                 yield from null()
                 return
+            if p['scantype'] == 'slew' and not velocity_ok(dcm_bragg, fly_segments(dcm.e2a(numpy.array(energy_grid)), time_grid)):
+                print(error_msg('This scan grid cannot be measured on the fly.  Bailing out....'))
+                BMMuser.final_log_entry = False
+                yield from null()
+                return
 
 
             ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
@@ -943,7 +943,7 @@ def xafs(inifile, **kwargs):
                               element       = p['element'],
                               edge_energy   = p['e0'],
                               direction     = 1,
-                              scantype      = 'step',
+                              scantype      = p['scantype'],
                               channelcut    = p['channelcut'],
                               mono          = 'Si(%s)' % dcm._crystal,
                               i0_gas        = 'N2', #\
@@ -978,9 +978,10 @@ def xafs(inifile, **kwargs):
             html_dict['comment']       = p['comment']
             html_dict['mode']          = p['mode']
             html_dict['pccenergy']     = eave
-            html_dict['bounds']        = ' '.join(map(str, p['bounds_given'])) # see https://stackoverflow.com/a/5445983
-            html_dict['steps']         = ' '.join(map(str, p['steps']))
-            html_dict['times']         = ' '.join(map(str, p['times']))
+            html_dict['bounds']        = ' '.join(map(str, grid.given_bounds)) # see https://stackoverflow.com/a/5445983
+            html_dict['steps']         = ' '.join(map(str, grid.given_steps))
+            html_dict['times']         = ' '.join(map(str, grid.given_times))
+            html_dict['grid']          = grid
             html_dict['clargs']        = clargs
             html_dict['htmlpage']      = p['htmlpage']
             html_dict['ththth']        = p['ththth']
@@ -1016,7 +1017,7 @@ def xafs(inifile, **kwargs):
             ## write dotfile, used by cadashboard
             with open(dotfile, "w") as f:
                 f.write(str(datetime.datetime.timestamp(datetime.datetime.now())) + '\n')
-                f.write('%.1f\n' % (approx_time * int(p['nscans']) * 60))
+                f.write('%.1f\n' % (estimator.estimate(grid, p)['total'] * 60))
                 
             ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
             ## loop over scan count
@@ -1040,13 +1041,17 @@ def xafs(inifile, **kwargs):
 
                 if p['mode'] == 'xs':
                     yield from mv(xs.spectra_per_point, 1) 
-                    yield from mv(xs.total_points, len(energy_grid))
+                    if p['precision'] > 0:  # one frame per sub-frame, at most maxdwell/subframe at each point
+                        yield from mv(xs.total_points, len(energy_grid) * int(numpy.ceil(p['maxdwell']/p['subframe'])))
+                    else:
+                        yield from mv(xs.total_points, len(energy_grid))
 
                 
                 ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
                 ## compute trajectory
                 energy_trajectory    = cycler(dcm.energy, energy_grid)
                 dwelltime_trajectory = cycler(dwell_time, time_grid)
+                these_energies, these_times = energy_grid, time_grid
 
                 ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
                 ## need to set certain metadata items on a per-scan basis... temperatures, ring stats
@@ -1056,6 +1061,7 @@ def xafs(inifile, **kwargs):
                 if p['bothways'] and cnt%2 == 0:
                     energy_trajectory    = cycler(dcm.energy, energy_grid[::-1])
                     dwelltime_trajectory = cycler(dwell_time, time_grid[::-1])
+                    these_energies, these_times = energy_grid[::-1], time_grid[::-1]
                     md['Mono']['direction'] = 'backward'
                     #dcm_bragg.clear_encoder_loss()
                     yield from mv(dcm.energy, energy_grid[-1]+5)
@@ -1079,6 +1085,9 @@ def xafs(inifile, **kwargs):
                 
                 md['_kind'] = 'xafs'
                 if p['ththth']: md['_kind'] = '333'
+                md['_adaptive'] = p['adaptive']
+                if not p['adaptive'] and not p['precision'] > 0:
+                    md['_dwell_total'] = float(numpy.sum(these_times)) # used by the scan time estimator
 
                 xdi = {'XDI': md}
                 #mtr = {'BMM_motors' : motor_metadata()}
@@ -1086,33 +1095,46 @@ def xafs(inifile, **kwargs):
                 ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
                 ## call the stock scan_nd plan with the correct detectors
                 uid = None
-                if any(md in p['mode'] for md in ('trans', 'ref', 'yield', 'test')):
-                    uid = yield from scan_nd([quadem1], energy_trajectory + dwelltime_trajectory,
-                                             md={**xdi, **supplied_metadata})
-                elif p['mode'] == 'xs':
-                    uid= yield from scan_nd([quadem1, xs], energy_trajectory + dwelltime_trajectory,
-                                            md={**xdi, **supplied_metadata})
+                if p['scantype'] == 'slew':
+                    if any(md in p['mode'] for md in ('trans', 'ref', 'yield', 'test')):
+                        uid = yield from fly_energy_scan([quadem1], these_energies, these_times,
+                                                         md={**xdi, **supplied_metadata})
+                    else:
+                        uid = yield from fly_energy_scan([quadem1, vor], these_energies, these_times,
+                                                         md={**xdi, **supplied_metadata})
+                    if uid is None:
+                        print(error_msg('The fly scan did not run.  Bailing out....'))
+                        BMMuser.final_log_entry = False
+                        return
                 else:
-                    uid = yield from scan_nd([quadem1, vor], energy_trajectory + dwelltime_trajectory,
-                                             md={**xdi, **supplied_metadata})
-                ## here is where we would use the new SingleRunCache solution in databroker v1.0.3
-                ## see #64 at https://github.com/bluesky/tutorials
-                header = db[uid]
-                write_XDI(datafile, header)
-                print(bold_msg('wrote %s' % datafile))
-                BMM_log_info(f'energy scan finished, uid = {uid}, scan_id = {header.start["scan_id"]}\ndata file written to {datafile}')
+                    ## step scan, using the fused per-step so that the mono moves to the next point
+                    ## while each event is being saved, and so that the point overhead is measured
+                    if any(md in p['mode'] for md in ('trans', 'ref', 'yield', 'test')):
+                        dets = [quadem1]
+                    elif p['mode'] == 'xs':
+                        dets = [quadem1, xs]
+                    else:
+                        dets = [quadem1, vor]
+                    if p['adaptive']:
+                        uid = yield from adaptive_xanes(dets, these_energies, these_times, p['mode'], budget=p['budget'],
+                                                        md={**xdi, **supplied_metadata})
+                    else:
+                        trajectory = energy_trajectory + dwelltime_trajectory
+                        if p['precision'] > 0:
+                            fused = CountUntil(trajectory, dwell=dwell_time, mode=p['mode'], precision=p['precision'],
+                                               maxdwell=p['maxdwell'], subframe=p['subframe'])
+                        else:
+                            fused = FusedStep(trajectory, dwell=dwell_time)
+                        uid = yield from with_step_timing(scan_nd(dets, trajectory, per_step=fused,
+                                                                  md={**xdi, **supplied_metadata}), fused)
+                ## logging, data evaluation, and notification happen in
+                ## the background while the next repetition is measured
+                yield from postscan.queue_plan(f'post-scan processing of {fname}', xafs_postscan, uid, datafile, p['mode'])
 
-                ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
-                ## data evaluation
-                if any(md in p['mode'] for md in ('trans', 'fluo', 'flou', 'both', 'ref', 'xs')):
-                    score, emoji = user_ns['clf'].evaluate(uid, mode=p['mode'])
-                    report(f"Data evaluation: {score} {emoji}", level='bold', slack=True)
-                    ## FYI: db.v2[-1].metadata['start']['scan_id']
-                
                 ## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
                 ## generate left sidebar text for the static html page for this scan sequence
                 js_text = '<a href="javascript:void(0)" onclick="toggle_visibility(\'%s\');" title="This is the scan number for %s, click to show/hide its UID">#%d</a><div id="%s" style="display:none;"><small>%s</small></div>' \
-                          % (fname, fname, header.start['scan_id'], fname, uid)
+                          % (fname, fname, RE.md['scan_id'], fname, uid)
                 printedname = fname
                 if len(p['filename']) > 11:
                     printedname = fname[0:6] + '&middot;&middot;&middot;' + fname[-5:]
@@ -1140,20 +1162,21 @@ def xafs(inifile, **kwargs):
         RE.clear_suspenders()
         if os.path.isfile(dotfile):
             os.remove(dotfile)
+        yield from postscan.flush_plan()
 
-        db = user_ns['db']
-        ## db[-1].stop['num_events']['primary'] should equal db[-1].start['num_points'] for a complete scan
+        ## the stop document's num_events['primary'] should equal the start document's num_points for a complete scan
         how = 'finished'
         try:
-            if 'primary' not in db[-1].stop['num_events']:
+            start, stop = runcache.start_doc(-1), runcache.stop_doc(-1)
+            if 'primary' not in stop['num_events']:
                 how = 'stopped'
-            elif db[-1].stop['num_events']['primary'] != db[-1].start['num_points']:
+            elif stop['num_events']['primary'] != start['num_points']:
                 how = 'stopped'
         except:
             how = 'stopped'
         if BMMuser.final_log_entry is True:
             report(f'== XAFS scan sequence {how}', level='bold', slack=True)
-            BMM_log_info(f'most recent uid = {db[-1].start["uid"]}, scan_id = {db[-1].start["scan_id"]}')
+            BMM_log_info(f'most recent uid = {runcache.start_doc(-1)["uid"]}, scan_id = {runcache.start_doc(-1)["scan_id"]}')
             ## FYI: db.v2[-1].metadata['start']['scan_id']
             if 'htmlpage' in html_dict and html_dict['htmlpage']:
                 htmlout = scan_sequence_static_html(inifile=inifile, **html_dict)
@@ -1166,7 +1189,7 @@ def xafs(inifile, **kwargs):
         yield from abs_set(dcm_pitch.kill_cmd, 1, wait=True)
         yield from abs_set(dcm_roll.kill_cmd, 1, wait=True)
 
-    RE, BMMuser, dcm, dwell_time, db = user_ns['RE'], user_ns['BMMuser'], user_ns['dcm'], user_ns['dwell_time'], user_ns['db']
+    RE, BMMuser, dcm, dwell_time = user_ns['RE'], user_ns['BMMuser'], user_ns['dcm'], user_ns['dwell_time']
     dcm_bragg, dcm_pitch, dcm_roll, dcm_x = user_ns['dcm_bragg'], user_ns['dcm_pitch'], user_ns['dcm_roll'], user_ns['dcm_x']
     quadem1, vor = user_ns['quadem1'], user_ns['vor']
     try:
@@ -1181,17 +1204,22 @@ def xafs(inifile, **kwargs):
     # this is a tool for verifying a macro.  this replaces an xafs scan  #
     # with a sleep, allowing the user to easily map out motor motions in #
     # a macro                                                            #
-    if BMMuser.macro_dryrun:
+    if BMMuser.macro_dryrun or preflight.active:
         inifile, estimate = howlong(inifile, interactive=False, **kwargs)
         (p, f) = scan_metadata(inifile=inifile, **kwargs)
         if 'filename' in p:
-            print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds at sample "%s".\n' %
-                           (BMMuser.macro_sleep, p['filename'])))
+            text = 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds at sample "%s".' % (BMMuser.macro_sleep, p['filename'])
         else:
-            print(info_msg('\nBMMuser.macro_dryrun is True.  Sleeping for %.1f seconds.\nAlso there seems to be a problem with "%s".\n' %
-                           (BMMuser.macro_sleep, inifile)))
-        countdown(BMMuser.macro_sleep)
-        return(yield from null())
+            text = 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds.\nAlso there seems to be a problem with "%s".' % (BMMuser.macro_sleep, inifile)
+        ## the scan time model's prediction, for a preflight
+        seconds, dwell, last = 0, 0, None
+        if 'bounds' in p:
+            grid = scan_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], ththth=p['ththth'], crystal=dcm._crystal)
+            if grid.valid:
+                seconds = estimator.estimate(grid, p)['total'] * 60
+                dwell   = grid.dwell.sum() * p['nscans']
+                last    = float(grid.energy[-1])
+        return(yield from dryrun('xafs', text, seconds=seconds, dwell=dwell, energy=last, label=p.get('filename')))
     ######################################################################
     dotfile = '/home/xf06bm/Data/.xafs.scan.running'
     html_scan_list = ''
@@ -1242,15 +1270,29 @@ def howlong(inifile, interactive=True, **kwargs):
     if not ok:
         print(error_msg('\nThe following keywords are missing from your INI file: '), '%s\n' % str.join(', ', missing))
         return(orig, -1)
-    (energy_grid, time_grid, approx_time) = conventional_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], ththth=p['ththth'])
-    text = 'One scan of %d points will take about %.1f minutes\n' % (len(energy_grid), approx_time)
-    text +='The sequence of %s will take about %.1f hours' % (inflect('scan', p['nscans']), approx_time * int(p['nscans'])/60)
+    grid = scan_grid(p['bounds'], p['steps'], p['times'], e0=p['e0'], ththth=p['ththth'], crystal=user_ns['dcm']._crystal)
+    if not grid.valid:
+        print(error_msg('Cannot interpret scan grid parameters!\n'))
+        return(orig, -1)
+    (energy_grid, time_grid, approx_time) = grid.lists()
+    if interactive and estimator.stale():
+        try:
+            estimator.refresh()
+        except Exception as e:
+            print(warning_msg('could not refresh the scan time model: %s' % e))
+    est = estimator.estimate(grid, p)
+    text = 'One scan of %d points will take about %.1f minutes\n' % (len(energy_grid), est['scan'])
+    if est['halfwidth'] is None:
+        text +='The sequence of %s will take about %.1f hours' % (inflect('scan', p['nscans']), est['total']/60)
+    else:
+        text +='The sequence of %s will take about %.1f hours, give or take %.1f minutes (95%% interval, from %d past scans)' % \
+            (inflect('scan', p['nscans']), est['total']/60, est['halfwidth'], est['runs'])
 
     if interactive:
         length = 0
         bt = '\n'
         for k in ('bounds', 'bounds_given', 'steps', 'times'):
-            addition = '      %-13s : %-50s\n' % (k,p[k])
+            addition = '      %-13s : %-50s\n' % (k, list(grid.bounds) if k == 'bounds' else p[k])
             bt = bt + addition.rstrip() + '\n'
             if len(addition) > length: length = len(addition)
         for (k,v) in p.items():
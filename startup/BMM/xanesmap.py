@@ -0,0 +1,323 @@
+from bluesky.plan_stubs import abs_set, mv, null, trigger_and_read
+from bluesky.preprocessors import run_decorator, finalize_wrapper
+
+import numpy, os
+from math import asin, pi
+import matplotlib.pyplot as plt
+
+from BMM.functions     import HBARC, error_msg, warning_msg, bold_msg, whisper
+from BMM.logging       import BMM_log_info, BMM_msg_hook
+from BMM.preflight     import preflight, dryrun, travel_time, hms, DEFAULT_VELOCITY, TRIGGER_OVERHEAD, READOUT, EVENT
+from BMM.resting_state import resting_state_plan
+from BMM.runcache      import runcache
+from BMM.suspenders    import BMM_clear_to_start
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# XANES imaging: a stack of area maps at a list of energies             #
+#                                                                       #
+# xanes_map measures every pixel of a 2D grid at every energy in one    #
+# run.  The loop order is chosen by predicting the motor time of each:  #
+#                                                                       #
+#   energy:    at each energy, the whole raster (mono moves few times,  #
+#              the stages every point)                                  #
+#   position:  at each pixel, all of the energies (stages move once per #
+#              pixel, the mono every point)                             #
+#                                                                       #
+# using travel_time and the preflight's motion models for dcm_bragg     #
+# and the two stages.  Neither order ever rewinds: alternate rows,      #
+# alternate rasters, and alternate spectra are traversed in reverse.    #
+#                                                                       #
+# The mono is in pseudo-channel-cut mode during the map.  Each event    #
+# has the energy and both motor positions, so the run can be put back   #
+# into an energy x slow x fast cube from the grids in the start         #
+# document, whatever the order:                                         #
+#                                                                       #
+#    RE(xanes_map('it', [8970, 8980, 8985, 8990, 9000, 9020],           #
+#                 'y', -1, 1, 21, 'x', -2, 2, 41, dwell=0.2))           #
+#    xm2npz('/path/to/map.npz', -1)    # one .npz file with the cubes   #
+#    v = XanesMapViewer('/path/to/map.npz')  # click for a spectrum     #
+#########################################################################
+
+
+def _bragg(energy, twod):
+    return 180 * asin(2*pi*HBARC / (energy*twod)) / pi
+
+
+def traverse(order, energies, slow_positions, fast_positions, snake=True):
+    '''Generate (energy index, slow index, fast index) in the order of
+    measurement, without rewinding any axis.'''
+    ne, ns, nf = len(energies), len(slow_positions), len(fast_positions)
+    raster = []
+    for i in range(ns):
+        row = range(nf-1, -1, -1) if snake and i % 2 else range(nf)
+        raster.extend((i, j) for j in row)
+    if order == 'energy':
+        for k in range(ne):
+            for (i, j) in (raster if k % 2 == 0 else raster[::-1]):
+                yield (k, i, j)
+    else:
+        for n, (i, j) in enumerate(raster):
+            for k in (range(ne) if n % 2 == 0 else range(ne-1, -1, -1)):
+                yield (k, i, j)
+
+
+def loop_times(energies, slow, slow_positions, fast, fast_positions, dwell, twod=None, snake=True, ndevices=4):
+    '''Predict the time of each loop order, in seconds.  Return a dict of
+    order -> (total, motion).'''
+    if twod is None:
+        twod = user_ns['dcm']._twod
+    motion = lambda name: preflight.motion.get(name, DEFAULT_VELOCITY)
+    slowm, fastm, braggm = motion(slow.name), motion(fast.name), motion('dcm_bragg')
+    ne, ns, nf = len(energies), len(slow_positions), len(fast_positions)
+
+    fstep = abs(fast_positions[1] - fast_positions[0]) if nf > 1 else 0
+    sstep = abs(slow_positions[1] - slow_positions[0]) if ns > 1 else 0
+    frange = abs(fast_positions[-1] - fast_positions[0])
+    raster = ns*(nf-1)*travel_time(fstep, *fastm)
+    if snake:
+        raster += (ns-1)*travel_time(sstep, *slowm)
+    else:
+        raster += (ns-1)*max(travel_time(sstep, *slowm), travel_time(frange, *fastm))
+    angles = [_bragg(e, twod) for e in energies]
+    spectrum = sum(travel_time(b-a, *braggm) for a, b in zip(angles[:-1], angles[1:]))
+
+    counting = ne*ns*nf*(dwell + TRIGGER_OVERHEAD + ndevices*READOUT + EVENT)
+    motions = {'energy':   ne*raster + spectrum,
+               'position': raster + ns*nf*spectrum}
+    return {k: (counting + v, v) for k, v in motions.items()}
+
+
+def xanes_map(detector, energies,
+              slow, startslow, stopslow, nslow,
+              fast, startfast, stopfast, nfast,
+              dwell=0.1, order=None, snake=True, force=False, md={}):
+    '''
+    XANES imaging: an area scan at each of a list of energies, in one
+    run.  The grid is RELATIVE to the current positions of the motors.
+
+       detector: 'it' or 'if'
+       energies: list of energies in eV
+       slow:     slow axis motor or nickname
+       startslow, stopslow, nslow: relative range and number of rows
+       fast:     fast axis motor or nickname
+       startfast, stopfast, nfast: relative range and number of columns
+       dwell:    dwell time at each point (0.1 sec default)
+       order:    'energy', 'position', or None to choose the faster
+       snake:    measure alternate rows in opposite directions
+       force:    flag for forcing a scan even if not clear to start
+       md:       composable dictionary of metadata
+
+    See the comment above.  Use xm2npz() to export the map and
+    XanesMapViewer to look at it.
+    '''
+    RE, BMMuser = user_ns['RE'], user_ns['BMMuser']
+    energies = [float(e) for e in energies]
+    if BMMuser.macro_dryrun or preflight.active:
+        return(yield from dryrun('xanes_map', 'BMMuser.macro_dryrun is True.  Sleeping for %.1f seconds rather than running a XANES map.' %
+                                 BMMuser.macro_sleep, energies=energies,
+                                 slow=slow, slow_positions=list(numpy.linspace(startslow, stopslow, nslow)),
+                                 fast=fast, fast_positions=list(numpy.linspace(startfast, stopfast, nfast)),
+                                 dwell=dwell, order=order, snake=snake))
+
+    from BMM.linescans import motor_nicknames
+    dcm, quadem1 = user_ns['dcm'], user_ns['quadem1']
+
+    def main_plan():
+        (ok, text) = BMM_clear_to_start()
+        if force is False and ok is False:
+            print(error_msg(text))
+            yield from null()
+            return
+        if len(energies) < 2:
+            print(error_msg('\n*** A XANES map needs at least two energies\n'))
+            yield from null()
+            return
+
+        dets = [quadem1,]
+        if detector.lower() == 'if':
+            dets.append(user_ns['vor'])
+        yield from abs_set(user_ns['_locked_dwell_time'], dwell, wait=True)
+
+        ## the mono moves in pseudo-channel-cut mode
+        dcm.mode = 'fixed'
+        yield from mv(dcm.energy, eave)
+        dcm.mode = 'channelcut'
+
+        _md = {'XDI':            {'Facility': {'GUP': BMMuser.gup, 'SAF': BMMuser.saf}},
+               'detectors':      [d.name for d in dets],
+               'motors':         [dcm.energy.name, slow.name, fast.name],
+               'slow_motor':     slow.name,
+               'fast_motor':     fast.name,
+               'energies':       energies,
+               'slow_positions': list(slow_positions),
+               'fast_positions': list(fast_positions),
+               'shape':          (len(energies), nslow, nfast),
+               'loop_order':     order,
+               'snaking':        (False, snake),
+               'num_points':     len(energies)*nslow*nfast,
+               'plan_name':      'xanes_map',
+               'plan_args':      {'detector': detector, 'energies': energies, 'slow': slow.name, 'fast': fast.name,
+                                  'dwell': dwell, 'order': order, 'snake': snake},
+               'hints':          {'dimensions': [([slow.name], 'primary'), ([fast.name], 'primary')]},
+        }
+
+        @run_decorator(md={**_md, **md})
+        def measure():
+            here = dict()
+            for (k, i, j) in traverse(order, energies, slow_positions, fast_positions, snake):
+                args = []
+                for motor, target in ((dcm.energy, energies[k]), (slow, slow_positions[i]), (fast, fast_positions[j])):
+                    if here.get(motor.name) != target:
+                        args.extend([motor, target])
+                        here[motor.name] = target
+                yield from mv(*args)
+                yield from trigger_and_read(dets + [dcm.energy, slow, fast])
+
+        BMM_log_info('begin XANES map: %s, %d energies from %.1f to %.1f, %s order\n%s%s' %
+                     (detector, len(energies), min(energies), max(energies), order, line1, line2))
+        uid = yield from measure()
+        BMM_log_info('XANES map finished\n\tuid = %s, scan_id = %d' % (uid, runcache.start_doc(uid)['scan_id']))
+
+    def cleanup_plan():
+        dcm.mode = 'fixed'
+        yield from mv(dcm.energy, eave, slow, valueslow, fast, valuefast)
+        yield from resting_state_plan()
+        RE.msg_hook = BMM_msg_hook
+
+    ## resolve the motors and the grid
+    if type(slow) is str: slow = motor_nicknames.get(slow.lower(), slow)
+    if type(fast) is str: fast = motor_nicknames.get(fast.lower(), fast)
+    if type(slow) is str or type(fast) is str:
+        print(error_msg('\n*** %s is not an areascan motor (%s)\n' %
+                        (slow if type(slow) is str else fast, str.join(', ', motor_nicknames.keys()))))
+        return(yield from null())
+    valueslow, valuefast = slow.position, fast.position
+    slow_positions = valueslow + numpy.linspace(startslow, stopslow, nslow)
+    fast_positions = valuefast + numpy.linspace(startfast, stopfast, nfast)
+    eave = numpy.mean(energies)
+    line1 = 'slow motor: %s, %.3f, %.3f, %d -- starting at %.3f\n' % (slow.name, startslow, stopslow, nslow, valueslow)
+    line2 = 'fast motor: %s, %.3f, %.3f, %d -- starting at %.3f\n' % (fast.name, startfast, stopfast, nfast, valuefast)
+
+    times = loop_times(energies, slow, slow_positions, fast, fast_positions, dwell, snake=snake, ndevices=2 if detector.lower() == 'it' else 3)
+    if order is None:
+        order = min(times, key=lambda k: times[k][0])
+    for k, (total, motion) in sorted(times.items()):
+        print(whisper('  %-8s order: %s predicted, %s of it moving motors%s' %
+                      (k, hms(total), hms(motion), '  <--' if k == order else '')))
+
+    RE.msg_hook = None
+    yield from finalize_wrapper(main_plan(), cleanup_plan())
+    RE.msg_hook = BMM_msg_hook
+
+
+## --*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--
+## export and viewing
+def xanes_cube(key=-1):
+    '''Put a XANES map back into cubes (energy x slow x fast), one for
+    each data column.  Return (start document, dict of arrays).'''
+    start = runcache.start_doc(key)
+    if start.get('plan_name') != 'xanes_map':
+        print(error_msg('That database entry does not seem to be a XANES map'))
+        return None, None
+    energies = numpy.array(start['energies'])
+    slowgrid = numpy.array(start['slow_positions'])
+    fastgrid = numpy.array(start['fast_positions'])
+    table = runcache.table(key)
+    nearest = lambda grid, values: numpy.abs(numpy.asarray(values, dtype=float)[:, None] - grid[None, :]).argmin(axis=1)
+    k = nearest(energies, table[start['motors'][0]])
+    i = nearest(slowgrid, table[start['slow_motor']])
+    j = nearest(fastgrid, table[start['fast_motor']])
+    cubes = {'energies': energies, 'slow': slowgrid, 'fast': fastgrid}
+    for column in table.columns:
+        values = numpy.asarray(table[column])
+        if column == 'time' or values.dtype.kind not in 'iuf':
+            continue
+        cube = numpy.full(start['shape'], numpy.nan)
+        cube[k, i, j] = values
+        cubes[column] = cube
+    return start, cubes
+
+
+def xm2npz(filename, key=-1):
+    '''
+    Export a XANES map to a numpy .npz file, one array per data column,
+    each of shape (energies, slow, fast), plus the energies and the slow
+    and fast grids.
+
+      xm2npz('/path/to/map.npz', -1)
+
+    Read it back with numpy.load.
+    '''
+    if os.path.isfile(filename):
+        print(error_msg('%s already exists!  Bailing out....' % filename))
+        return
+    start, cubes = xanes_cube(key)
+    if cubes is None:
+        return
+    numpy.savez(filename, uid=start['uid'], slow_motor=start['slow_motor'], fast_motor=start['fast_motor'], **cubes)
+    print(bold_msg('wrote XANES map to %s' % filename))
+
+
+class XanesMapViewer():
+    '''Show a XANES map with the per-pixel spectra.  The left panel is
+    the edge step (the last energy less the first) or the map at one
+    energy; click on it to plot that pixel's spectrum on the right.
+
+      v = XanesMapViewer('/path/to/map.npz')    # or a database key
+      v.show(8985)                              # the map at one energy
+
+    signal is 'transmission' (ln(I0/It)) or 'fluorescence' (the sum of
+    the dead-time corrected channels over I0).
+    '''
+    def __init__(self, source=-1, signal='transmission'):
+        if isinstance(source, str) and os.path.isfile(source):
+            data = numpy.load(source)
+            cubes = {k: data[k] for k in data.files}
+        else:
+            start, cubes = xanes_cube(source)
+            if cubes is None:
+                return
+        self.energies = cubes['energies']
+        self.slow, self.fast = cubes['slow'], cubes['fast']
+        if signal == 'fluorescence':
+            BMMuser = user_ns['BMMuser']
+            channels = [c for c in (BMMuser.dtc1, BMMuser.dtc2, BMMuser.dtc3, BMMuser.dtc4) if c in cubes]
+            self.mu = sum(cubes[c] for c in channels) / cubes['I0']
+        else:
+            self.mu = numpy.log(numpy.abs(cubes['I0'] / cubes['It']))
+        self.fig, (self.map_ax, self.spectrum_ax) = plt.subplots(1, 2, figsize=(11, 4.5))
+        self.spectrum_ax.set_xlabel('energy (eV)')
+        self.spectrum_ax.set_ylabel('mu(E)')
+        self.spectrum_ax.plot(self.energies, numpy.nanmean(self.mu, axis=(1, 2)), color='grey', label='average')
+        self.spectrum_ax.legend(loc=0)
+        self.image = None
+        self.fig.canvas.mpl_connect('button_press_event', self.click)
+        self.show()
+
+    def show(self, energy=None):
+        if energy is None:
+            values, title = self.mu[-1] - self.mu[0], 'edge step'
+        else:
+            k = int(numpy.abs(self.energies - energy).argmin())
+            values, title = self.mu[k], '%.1f eV' % self.energies[k]
+        extent = (self.fast[0], self.fast[-1], self.slow[0], self.slow[-1])
+        if self.image is None:
+            self.image = self.map_ax.imshow(values, origin='lower', extent=extent, aspect='auto')
+        else:
+            self.image.set_data(values)
+            self.image.autoscale()
+        self.map_ax.set_title(title)
+        self.fig.canvas.draw_idle()
+
+    def click(self, ev):
+        if ev.inaxes is not self.map_ax:
+            return
+        i = int(numpy.abs(self.slow - ev.ydata).argmin())
+        j = int(numpy.abs(self.fast - ev.xdata).argmin())
+        self.spectrum_ax.plot(self.energies, self.mu[:, i, j], marker='.', label='(%.3f, %.3f)' % (self.fast[j], self.slow[i]))
+        self.spectrum_ax.legend(loc=0)
+        self.fig.canvas.draw_idle()
@@ -1,5 +1,9 @@
 from bluesky import __version__ as bluesky_version
-import re, pathlib, sys, datetime, pandas, numpy
+from bluesky.callbacks import CallbackBase
+import re, os, pathlib, sys, datetime, pandas, numpy
+
+from BMM.functions import bold_msg, error_msg
+from BMM.sidecar   import write_sidecar
 
 from IPython import get_ipython
 user_ns = get_ipython().user_ns
@@ -51,7 +55,7 @@ fluorescence_1ch = [quadem1.I0, quadem1.It, quadem1.Ir, vor.dtcorr1, vor.channel
 class metadata_for_XDI_file():
     def __init__(self):
         self.xdilist = []
-        self.dataframe = None
+        self.start = None
 
     def insert_line(self, line):
         '''Insert a line directly into the list of header lines. Presumably,
@@ -84,7 +88,7 @@ class metadata_for_XDI_file():
         text = ''
         (group,family,key) = datum.split('.') # e.g. XDI.Beamline.name
         try:
-            text = template % self.dataframe.start[group][family][key]
+            text = template % self.start[group][family][key]
         except:
             if '%s' in template:
                 text = template % ''
@@ -93,35 +97,53 @@ class metadata_for_XDI_file():
         self.xdilist.append(text)
 
 
-
-def write_XDI(datafile, dataframe):
-    BMMuser = user_ns['BMMuser']
-    handle = open(datafile, 'w')
-
-    ## set Scan.start_time & Scan.end_time ... this is how it is done
-    d=datetime.datetime.fromtimestamp(round(dataframe.start['time']))
-    start_time = datetime.datetime.isoformat(d)
-    d=datetime.datetime.fromtimestamp(round(dataframe.stop['time']))
-    end_time   = datetime.datetime.isoformat(d)
-    st = pandas.Timestamp(start_time) # this is a UTC problem
-
-    ##################################
-    # grab the "underscore" metadata #
-    ##################################
+def xdi_kind(start):
+    '''Grab the "underscore" metadata from a start document.  Return (mode, comment, kind).'''
     try:
-        mode = dataframe.start['XDI']['_mode'][0]
+        mode = start['XDI']['_mode'][0]
     except:
         mode = 'transmission'
 
     try:
-        comment = dataframe.start['XDI']['_comment'][0]
+        comment = start['XDI']['_comment'][0]
     except:
         comment = ''
 
     try:
-        kind = dataframe.start['XDI']['_kind']
+        kind = start['XDI']['_kind']
     except:
         kind = 'xafs'
+    return mode, comment, kind
+
+
+def xdi_sorted(start):
+    '''An adaptive scan is not measured in energy order, so its rows are
+    sorted by energy when written.'''
+    try:
+        return bool(start['XDI']['_adaptive'])
+    except (KeyError, TypeError):
+        return False
+
+
+def xdi_time(stamp):
+    '''Format an epoch time as XDI wants it for Scan.start_time & Scan.end_time.'''
+    d=datetime.datetime.fromtimestamp(round(stamp))
+    return datetime.datetime.isoformat(d)
+
+
+def xdi_header(start, baseline, start_time, end_time):
+    '''Assemble the header of an XDI file.
+
+      start:      the start document
+      baseline:   function returning the first baseline reading of a device, by name
+      start_time: ISO 8601 string
+      end_time:   ISO 8601 string
+
+    Return (lines, labels), where lines is the list of header lines up
+    to and including Column.N, and labels is the list of column labels.
+    '''
+    BMMuser = user_ns['BMMuser']
+    mode, comment, kind = xdi_kind(start)
 
     ##########################
     # grab the detector list #
@@ -147,7 +169,7 @@ def write_XDI(datafile, dataframe):
     # start gathering formatted metadata lines #
     ############################################
     metadata = metadata_for_XDI_file()
-    metadata.dataframe = dataframe
+    metadata.start = start
 
     ## snarf XDI metadata from the dataframe and elsewhere
     metadata.insert_line('# XDI/1.0 BlueSky/%s BMM/%s' % (bluesky_version, pathlib.Path(sys.executable).parts[-3]))
@@ -195,22 +217,22 @@ def write_XDI(datafile, dataframe):
     XDI_record = user_ns['XDI_record']
     for r in XDI_record.keys():
         if XDI_record[r][0] is True:
-            metadata.insert_line('# %s: %.3f mm' % (XDI_record[r][1], dataframe.table('baseline')[r][1]))
+            metadata.insert_line('# %s: %.3f mm' % (XDI_record[r][1], baseline(r)))
     
     metadata.start_doc('# Scan.experimenters: %s', 'XDI.Scan.experimenters')
     metadata.start_doc('# Scan.edge_energy: %s',   'XDI.Scan.edge_energy')
 
     if kind == '333':
         try:
-            ththth_energy = dataframe.start['XDI']['Scan']['edge_energy'] / 3.0
+            ththth_energy = start['XDI']['Scan']['edge_energy'] / 3.0
             metadata.insert_line('# Scan.edge_energy_333: %.1f'  % ththth_energy)
         except:
             pass
 
     metadata.insert_line('# Scan.start_time: %s'   % start_time)
     metadata.insert_line('# Scan.end_time: %s'     % end_time)
-    metadata.insert_line('# Scan.transient_id: %s' % dataframe.start['scan_id'])
-    metadata.insert_line('# Scan.uid: %s'          % dataframe.start['uid'])
+    metadata.insert_line('# Scan.transient_id: %s' % start['scan_id'])
+    metadata.insert_line('# Scan.uid: %s'          % start['uid'])
 
     if kind == 'sead':
         metadata.start_doc('# Beamline.energy: %.3f', 'XDI.Beamline.energy')
@@ -259,17 +281,15 @@ def write_XDI(datafile, dataframe):
         labels.append(this)
         metadata.insert_line('# Column.%d: %s %s' % (i, this, units(this)))
 
-    ####################
-    # write it all out #
-    ####################
-    eol = '\n'
-    for line in metadata.xdilist:
-        handle.write(line + eol)
-    handle.write('# ///////////' + eol)
-    handle.write('# ' + comment + eol)
-    handle.write('# -----------' + eol)
-    handle.write('# ' + '  '.join(labels) + eol)
-    table = dataframe.table()
+    return metadata.xdilist, labels
+
+
+def xdi_columns(table, mode, kind):
+    '''Compute the xmu (and, for Si(333), the 333_energy) column of a
+    table of measurements.  table can be a DataFrame or a dict of
+    values from a single event.  Return (column_list, template), the
+    ordered list of columns to write and the format of a row.'''
+    BMMuser = user_ns['BMMuser']
     if 'fluo' in mode or 'flou' in mode or 'both' in mode:
         table['xmu'] = (table[BMMuser.dtc1] + table[BMMuser.dtc2] + table[BMMuser.dtc4]) / table['I0']
         if kind == '333':
@@ -319,15 +339,245 @@ def write_XDI(datafile, dataframe):
         column_list.pop(0)
         column_list.insert(0, 'time')
         template = template[12:]
-    this = table.loc[:,column_list]
-
-    for i in range(0,len(this)):
-        datapoint = list(this.iloc[i])
-        if kind == 'sead':
-            ti = this.iloc[i, 0]
-            elapsed =  (ti.value - st.value)/10**9
-            datapoint[0] = elapsed
-        handle.write(template % tuple(datapoint))
-        #handle.write(template % tuple(this.iloc[i]))
+    return column_list, template
+
+
+def write_XDI(datafile, dataframe, final=None):
+    '''Write an XDI file from a databroker header or from a run in the
+    run cache (see BMM/runcache.py).  final is the name the file will
+    be moved to if datafile is a temporary name, see write_sidecar.'''
+    handle = open(datafile, 'w')
+
+    ## set Scan.start_time & Scan.end_time ... this is how it is done
+    start_time = xdi_time(dataframe.start['time'])
+    end_time   = xdi_time(dataframe.stop['time'])
+    st = pandas.Timestamp(start_time) # this is a UTC problem
+
+    mode, comment, kind = xdi_kind(dataframe.start)
+    baseline_table = dataframe.table('baseline')
+    baseline = lambda r: baseline_table[r][1]
+    (lines, labels) = xdi_header(dataframe.start, baseline, start_time, end_time)
+
+    ####################
+    # write it all out #
+    ####################
+    eol = '\n'
+    lines = lines + ['# ///////////', '# ' + comment, '# -----------', '# ' + '  '.join(labels)]
+    for line in lines:
+        handle.write(line + eol)
+    table = dataframe.table()
+    (column_list, template) = xdi_columns(table, mode, kind)
+    data = xdi_array(table.loc[:,column_list], kind, st)
+    if xdi_sorted(dataframe.start):
+        data = data[numpy.argsort(data[:,0], kind='stable')]
+    handle.write(xdi_format(data, template))
     handle.flush()
     handle.close()
+
+    if user_ns['BMMuser'].sidecar:
+        write_sidecar(datafile, column_list, data, lines, dataframe.start, final=final)
+
+
+def xdi_complete(datafile, dataframe):
+    '''True if datafile exists and holds as many rows of data as the
+    primary stream of the run has events.'''
+    try:
+        expected = dataframe.stop['num_events']['primary']
+        with open(datafile) as f:
+            rows = sum(1 for line in f if line.strip() and not line.startswith('#'))
+    except (OSError, KeyError, TypeError):
+        return False
+    return rows == expected
+
+
+def xdi_table(this, template, kind, st=None):
+    '''Format the data section of an XDI file in one go.
+
+      this:     DataFrame holding the columns to write, in order
+      template: format of one row, from xdi_columns()
+      kind:     'sead' means the first column is a time stamp
+      st:       pandas Timestamp of the start of a sead scan
+
+    The table is turned into a single flat list of floats and the row
+    template, repeated once per row, is applied to all of it with a
+    single % operation.  This gives exactly the same text as applying
+    the template row by row, but without the per-row pandas overhead.
+    For a sead scan, the elapsed time column is computed for the
+    whole table at once.
+    '''
+    return xdi_format(xdi_array(this, kind, st), template)
+
+
+def xdi_array(this, kind, st=None):
+    '''Return the columns to be written to an XDI file as a 2D array,
+    with the time stamps of a sead scan turned into elapsed seconds.'''
+    columns = []
+    for i, c in enumerate(this.columns):
+        if i == 0 and kind == 'sead':
+            ti = this.iloc[:, 0].values.astype('datetime64[ns]').astype(numpy.int64)
+            columns.append((ti - st.value)/10**9)
+        else:
+            columns.append(this.iloc[:, i].values)
+    if len(columns) == 0:
+        return numpy.zeros((len(this), 0))
+    return numpy.column_stack(columns)
+
+
+def xdi_format(data, template):
+    '''Apply a row template to every row of a 2D array at once.'''
+    if len(data) == 0:
+        return ''
+    return (template * len(data)) % tuple(data.ravel().tolist())
+
+
+class XDIFileWriter(CallbackBase):
+    '''A callback which writes an XDI file as a scan happens.
+
+    The header is written when the first event of the primary stream
+    arrives, by which time the start document and the baseline readings
+    are in hand.  Each primary event is then appended to the file as
+    one formatted row.  When the stop document arrives, the
+    Scan.end_time line is filled in.  Until then, that line holds the
+    start time, so a scan which dies part way through still leaves a
+    valid XDI file with all the data measured up to that point.  The
+    rows of an adaptive scan are rewritten in energy order at the end.
+
+    The file name is taken from the _filename item of the XDI part of
+    the start document, relative to folder (or to BMMuser.DATA if
+    folder is None).  A run without _filename is ignored.
+
+      writer = XDIFileWriter(folder=p['folder'])
+      @subs_decorator(writer)
+      def plan(): ...
+
+    The columns and formatting are the same as write_XDI().
+
+    This runs inside the RunEngine, which raises a callback's exception
+    in the plan, so any error writing the file is reported once and the
+    writer then ignores the rest of the run -- the measurement goes on,
+    and the post-scan processing writes the file from the run cache
+    instead (see xdi_complete).
+    '''
+    def __init__(self, folder=None):
+        super().__init__()
+        self.folder = folder
+        self._reset()
+
+    def _reset(self):
+        self.handle      = None
+        self.datafile    = None
+        self.start_doc   = None
+        self.streams     = dict()
+        self.baseline    = dict()
+        self.end_cookie  = None
+        self.column_list = None
+        self.template    = None
+        self.npoints     = 0
+        self.header      = []
+        self.rows        = []
+        self.data_cookie = None
+
+    def _fail(self, stage, e):
+        '''Report an error and stop writing this run.'''
+        print(error_msg('could not write %s (%s): %s -- it will be written from the run cache after the scan' % (self.datafile, stage, e)))
+        try:
+            if self.handle is not None:
+                self.handle.close()
+        except Exception:
+            pass
+        self._reset()
+
+    def start(self, doc):
+        self._reset()
+        try:
+            filename = doc['XDI']['_filename']
+        except (KeyError, TypeError):
+            return
+        try:
+            self._start(doc, filename)
+        except Exception as e:
+            self._fail('start', e)
+
+    def _start(self, doc, filename):
+        folder = self.folder
+        if folder is None:
+            folder = user_ns['BMMuser'].DATA
+        self.datafile  = os.path.join(folder, filename)
+        self.start_doc = doc
+        self.mode, self.comment, self.kind = xdi_kind(doc)
+        self.st = round(doc['time'])
+
+    def descriptor(self, doc):
+        self.streams[doc['uid']] = doc['name']
+
+    def _write_header(self):
+        start_time = xdi_time(self.start_doc['time'])
+        baseline   = lambda r: self.baseline[r]
+        (lines, labels) = xdi_header(self.start_doc, baseline, start_time, start_time)
+        self.handle = open(self.datafile, 'w')
+        eol = '\n'
+        self.header = lines + ['# ///////////', '# ' + self.comment, '# -----------', '# ' + '  '.join(labels)]
+        for line in self.header:
+            if line.startswith('# Scan.end_time:'):
+                self.end_cookie = self.handle.tell()
+            self.handle.write(line + eol)
+        self.data_cookie = self.handle.tell()
+        self.handle.flush()
+
+    def event(self, doc):
+        if self.datafile is None:
+            return
+        try:
+            self._event(doc)
+        except Exception as e:
+            self._fail('event', e)
+
+    def _event(self, doc):
+        stream = self.streams.get(doc['descriptor'])
+        if stream == 'baseline':
+            if len(self.baseline) == 0:
+                self.baseline = dict(doc['data'])
+            return
+        if stream != 'primary':
+            return
+        if self.handle is None:
+            self._write_header()
+        row = dict(doc['data'])
+        row['time'] = doc['time']
+        (self.column_list, self.template) = xdi_columns(row, self.mode, self.kind)
+        datapoint = [row[c] for c in self.column_list]
+        if self.kind == 'sead':
+            datapoint[0] = doc['time'] - self.st
+        self.handle.write(self.template % tuple(datapoint))
+        self.handle.flush()
+        self.rows.append(datapoint)
+        self.npoints += 1
+
+    def stop(self, doc):
+        if self.datafile is None:
+            return
+        try:
+            self._stop(doc)
+        except Exception as e:
+            self._fail('stop', e)
+
+    def _stop(self, doc):
+        if self.handle is None:
+            self._write_header()
+        end_time = '# Scan.end_time: %s' % xdi_time(doc['time'])
+        if self.end_cookie is not None:
+            self.handle.seek(self.end_cookie)
+            self.handle.write(end_time + '\n')
+            self.handle.seek(0, os.SEEK_END)
+        if xdi_sorted(self.start_doc) and len(self.rows) > 0:
+            data = numpy.array(self.rows, dtype=float)
+            self.rows = data[numpy.argsort(data[:,0], kind='stable')]
+            self.handle.seek(self.data_cookie)
+            self.handle.truncate()
+            self.handle.write(xdi_format(self.rows, self.template))
+        self.handle.close()
+        print(bold_msg('wrote %s' % self.datafile))
+        if user_ns['BMMuser'].sidecar and self.column_list is not None:
+            header = [end_time if l.startswith('# Scan.end_time:') else l for l in self.header]
+            write_sidecar(self.datafile, self.column_list, self.rows, header, self.start_doc)
+        self._reset()
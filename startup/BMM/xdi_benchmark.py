@@ -0,0 +1,112 @@
+import numpy, pandas, time, datetime
+
+from BMM.functions import error_msg, warning_msg, bold_msg, whisper
+from BMM.xdi       import xdi_columns, xdi_table
+
+from IPython import get_ipython
+user_ns = get_ipython().user_ns
+
+
+#########################################################################
+# Benchmark for the data section of write_XDI                           #
+#                                                                       #
+# Synthetic tables are made for each of the data file layouts written   #
+# by write_XDI.  Each is formatted by xdi_table() and by the row-by-row #
+# loop that write_XDI used to use.  The two must be identical and the   #
+# time taken by each is reported.  Run this after touching xdi.py:      #
+#                                                                       #
+#    xdi_benchmark()                                                    #
+#    xdi_benchmark(sizes=(1000,), layouts=('sead',))                    #
+#########################################################################
+
+LAYOUTS = {'transmission' : ('transmission', 'xafs'),
+           'fluorescence' : ('fluorescence', 'xafs'),
+           'xs'           : ('xs',           'xafs'),
+           'yield'        : ('yield',        'xafs'),
+           'sead'         : ('fluorescence', 'sead'),}
+
+
+def legacy_table(this, template, kind, st=None):
+    '''The data section of an XDI file as write_XDI formatted it before
+    xdi_table() -- one row at a time.  Kept as the reference output.'''
+    text = []
+    for i in range(0,len(this)):
+        datapoint = list(this.iloc[i])
+        if kind == 'sead':
+            ti = this.iloc[i, 0]
+            elapsed =  (ti.value - st.value)/10**9
+            datapoint[0] = elapsed
+        text.append(template % tuple(datapoint))
+    return ''.join(text)
+
+
+def synthetic_table(npoints, seed=0):
+    '''Make a DataFrame with every column any write_XDI layout might
+    want, filled with plausible random values.'''
+    BMMuser = user_ns['BMMuser']
+    rng = numpy.random.default_rng(seed)
+    start = round(time.time())
+    table = pandas.DataFrame(index=numpy.arange(1, npoints+1))
+    stamps = start + 1 + numpy.arange(npoints)*0.7 + rng.random(npoints)*0.01
+    table['time']                = pandas.to_datetime([datetime.datetime.fromtimestamp(t) for t in stamps])
+    table['dcm_energy']          = 6912 + numpy.arange(npoints)*0.37 + rng.random(npoints)*0.01
+    table['dcm_energy_setpoint'] = 6912 + numpy.arange(npoints)*0.37
+    table['dwti_dwell_time']     = 0.5 + rng.random(npoints)*0.001
+    for c in ('I0', 'It', 'Ir', 'Iy'):
+        table[c] = 0.1 + rng.random(npoints)*10
+    for c in (BMMuser.dtc1, BMMuser.dtc2, BMMuser.dtc3, BMMuser.dtc4,
+              BMMuser.xs1,  BMMuser.xs2,  BMMuser.xs3,  BMMuser.xs4):
+        table[c] = rng.random(npoints)*1e4
+    for i, c in enumerate((BMMuser.roi1, BMMuser.roi2, BMMuser.roi3, BMMuser.roi4), start=1):
+        table[c]         = rng.integers(0, 10000,  npoints)
+        table['ICR%d'%i] = rng.integers(0, 200000, npoints)
+        table['OCR%d'%i] = rng.integers(0, 150000, npoints)
+    return table, pandas.Timestamp(datetime.datetime.fromtimestamp(start))
+
+
+def _best(func, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        text = func()
+        times.append(time.perf_counter() - t0)
+    return text, min(times)
+
+
+def xdi_benchmark(sizes=(1000, 10000, 100000), layouts=tuple(LAYOUTS.keys()), repeat=3, legacy=True):
+    '''Time the formatting of the data section of an XDI file.
+
+      sizes:   numbers of rows to try
+      layouts: any of transmission, fluorescence, xs, yield, sead
+      repeat:  best of this many tries is reported for xdi_table
+      legacy:  False to skip timing (and checking against) the old
+               row-by-row loop, which is slow for large tables
+
+    Return a list of (layout, rows, xdi_table time, legacy time,
+    identical) tuples.  An error message is printed for any layout
+    where the two disagree.
+    '''
+    results = []
+    print(bold_msg('%-14s %8s %12s %12s %8s' % ('layout', 'rows', 'vectorized', 'row loop', 'speedup')))
+    for npoints in sizes:
+        table, st = synthetic_table(npoints)
+        for layout in layouts:
+            if layout not in LAYOUTS:
+                print(error_msg('"%s" is not a write_XDI layout' % layout))
+                continue
+            mode, kind = LAYOUTS[layout]
+            this_table = table.copy()
+            (column_list, template) = xdi_columns(this_table, mode, kind)
+            this = this_table.loc[:, column_list]
+            text, fast = _best(lambda: xdi_table(this, template, kind, st), repeat)
+            if legacy:
+                reference, slow = _best(lambda: legacy_table(this, template, kind, st), 1)
+                same = text == reference
+                print('%-14s %8d %10.4f s %10.4f s %7.1fx' % (layout, npoints, fast, slow, slow/fast))
+                if not same:
+                    print(error_msg('   %s, %d rows: xdi_table output differs from the row-by-row output!' % (layout, npoints)))
+            else:
+                slow, same = None, None
+                print('%-14s %8d %10.4f s %12s %8s' % (layout, npoints, fast, '', ''))
+            results.append((layout, npoints, fast, slow, same))
+    return results
@@ -37,6 +37,7 @@ user_ns = get_ipython().user_ns
 from BMM.functions     import error_msg, warning_msg, go_msg, url_msg, bold_msg, verbosebold_msg, list_msg, disconnected_msg, info_msg, whisper
 from BMM.functions     import now
 from BMM.metadata      import mirror_state
+from BMM.sidecar       import write_sidecar
 
 from databroker.assets.handlers import HandlerBase, Xspress3HDF5Handler, XS3_XRF_DATA_KEY
 
@@ -394,4 +395,6 @@ class BMMXspress3Detector(XspressTrigger, Xspress3Detector):
         handle.flush()
         handle.close()
         print(bold_msg('wrote XRF spectra to %s' % filename))
+        if BMMuser.sidecar:
+            write_sidecar(filename, ['energy'] + column_list, numpy.column_stack([e, a.transpose()]))
         
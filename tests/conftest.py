@@ -0,0 +1,11 @@
+import builtins, os, sys, tempfile
+
+from IPython.core.interactiveshell import InteractiveShell
+
+## the BMM modules find user_ns through get_ipython() when imported --
+## BMM.functions calls it as a builtin, as in an IPython session -- and
+## BMM.logging makes its log file under $HOME/Data
+os.environ['HOME'] = tempfile.mkdtemp(prefix='bmm-tests-')
+shell = InteractiveShell.instance()
+builtins.get_ipython = lambda: shell
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'startup'))
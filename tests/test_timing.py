@@ -0,0 +1,92 @@
+import pytest
+
+## the beamline profile's dependencies, as imported by BMM.functions
+for module in ('bluesky', 'ophyd', 'inflection', 'textwrap3', 'ansiwrap'):
+    pytest.importorskip(module)
+
+from bluesky import RunEngine
+from bluesky.plans import count, scan_nd
+from cycler import cycler
+from ophyd.sim import det, motor
+
+import BMM.perstep, BMM.profiler
+from BMM.perstep  import FusedStep, with_step_timing
+from BMM.profiler import DeadTimeProfiler
+
+
+@pytest.fixture(autouse=True)
+def quiet_log(monkeypatch):
+    ## the experiment log lives on the beamline file system
+    monkeypatch.setattr(BMM.perstep,  'BMM_log_info', lambda text: None)
+    monkeypatch.setattr(BMM.profiler, 'BMM_log_info', lambda text: None)
+
+
+def documents(plan, preprocessors=()):
+    '''Run plan, returning the list of (name, doc) it produced.  A
+    plan which fails is allowed to.'''
+    RE = RunEngine({})
+    RE.preprocessors.extend(preprocessors)
+    docs = []
+    RE.subscribe(lambda name, doc: docs.append((name, doc)))
+    try:
+        RE(plan)
+    except RuntimeError:
+        pass
+    return docs
+
+def streams(docs):
+    return [d['name'] for n,d in docs if n == 'descriptor']
+
+def exit_status(docs):
+    return [d['exit_status'] for n,d in docs if n == 'stop'][0]
+
+def failing(fused, after):
+    '''A per_step which fails once after points have been measured.'''
+    def per_step(detectors, step, pos_cache):
+        if fused.index == after:
+            raise RuntimeError('failed after %d points' % after)
+        return (yield from fused(detectors, step, pos_cache))
+    return per_step
+
+
+def test_step_timing_success():
+    trajectory = cycler(motor, [1, 2, 3, 4, 5])
+    fused = FusedStep(trajectory)
+    docs = documents(with_step_timing(scan_nd([det], trajectory, per_step=fused), fused))
+    assert exit_status(docs) == 'success'
+    assert streams(docs) == ['primary', 'timing']
+    timing = [d for n,d in docs if n == 'event'][-1]
+    assert timing['data']['points'] == 5
+
+def test_step_timing_failure():
+    trajectory = cycler(motor, [1, 2, 3, 4, 5])
+    fused = FusedStep(trajectory)
+    docs = documents(with_step_timing(scan_nd([det], trajectory, per_step=failing(fused, 3)), fused))
+    assert exit_status(docs) == 'fail'
+    assert len(fused.total) == 3
+    assert 'timing' not in streams(docs)
+
+
+def test_profiler_success():
+    docs = documents(count([det], num=3), [DeadTimeProfiler()])
+    assert exit_status(docs) == 'success'
+    assert streams(docs) == ['primary', 'timing']
+    timing = [d for n,d in docs if n == 'event'][-1]
+    assert timing['data']['points'] == 3
+    assert set(BMM.perstep.PHASES) <= set(timing['data'].keys())
+
+def test_profiler_failure():
+    trajectory = cycler(motor, [1, 2, 3, 4, 5])
+    fused = FusedStep(trajectory)
+    docs = documents(scan_nd([det], trajectory, per_step=failing(fused, 3)), [DeadTimeProfiler()])
+    assert exit_status(docs) == 'fail'
+    assert 'timing' not in streams(docs)
+
+def test_profiler_with_step_timing():
+    '''The run gets one timing event, from with_step_timing.'''
+    trajectory = cycler(motor, [1, 2, 3, 4, 5])
+    fused = FusedStep(trajectory)
+    docs = documents(with_step_timing(scan_nd([det], trajectory, per_step=fused), fused), [DeadTimeProfiler()])
+    assert exit_status(docs) == 'success'
+    assert streams(docs) == ['primary', 'timing']
+    assert 'dwell_sets' in [d for n,d in docs if n == 'event'][-1]['data']